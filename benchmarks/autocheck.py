@@ -0,0 +1,111 @@
+'''Benchmark of the autocheck dispatcher with many subscribed channels
+
+Simulates dispatching and rescheduling jobs for N channels, first with the
+previous approach of a list of jobs scanned with min() for every dispatch and
+a database query to see whether the channel is muted, then with
+subscriptions.AutocheckScheduler. Also times scheduling, rescheduling and
+cancelling single channels with the scheduler.
+
+Run from the top directory:
+    python3 -m benchmarks.autocheck --channels 50000
+'''
+from youtube import subscriptions
+
+import argparse
+import contextlib
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+
+def make_database(path, channel_ids):
+    with contextlib.closing(sqlite3.connect(path)) as connection:
+        with connection:
+            connection.execute('''CREATE TABLE subscribed_channels (
+                                      id integer PRIMARY KEY,
+                                      yt_channel_id text UNIQUE NOT NULL,
+                                      muted integer DEFAULT 0
+                                  )''')
+            connection.executemany(
+                'INSERT INTO subscribed_channels (yt_channel_id) VALUES (?)',
+                ((channel_id,) for channel_id in channel_ids))
+
+
+def legacy_dispatch(jobs, database_path, now):
+    '''Dispatches the earliest job and puts it back with a later time, like
+    the old autocheck_dispatcher followed by _get_upstream_videos'''
+    earliest_job_index = min(range(0, len(jobs)), key=lambda index: jobs[index]['next_check_time'])
+    earliest_job = jobs[earliest_job_index]
+    with contextlib.closing(sqlite3.connect(database_path)) as connection:
+        with connection as cursor:
+            muted = cursor.execute('''SELECT muted FROM subscribed_channels WHERE yt_channel_id=?''', [earliest_job['channel_id']]).fetchone()[0]
+    del jobs[earliest_job_index]
+    if not muted:
+        jobs.append({'channel_id': earliest_job['channel_id'],
+                     'channel_name': earliest_job['channel_name'],
+                     'next_check_time': now + random.random()*86400})
+
+
+def scheduler_dispatch(scheduler, now):
+    channel_id = scheduler.pop()
+    scheduler.schedule(channel_id, now + random.random()*86400)
+
+
+def time_per_operation(function, operations):
+    start_time = time.perf_counter()
+    for i in range(operations):
+        function(i)
+    return (time.perf_counter() - start_time)/operations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--channels', type=int, default=50000,
+                        help='number of subscribed channels')
+    parser.add_argument('--dispatches', type=int, default=500,
+                        help='number of dispatches to time for each approach')
+    arguments = parser.parse_args()
+
+    random.seed(0)
+    now = time.time()
+    channel_ids = ['UC%022d' % i for i in range(arguments.channels)]
+    check_times = [now + random.random()*86400 for i in channel_ids]
+
+    jobs = [{'channel_id': channel_id, 'channel_name': channel_id,
+             'next_check_time': check_time}
+            for channel_id, check_time in zip(channel_ids, check_times)]
+    scheduler = subscriptions.AutocheckScheduler()
+    start_time = time.perf_counter()
+    for channel_id, check_time in zip(channel_ids, check_times):
+        scheduler.schedule(channel_id, check_time)
+    load_time = time.perf_counter() - start_time
+
+    print('%d channels, %d dispatches'
+          % (arguments.channels, arguments.dispatches))
+    print('%-26s %10.1f ms' % ('scheduler: load all', load_time*1e3))
+    with tempfile.TemporaryDirectory() as directory:
+        database_path = os.path.join(directory, 'subscriptions.sqlite')
+        make_database(database_path, channel_ids)
+        duration = time_per_operation(
+            lambda i: legacy_dispatch(jobs, database_path, now),
+            arguments.dispatches)
+        print('%-26s %10.1f us' % ('legacy: dispatch', duration*1e6))
+
+    duration = time_per_operation(lambda i: scheduler_dispatch(scheduler, now),
+                                  arguments.dispatches)
+    print('%-26s %10.1f us' % ('scheduler: dispatch', duration*1e6))
+    for name, function in (
+            ('scheduler: reschedule', lambda i: scheduler.schedule(
+                channel_ids[i], now + random.random()*86400)),
+            ('scheduler: cancel', lambda i: scheduler.cancel(channel_ids[i])),
+            ('scheduler: schedule new', lambda i: scheduler.schedule(
+                channel_ids[i], now + random.random()*86400))):
+        duration = time_per_operation(function, arguments.dispatches)
+        print('%-26s %10.1f us' % (name, duration*1e6))
+    assert len(scheduler) == arguments.channels
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+'''Benchmark of the per request overhead of site_dispatch
+
+Times working out the handler for a mix of request paths like those a watch
+page generates (mostly thumbnails and video chunks), first with the previous
+approach of an uncompiled regex and a suffix built up by string concatenation
+for every request, then with server.split_url and server.site_router. Also
+times a whole pass through server.site_dispatch to a handler that does
+nothing.
+
+Run from the top directory:
+    python3 -m benchmarks.dispatch --requests 200000
+'''
+from gevent import monkey
+monkey.patch_all()
+
+import server
+
+import argparse
+import re
+import time
+
+
+SAMPLE_PATHS = [
+    '/https://i.ytimg.com/vi/dQw4w9WgXcQ/hqdefault.jpg',
+    '/https://i.ytimg.com/vi/9bZkp7q19f0/mqdefault.jpg',
+    '/https://yt3.ggpht.com/ytc/AIdro_kX4=s88-c-k-c0x00ffffff-no-rj',
+    '/https://rr3---sn-4g5edndz.googlevideo.com/videoplayback',
+    '/https://rr5---sn-ab5l6nrz.googlevideo.com/videoplayback',
+    '/https://rr1---sn-q4fl6nsr.googlevideo.com/videoplayback',
+    '/https://www.youtube.com/watch',
+    '/https://sponsor.ajay.app/api/skipSegments',
+]
+
+
+legacy_handlers = {suffix: route[0]
+                   for suffix, route in server.site_router.routes.items()}
+
+
+def legacy_lookup(path):
+    match = re.match(r'(?:https?://)?([\w-]+(?:\.[\w-]+)+?)(/.*|$)', path)
+    host = match.group(1)
+    base_name = ''
+    for domain in reversed(host.split('.')):
+        if base_name == '':
+            base_name = domain
+        else:
+            base_name = domain + '.' + base_name
+        try:
+            return legacy_handlers[base_name]
+        except KeyError:
+            continue
+    return None
+
+
+def router_lookup(path):
+    host, path = server.split_url(path)
+    return server.site_router.lookup(host)
+
+
+def null_handler(env, start_response):
+    start_response('200 OK', ())
+    return
+    yield
+
+
+def dispatch(path):
+    env = {
+        'REMOTE_ADDR': '127.0.0.1',
+        'REQUEST_METHOD': 'GET',
+        'QUERY_STRING': '',
+        'PATH_INFO': '/https://bench.invalid' + path[path.index('/', 9):],
+    }
+    for content_part in server.site_dispatch(env, lambda *args: None):
+        pass
+
+
+def time_per_request(function, paths, requests):
+    start_time = time.perf_counter()
+    for i in range(requests):
+        function(paths[i % len(paths)])
+    return (time.perf_counter() - start_time)/requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200000,
+                        help='number of requests to time for each approach')
+    arguments = parser.parse_args()
+
+    for path in SAMPLE_PATHS:
+        assert legacy_lookup(path[1:]) is router_lookup(path[1:])[0]
+    server.site_router.register('bench.invalid', null_handler, 'page')
+
+    paths = [path[1:] for path in SAMPLE_PATHS]
+    print('%d requests' % arguments.requests)
+    for name, function, function_paths in (
+            ('legacy lookup', legacy_lookup, paths),
+            ('site_router', router_lookup, paths),
+            ('site_dispatch', dispatch, SAMPLE_PATHS)):
+        duration = time_per_request(function, function_paths,
+                                    arguments.requests)
+        print('%-15s %8.0f ns/request' % (name, duration*1e9))
+
+
+if __name__ == '__main__':
+    main()
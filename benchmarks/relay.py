@@ -0,0 +1,126 @@
+'''Benchmark of the relay loop that proxy_site uses to pass responses along
+
+Runs a local stand-in for googlevideo, a local proxy which relays its
+responses, and N clients downloading through the proxy at the same time. The
+proxy relays either with the old loop, which reads a new bytes object for every
+chunk, or with server.relay_response, which reads into a reused buffer.
+
+Run from the top directory:
+    python3 -m benchmarks.relay --streams 16 --size 32
+'''
+from gevent import monkey
+monkey.patch_all()
+
+import server
+
+from gevent.pywsgi import WSGIServer
+import argparse
+import gevent
+import time
+import tracemalloc
+import urllib3
+
+
+def upstream_app(payload):
+    def app(env, start_response):
+        start_response('200 OK', [
+            ('Content-Type', 'video/mp4'),
+            ('Content-Length', str(len(payload))),
+        ])
+        view = memoryview(payload)
+        for i in range(0, len(payload), server.VIDEO_CHUNK_SIZE):
+            yield view[i:i+server.VIDEO_CHUNK_SIZE]
+    return app
+
+
+def proxy_app(upstream_url, strategy, chunk_size, streams):
+    pool = urllib3.PoolManager(maxsize=streams)
+
+    def app(env, start_response):
+        response = pool.request('GET', upstream_url, preload_content=False,
+                                decode_content=False)
+        start_response('200 OK', [
+            ('Content-Length', response.headers['Content-Length']),
+        ])
+        if strategy == 'read':
+            while True:
+                content_part = response.read(chunk_size)
+                if not content_part:
+                    break
+                yield content_part
+        else:
+            buffer = server.relay_buffers.acquire(chunk_size)
+            try:
+                yield from server.relay_response(
+                    response, buffer, server.server_allows_zero_copy(env))
+            finally:
+                server.relay_buffers.release(buffer)
+        response.release_conn()
+    return app
+
+
+def download(pool, url):
+    response = pool.request('GET', url, preload_content=False)
+    received = 0
+    while True:
+        content_part = response.read(server.VIDEO_CHUNK_SIZE)
+        if not content_part:
+            break
+        received += len(content_part)
+    response.release_conn()
+    return received
+
+
+def run(upstream_url, strategy, chunk_size, streams, trace_memory):
+    proxy = WSGIServer(('127.0.0.1', 0),
+                       proxy_app(upstream_url, strategy, chunk_size, streams),
+                       log=None)
+    proxy.start()
+    url = 'http://127.0.0.1:%d/' % proxy.server_port
+    client_pool = urllib3.PoolManager(maxsize=streams)
+    if trace_memory:
+        tracemalloc.start()
+    start_time = time.monotonic()
+    tasks = [gevent.spawn(download, client_pool, url) for i in range(streams)]
+    gevent.joinall(tasks, raise_error=True)
+    duration = time.monotonic() - start_time
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    proxy.stop()
+    return sum(task.value for task in tasks), duration, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--streams', type=int, default=16,
+                        help='number of concurrent downloads')
+    parser.add_argument('--size', type=int, default=32,
+                        help='size of each download in MiB')
+    parser.add_argument('--chunk-size', type=int,
+                        default=server.VIDEO_CHUNK_SIZE)
+    arguments = parser.parse_args()
+
+    payload = bytes(arguments.size*1024*1024)
+    upstream = WSGIServer(('127.0.0.1', 0), upstream_app(payload), log=None)
+    upstream.start()
+    upstream_url = 'http://127.0.0.1:%d/' % upstream.server_port
+
+    print('%d streams of %d MiB, chunk size %d' % (
+        arguments.streams, arguments.size, arguments.chunk_size))
+    for strategy in ('read', 'relay_response'):
+        received, duration, peak = run(
+            upstream_url, strategy, arguments.chunk_size, arguments.streams,
+            trace_memory=False)
+        assert received == len(payload)*arguments.streams
+        received, traced_duration, peak = run(
+            upstream_url, strategy, arguments.chunk_size, arguments.streams,
+            trace_memory=True)
+        print('%-15s %8.1f MiB/s    peak traced memory: %7.1f MiB' % (
+            strategy, received/duration/1024/1024, peak/1024/1024))
+    upstream.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+'''Benchmark of the subscriptions database queries, before and after the
+indexes added in schema version 2
+
+Builds a synthetic database of the version 1 schema with N videos spread
+over a number of channels and tags, then prints the query plan and time of
+each of the main queries, before and after running the migrations. Page 500
+of the feed is read both by OFFSET, as before, and from a ctoken edge, as the
+subscriptions page now does.
+
+Run from the top directory:
+    python3 -m benchmarks.subscriptions_db --videos 1000000
+'''
+from youtube import subscriptions
+
+import argparse
+import contextlib
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+
+QUERIES = [
+    ('feed page', '''SELECT video_id, title, duration, time_published, is_time_published_exact, channel_name, yt_channel_id
+                     FROM videos
+                     INNER JOIN subscribed_channels on videos.sql_channel_id = subscribed_channels.id
+                     WHERE muted = 0
+                     ORDER BY time_noticed DESC, time_published DESC
+                     LIMIT ? OFFSET ?''', lambda: (540, 0)),
+    ('feed page 500, offset', '''SELECT video_id, title, duration, time_published, is_time_published_exact, channel_name, yt_channel_id
+                                 FROM videos
+                                 INNER JOIN subscribed_channels on videos.sql_channel_id = subscribed_channels.id
+                                 WHERE muted = 0
+                                 ORDER BY time_noticed DESC, time_published DESC
+                                 LIMIT ? OFFSET ?''', lambda: (540, 499*60)),
+    ('feed page 500, keyset', '''SELECT video_id, title, duration, time_published, is_time_published_exact, channel_name, yt_channel_id, time_noticed, videos.id
+                                 FROM videos
+                                 INNER JOIN subscribed_channels on videos.sql_channel_id = subscribed_channels.id
+                                 WHERE muted = 0
+                                 AND (time_noticed, time_published, videos.id) < (?, ?, ?)
+                                 ORDER BY time_noticed DESC, time_published DESC, videos.id DESC
+                                 LIMIT ?''', lambda: (PAGE_500_EDGE, PAGE_500_EDGE, 0, 61)),
+    ('tag feed page', '''SELECT video_id, title, duration, time_published, is_time_published_exact, channel_name, yt_channel_id
+                         FROM videos
+                         INNER JOIN subscribed_channels on videos.sql_channel_id = subscribed_channels.id
+                         INNER JOIN tag_associations on videos.sql_channel_id = tag_associations.sql_channel_id
+                         WHERE tag = ? AND muted = 0
+                         ORDER BY time_noticed DESC, time_published DESC
+                         LIMIT ? OFFSET ?''',
+     lambda: ('tag%d' % random.randrange(TAGS), 540, 0)),
+    ('channel latest 30', '''SELECT video_id
+                             FROM videos
+                             INNER JOIN subscribed_channels
+                                 ON videos.sql_channel_id = subscribed_channels.id
+                             WHERE yt_channel_id=?
+                             ORDER BY time_published DESC
+                             LIMIT 30''', lambda: (random_channel_id(),)),
+    ('tags of channel', '''SELECT tag
+                           FROM tag_associations
+                           WHERE sql_channel_id = (
+                               SELECT id FROM subscribed_channels WHERE yt_channel_id = ?
+                           )''', lambda: (random_channel_id(),)),
+    ('channels with tag', '''SELECT yt_channel_id, channel_name
+                             FROM subscribed_channels
+                             WHERE subscribed_channels.id IN (
+                                 SELECT tag_associations.sql_channel_id FROM tag_associations WHERE tag=?
+                             )''', lambda: ('tag%d' % random.randrange(TAGS),)),
+]
+
+CHANNELS = 5000
+TAGS = 50
+# time_noticed of about the 30000th newest video, set by make_database
+PAGE_500_EDGE = None
+
+
+def random_channel_id():
+    return 'UC%022d' % random.randrange(CHANNELS)
+
+
+def make_database(connection, videos):
+    global PAGE_500_EDGE
+    random.seed(0)
+    now = int(time.time())
+    PAGE_500_EDGE = now - int(10*365*86400*30000/videos)
+    with connection:
+        subscriptions._create_tables(connection)
+        connection.execute('INSERT INTO db_info (version) VALUES (1)')
+        connection.executemany(
+            '''INSERT INTO subscribed_channels (id, yt_channel_id, channel_name, muted)
+               VALUES (?, ?, ?, ?)''',
+            ((i + 1, 'UC%022d' % i, 'Channel %d' % i, int(i % 50 == 0))
+             for i in range(CHANNELS)))
+        connection.executemany(
+            '''INSERT INTO tag_associations (tag, sql_channel_id)
+               VALUES (?, ?)''',
+            (('tag%d' % (i % TAGS), i + 1) for i in range(CHANNELS)
+             if i % 3))
+
+        def video_rows():
+            for i in range(videos):
+                time_published = now - random.randrange(10*365*86400)
+                time_noticed = time_published + random.randrange(86400)
+                yield (random.randrange(CHANNELS) + 1, '%011d' % i,
+                       'Video %d' % i, '10:00', time_published,
+                       time_noticed, '')
+        connection.executemany(
+            '''INSERT INTO videos (sql_channel_id, video_id, title, duration, time_published, time_noticed, description)
+               VALUES (?, ?, ?, ?, ?, ?, ?)''', video_rows())
+
+
+def report(connection, repetitions):
+    for name, sql, make_parameters in QUERIES:
+        plan = connection.execute('EXPLAIN QUERY PLAN ' + sql,
+                                  make_parameters()).fetchall()
+        start_time = time.perf_counter()
+        for i in range(repetitions):
+            connection.execute(sql, make_parameters()).fetchall()
+        duration = (time.perf_counter() - start_time)/repetitions
+        print('%-22s %10.3f ms' % (name, duration*1e3))
+        for row in plan:
+            print('    ' + row[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--videos', type=int, default=1000000,
+                        help='number of videos in the database')
+    parser.add_argument('--repetitions', type=int, default=5,
+                        help='times to run each query')
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'subscriptions.sqlite')
+        with contextlib.closing(sqlite3.connect(path)) as connection:
+            start_time = time.perf_counter()
+            make_database(connection, arguments.videos)
+            print('Made database with %d videos in %.1f s'
+                  % (arguments.videos, time.perf_counter() - start_time))
+
+            print('\nBefore (schema version 1):')
+            report(connection, arguments.repetitions)
+
+            start_time = time.perf_counter()
+            subscriptions._migrate(connection)
+            print('\nMigrated to version %d in %.1f s'
+                  % (subscriptions.schema_version(),
+                     time.perf_counter() - start_time))
+
+            print('\nAfter:')
+            report(connection, arguments.repetitions)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,14 @@
 from gevent import monkey
 monkey.patch_all()
 import gevent.socket
+import gevent
+import gevent.event
 
 from youtube import yt_app
 from youtube import util
+from youtube import video_cache
+from youtube import image_cache
+from youtube import metrics
 
 # these are just so the files get run - they import yt_app and add routes to it
 from youtube import watch, search, playlist, channel, local_playlist, comments, subscriptions
@@ -15,10 +20,16 @@ from gevent.pywsgi import WSGIServer
 import urllib
 import urllib3
 import socket
+import flask
 import socks, sockshandler
 import subprocess
 import re
 import sys
+import cachetools
+import collections
+import functools
+import http.client
+import random
 import time
 
 
@@ -33,154 +44,1103 @@ def youtu_be(env, start_response):
 
 
 RANGE_RE = re.compile(r'bytes=(\d+-(?:\d+)?)')
-def parse_range(range_header, content_length):
-    # Range header can be like bytes=200-1000 or bytes=200-
-    # amount_received is the length of bytes from the range that have already
-    # been received
-    match = RANGE_RE.fullmatch(range_header.strip())
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+def requested_range(env, total_length):
+    '''Returns the inclusive (start, end) byte range the client asked for,
+    or None if it can't be satisfied from a file of total_length bytes'''
+    if 'HTTP_RANGE' not in env:
+        return 0, total_length - 1
+    match = RANGE_RE.fullmatch(env['HTTP_RANGE'].strip())
     if not match:
-        print('Unsupported range header format:', range_header)
         return None
     start, end = match.group(1).split('-')
     start_byte = int(start)
     if not end:
-        end_byte = start_byte + content_length - 1
+        end_byte = total_length - 1
     else:
-        end_byte = int(end)
+        end_byte = min(int(end), total_length - 1)
+    if start_byte > end_byte:
+        return None
     return start_byte, end_byte
 
 
-def proxy_site(env, start_response, video=False):
-    send_headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64)',
-        'Accept': '*/*',
-    }
-    current_range_start = 0
-    range_end = None
-    if 'HTTP_RANGE' in env:
-        send_headers['Range'] = env['HTTP_RANGE']
-
+def upstream_url(env, video=False):
     url = "https://" + env['SERVER_NAME'] + env['PATH_INFO']
     # remove /name portion
     if video and '/videoplayback/name/' in url:
         url = url[0:url.rfind('/name/')]
     if env['QUERY_STRING']:
         url += '?' + env['QUERY_STRING']
+    if video:
+        url = host_failures.alternate_url(url)
+    return url
 
-    try_num = 1
-    first_attempt = True
-    current_attempt_position = 0
-    while try_num <= 3:   # Try a given byte position three times
-        if not first_attempt:
-            print('(Try %d)' % try_num, 'Trying with', send_headers['Range'])
 
-        if video:
-            params = urllib.parse.parse_qs(env['QUERY_STRING'])
-            params_use_tor = int(params.get('use_tor', '0')[0])
-            use_tor = (settings.route_tor == 2) or params_use_tor
-            response, cleanup_func = util.fetch_url_response(url, send_headers,
-                                                             use_tor=use_tor,
-                                                             max_redirects=10)
+def video_use_tor(env):
+    params = urllib.parse.parse_qs(env['QUERY_STRING'])
+    params_use_tor = int(params.get('use_tor', '0')[0])
+    return (settings.route_tor == 2) or params_use_tor
+
+
+# a bit over 3 seconds of 360p video
+# we want each TCP packet to transmit in large multiples,
+# such as 65,536, so we shouldn't read in small chunks
+# such as 8192 lest that causes the socket library to limit the
+# TCP window size
+# Might need fine-tuning, since this gives us 4*65536
+# The tradeoff is that larger values (such as 6 seconds) only
+# allows video to buffer in those increments, meaning user must
+# wait until the entire chunk is downloaded before video starts
+# playing
+VIDEO_CHUNK_SIZE = 32*8192
+# Thumbnails and avatars are mostly well under this size, so a video sized
+# buffer for each of the dozens of images on a page would be wasted
+SITE_CHUNK_SIZE = 8*8192
+
+
+class BufferPool:
+    '''Keeps relay buffers around after a response is finished so that the
+    next response can reuse them instead of allocating new ones'''
+
+    def __init__(self, max_idle_per_size=16):
+        self.max_idle_per_size = max_idle_per_size
+        self.idle_buffers = {}
+
+    def acquire(self, size):
+        try:
+            return self.idle_buffers[size].pop()
+        except (KeyError, IndexError):
+            return bytearray(size)
+
+    def release(self, buffer):
+        idle = self.idle_buffers.setdefault(len(buffer), [])
+        if len(idle) < self.max_idle_per_size:
+            idle.append(buffer)
+
+
+relay_buffers = BufferPool()
+
+
+def response_readinto(response, buffer):
+    '''Reads the next part of the body into buffer and returns the number of
+    bytes read, 0 meaning the body has ended'''
+    # urllib3's readinto calls read() and then copies the new bytes object
+    # into the buffer. Since we ask for decode_content=False, read straight
+    # from the underlying http.client response instead, keeping urllib3's
+    # byte counters up to date. This bypasses urllib3's error wrapping, so
+    # errors come out as OSError or http.client.HTTPException, which
+    # relay_resumable catches along with urllib3's own.
+    if isinstance(response, urllib3.response.HTTPResponse):
+        fp = response._fp
+        if fp is None or not hasattr(fp, 'readinto'):
+            return response.readinto(buffer)
+        amount = fp.readinto(buffer)
+        response._fp_bytes_read += amount
+        if response.length_remaining is not None:
+            response.length_remaining -= amount
+        return amount
+    return response.readinto(buffer)
+
+
+def relay_response(response, buffer, zero_copy, limit=None):
+    '''Generator over the body of response, read into buffer piece by piece.
+
+    If zero_copy is True, the pieces are memoryview slices of buffer, which
+    get overwritten by the next piece, so they must be fully consumed before
+    the generator is resumed. Otherwise they are bytes copies.
+    limit is the maximum number of bytes to relay.'''
+    view = memoryview(buffer)
+    while limit is None or limit > 0:
+        if limit is not None and limit < len(view):
+            amount = response_readinto(response, view[0:limit])
+        else:
+            amount = response_readinto(response, view)
+        if not amount:
+            break
+        if limit is not None:
+            limit -= amount
+        if zero_copy:
+            yield view[0:amount]
+        else:
+            yield bytes(view[0:amount])
+
+
+def server_allows_zero_copy(env):
+    '''Whether the WSGI server writes out each piece of the response before
+    asking for the next one, so relay buffers can be handed to it directly'''
+    # gevent's WSGIServer sends each item with sendall before resuming the
+    # iterable. Other servers (uwsgi, gunicorn etc.) may queue items, so they
+    # get copies.
+    return env.get('SERVER_SOFTWARE', '').startswith('gevent/')
+
+
+UpstreamMetadata = collections.namedtuple(
+    'UpstreamMetadata', ('content_length', 'content_type', 'final_url'))
+
+
+class UpstreamMetadataCache:
+    '''Remembers the total size, content type and final redirect target of
+    upstream urls for a while. This lets us skip the redirects googlevideo
+    makes for each chunk request, work out open-ended ranges before
+    requesting them, and answer HEAD requests without going upstream.'''
+
+    def __init__(self, maxsize=4096, ttl=30*60):
+        self.cache = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, url):
+        return self.cache.get(url)
+
+    def invalidate(self, url):
+        self.cache.pop(url, None)
+
+    def record(self, url, response):
+        '''Learns the metadata of url from a response to a request for it'''
+        if response.status == 206:
+            match = CONTENT_RANGE_RE.fullmatch(
+                (response.getheader('Content-Range') or '').strip())
+            if not match or match.group(3) == '*':
+                return
+            content_length = int(match.group(3))
+        elif response.status == 200:
+            content_length = response.getheader('Content-Length')
+            if content_length is None:
+                return
+            content_length = int(content_length)
         else:
-            response, cleanup_func = util.fetch_url_response(url, send_headers)
+            return
+        self.cache[url] = UpstreamMetadata(
+            content_length,
+            response.getheader('Content-Type'),
+            getattr(response, 'final_url', None) or url,
+        )
+
+
+upstream_metadata = UpstreamMetadataCache()
+
+
+def fetch_known_target(url, fetch):
+    '''Calls fetch(target_url) with the final redirect target of url if it
+    is known, to skip the redirects, falling back to url itself if that
+    fails. Returns response, cleanup_func, target_url'''
+    metadata = upstream_metadata.get(url)
+    if metadata is not None and metadata.final_url != url:
+        response, cleanup_func = fetch(metadata.final_url)
+        if response.status < 400:
+            return response, cleanup_func, metadata.final_url
+        # the redirect target may have expired
+        cleanup_func(response)
+        upstream_metadata.invalidate(url)
+    response, cleanup_func = fetch(url)
+    upstream_metadata.record(url, response)
+    return response, cleanup_func, getattr(response, 'final_url', None) or url
+
+
+def proxy_head(env, start_response, video=False):
+    '''Answers a HEAD request using the metadata cache, or with a HEAD
+    request upstream rather than downloading the whole body'''
+    url = upstream_url(env, video)
+    extra_headers = [('Access-Control-Allow-Origin', '*')] if video else []
+    metadata = upstream_metadata.get(url)
+    if metadata is None:
+        response = util.head(url, use_tor=video_use_tor(env) if video else True)
+        upstream_metadata.record(url, response)
+        metadata = upstream_metadata.get(url)
+        if metadata is None:
+            response_headers = response.getheaders()
+            if isinstance(response_headers,
+                          urllib3._collections.HTTPHeaderDict):
+                response_headers = response_headers.items()
+            start_response(str(response.status) + ' ' + response.reason,
+                           list(response_headers) + extra_headers)
+            return []
+    response_headers = [
+        ('Content-Length', str(metadata.content_length)),
+        ('Accept-Ranges', 'bytes'),
+    ]
+    if metadata.content_type:
+        response_headers.append(('Content-Type', metadata.content_type))
+    start_response('200 OK', response_headers + extra_headers)
+    return []
+
+
+class HostFailureTracker:
+    '''Counts how often each googlevideo host closed the connection early
+    within the last WINDOW seconds, so that hosts which keep failing can be
+    avoided in favor of the alternatives YouTube lists in the url. Hosts
+    without failures in the window are forgotten, at most a WINDOW after.'''
+    WINDOW = 600
+    THRESHOLD = 3
+    HOST_RE = re.compile(r'(rr?\d+---)(sn-[\w-]+)(\.googlevideo\.com)')
+
+    def __init__(self):
+        self.failures = {}
+        self.next_prune_time = time.monotonic() + self.WINDOW
+
+    def record(self, host):
+        if not self.HOST_RE.fullmatch(host or ''):
+            # only googlevideo hosts have alternatives to switch to
+            return
+        now = time.monotonic()
+        self.failures.setdefault(host, collections.deque()).append(now)
+        if now >= self.next_prune_time:
+            self.next_prune_time = now + self.WINDOW
+            for known_host in list(self.failures):
+                self.count(known_host)
+
+    def count(self, host):
+        failure_times = self.failures.get(host)
+        if not failure_times:
+            return 0
+        cutoff = time.monotonic() - self.WINDOW
+        while failure_times and failure_times[0] < cutoff:
+            failure_times.popleft()
+        if not failure_times:
+            del self.failures[host]
+            return 0
+        return len(failure_times)
+
+    def is_failing(self, host):
+        return self.count(host) >= self.THRESHOLD
+
+    def alternate_url(self, url):
+        '''If the host of url keeps failing, returns the url with the host
+        swapped for one of the fallback nodes from the mn parameter'''
+        url_parts = urllib.parse.urlsplit(url)
+        host = url_parts.hostname or ''
+        if not self.is_failing(host):
+            return url
+        match = self.HOST_RE.fullmatch(host)
+        if not match:
+            return url
+        params = urllib.parse.parse_qs(url_parts.query)
+        for node in params.get('mn', [''])[0].split(','):
+            if not node.startswith('sn-'):
+                continue
+            candidate = match.group(1) + node + match.group(3)
+            if candidate != host and not self.is_failing(candidate):
+                print('Avoiding failing host', host, 'in favor of', candidate)
+                return url_parts._replace(netloc=candidate).geturl()
+        return url
+
+
+host_failures = HostFailureTracker()
+
+# Exponential backoff between attempts to resume a truncated response.
+# YouTube will return 503 Service Unavailable if you do a bunch of range
+# requests too quickly, but a fixed 1 second pause on every retry held up
+# playback for no reason when the connection was just cut once.
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8
+RETRY_MAX_TRIES = 3     # per byte position
+
 
-        response_headers = response.getheaders()
-        if isinstance(response_headers, urllib3._collections.HTTPHeaderDict):
-            response_headers = response_headers.items()
+def retry_delay(try_num):
+    '''Exponential backoff with jitter, so that streams cut off at the same
+    moment don't all reconnect at the same moment'''
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY*2**(try_num - 1))
+    return random.uniform(delay/2, delay)
+
+
+def print_truncation_warning(position, expected_end):
+    print('Warning: YouTube closed the connection before byte',
+          str(position) + '.', 'Expected', expected_end + 1, 'bytes.')
+
+
+def response_byte_range(response, content_length):
+    '''Returns the inclusive (start, end) range of the file contained in
+    response, or None if it isn't known'''
+    if response.status == 206:
+        match = CONTENT_RANGE_RE.fullmatch(
+            (response.getheader('Content-Range') or '').strip())
+        if not match:
+            return None
+        return int(match.group(1)), int(match.group(2))
+    if response.status == 200 and content_length:
+        return 0, content_length - 1
+    return None
+
+
+def relay_resumable(url, fetch_range, response, cleanup_func, start, end,
+                    buffer, zero_copy, on_part=None):
+    '''Generator relaying response, which contains the bytes start-end
+    (inclusive) of url.
+
+    Sometimes YouTube closes the connection before sending all of the
+    content. When that happens, fetch_range(url, position, end) is called to
+    get a new response with the missing content, starting at the exact byte
+    where the last one stopped, while the client connection stays open. See
+    https://github.com/user234683/youtube-local/issues/40
+
+    on_part(position, content_part) is called for each piece relayed.
+    Returns the position after the last byte relayed.'''
+    position = start
+    try_num = 0
+    last_failed_position = None
+    while True:
+        try:
+            for content_part in relay_response(response, buffer, zero_copy,
+                                               limit=end - position + 1):
+                if on_part is not None:
+                    on_part(position, content_part)
+                position += len(content_part)
+                yield content_part
+        except (OSError, http.client.HTTPException,
+                urllib3.exceptions.HTTPError) as e:
+            print('Error reading from YouTube:', repr(e))
+        finally:
+            cleanup_func(response)
+        if position > end:
+            return position
+
+        host_failures.record(urllib.parse.urlsplit(url).hostname)
+        print_truncation_warning(position, end)
+        if position == last_failed_position:
+            try_num += 1
+        else:
+            try_num = 1
+            last_failed_position = position
+        if try_num > RETRY_MAX_TRIES:
+            print('Error: YouTube closed the connection before',
+                  'providing all content. Retried %d times:' % RETRY_MAX_TRIES,
+                  url.split('?')[0])
+            return position
+
+        gevent.sleep(retry_delay(try_num))
+        url = host_failures.alternate_url(url)
+        print('(Try %d)' % try_num, 'Trying with',
+              'bytes=%d-%d' % (position, end))
+        response, cleanup_func = fetch_range(url, position, end)
+        if response.status != 206:
+            print('Error: YouTube returned "%d %s" while resuming %s' % (
+                response.status, response.reason, url.split('?')[0]))
+            cleanup_func(response)
+            return position
+
+
+def proxy_site(env, start_response, video=False, chunk_size=SITE_CHUNK_SIZE):
+    if env['REQUEST_METHOD'] == 'HEAD':
+        yield from proxy_head(env, start_response, video)
+        return
+
+    send_headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64)',
+        'Accept': '*/*',
+    }
+    url = upstream_url(env, video)
+    if 'HTTP_RANGE' in env:
+        send_headers['Range'] = env['HTTP_RANGE']
+        # Resolve open-ended ranges up front if the size is already known
+        metadata = upstream_metadata.get(url)
+        match = RANGE_RE.fullmatch(env['HTTP_RANGE'].strip())
+        if metadata is not None and match and match.group(1).endswith('-'):
+            send_headers['Range'] += str(metadata.content_length - 1)
+    if video:
+        use_tor = video_use_tor(env)
+
+    def fetch_range(url, start=None, end=None):
+        headers = dict(send_headers)
+        if start is not None:
+            headers['Range'] = 'bytes=%d-%d' % (start, end)
         if video:
-            response_headers = (list(response_headers)
-                                +[('Access-Control-Allow-Origin', '*')])
+            return util.fetch_url_response(url, headers, use_tor=use_tor,
+                                           max_redirects=10)
+        return util.fetch_url_response(url, headers)
+
+    response, cleanup_func, url = fetch_known_target(url, fetch_range)
+
+    response_headers = response.getheaders()
+    if isinstance(response_headers, urllib3._collections.HTTPHeaderDict):
+        response_headers = response_headers.items()
+    if video:
+        response_headers = (list(response_headers)
+                            +[('Access-Control-Allow-Origin', '*')])
+
+    start_response(str(response.status) + ' ' + response.reason,
+                   response_headers)
+
+    content_length = int(dict(response_headers).get('Content-Length', 0))
+    if response.status >= 400:
+        print('Error: YouTube returned "%d %s" while routing %s' % (
+            response.status, response.reason, url.split('?')[0]))
+
+    zero_copy = server_allows_zero_copy(env)
+    buffer = relay_buffers.acquire(chunk_size)
+    try:
+        byte_range = response_byte_range(response, content_length)
+        if byte_range is None:
+            try:
+                yield from relay_response(response, buffer, zero_copy)
+            finally:
+                cleanup_func(response)
+        else:
+            yield from relay_resumable(url, fetch_range, response,
+                                       cleanup_func, *byte_range, buffer,
+                                       zero_copy)
+    finally:
+        relay_buffers.release(buffer)
 
-        if first_attempt:
+
+# Images are content-addressed in the cache, so the ETag changes if the image
+# does. The cache checks upstream for the few images, such as avatars, that
+# can change under the same url once they are a day old, so browsers
+# shouldn't keep them longer than that either.
+IMAGE_CACHE_CONTROL = 'public, max-age=86400'
+
+
+# Concurrent requests for the same image, such as the thumbnails of a
+# trending search opened by several users, share one upstream fetch
+image_fetches = util.SingleFlight()
+
+
+def fetch_image(url, cache, revalidation_headers=None):
+    '''Returns response, content, image. image is the CachedImage if the
+    response was stored in cache, or was the cached image revalidated with
+    revalidation_headers, or None.'''
+    send_headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64)',
+        'Accept': '*/*',
+    }
+    send_headers.update(revalidation_headers or {})
+    response, cleanup_func = util.fetch_url_response(url, send_headers)
+    try:
+        content = response.read()
+    finally:
+        cleanup_func(response)
+
+    if response.status == 304 and cache is not None:
+        cache.mark_validated(url)
+        return response, content, cache.get(url)
+    if response.status >= 400:
+        print('Error: YouTube returned "%d %s" while routing %s' % (
+            response.status, response.reason, url.split('?')[0]))
+    content_length = response.getheader('Content-Length')
+    if (cache is None or response.status != 200
+            or (content_length is not None
+                and len(content) != int(content_length))):
+        return response, content, None
+
+    content = util.decode_content(
+        content, response.getheader('Content-Encoding', 'identity'))
+    image = cache.put(url, content,
+                      response.getheader('Content-Type', 'image/jpeg'),
+                      response.getheader('ETag'),
+                      response.getheader('Last-Modified'))
+    return response, content, image
+
+
+def proxy_image(env, start_response):
+    '''Serves thumbnails and avatars, from the image cache if it is enabled.
+    Images are fetched whole rather than streamed so that concurrent
+    requests for the same one can share the fetch.'''
+    if env['REQUEST_METHOD'] != 'GET' or 'HTTP_RANGE' in env:
+        yield from proxy_site(env, start_response)
+        return
+
+    cache = image_cache.image_cache
+    url = upstream_url(env)
+    image = cache.get(url) if cache is not None else None
+    revalidation_headers = None
+    if image is not None:
+        revalidation_headers = cache.revalidation_headers(url)
+    if revalidation_headers is not None:
+        try:
+            response, content, revalidated_image = image_fetches.do(
+                url, fetch_image, url, cache, revalidation_headers)
+        except Exception as e:
+            # serve the cached image rather than an error
+            print('Error revalidating image %s: %r' % (url.split('?')[0], e))
+        else:
+            if revalidated_image is not None:
+                image = revalidated_image
+    if image is None:
+        response, content, image = image_fetches.do(url, fetch_image, url,
+                                                    cache)
+        if image is None:
+            # not cacheable, pass the response along as it is
+            response_headers = response.getheaders()
+            if isinstance(response_headers,
+                          urllib3._collections.HTTPHeaderDict):
+                response_headers = response_headers.items()
             start_response(str(response.status) + ' ' + response.reason,
-                           response_headers)
+                           list(response_headers))
+            yield content
+            return
+
+    response_headers = [
+        ('ETag', image.etag),
+        ('Cache-Control', IMAGE_CACHE_CONTROL),
+    ]
+    if_none_match = env.get('HTTP_IF_NONE_MATCH', '')
+    if image.etag in (tag.strip() for tag in if_none_match.split(',')):
+        start_response('304 Not Modified', response_headers)
+        return
+    start_response('200 OK', response_headers + [
+        ('Content-Type', image.content_type),
+        ('Content-Length', str(len(image.content))),
+    ])
+    yield image.content
+
+
+# Size of the sub-range requests large video ranges are split into when
+# settings.parallel_video_connections is above 1. At most that many
+# sub-ranges are held in memory per client request.
+PARALLEL_SUBRANGE_SIZE = 1024*1024
+
+
+def fetch_video_range(url, use_tor, start, end):
+    send_headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64)',
+        'Accept': '*/*',
+        'Range': 'bytes=%d-%d' % (start, end),
+    }
+    return util.fetch_url_response(url, send_headers, use_tor=use_tor,
+                                   max_redirects=10)
+
+
+def fetch_subrange(url, use_tor, start, end, cache, key):
+    '''Fetches the bytes start-end (inclusive) of url into a new bytearray.
+    Returns None if YouTube returned an error or the response could not be
+    completed.'''
+    def fetch_range(url, start, end):
+        return fetch_video_range(url, use_tor, start, end)
 
-        content_length = int(dict(response_headers).get('Content-Length', 0))
-        if response.status >= 400:
+    response, cleanup_func = fetch_range(url, start, end)
+    if response.status != 206:
+        print('Error: YouTube returned "%d %s" while routing %s' % (
+            response.status, response.reason, url.split('?')[0]))
+        cleanup_func(response)
+        return None
+    content = bytearray()
+    buffer = relay_buffers.acquire(VIDEO_CHUNK_SIZE)
+    try:
+        for content_part in relay_resumable(url, fetch_range, response,
+                                            cleanup_func, start, end, buffer,
+                                            zero_copy=True):
+            content += content_part
+    finally:
+        relay_buffers.release(buffer)
+    if len(content) < end - start + 1:
+        return None
+    if cache is not None:
+        cache.write(key, start, content)
+    return content
+
+
+def fetch_subranges_parallel(url, use_tor, start, end, connections,
+                             cache=None, key=None, zero_copy=False):
+    '''Generator over the bytes start-end (inclusive) of url, in order.
+
+    The range is split into PARALLEL_SUBRANGE_SIZE sub-ranges, which are
+    fetched over up to `connections` connections at once, so that per
+    connection throttling by googlevideo doesn't limit the total speed.
+    Stops early if a sub-range could not be fetched.'''
+    subranges = collections.deque(
+        (sub_start, min(sub_start + PARALLEL_SUBRANGE_SIZE - 1, end))
+        for sub_start in range(start, end + 1, PARALLEL_SUBRANGE_SIZE))
+    in_flight = collections.deque()
+    try:
+        while subranges or in_flight:
+            while subranges and len(in_flight) < connections:
+                in_flight.append(gevent.spawn(
+                    fetch_subrange, url, use_tor, *subranges.popleft(),
+                    cache, key))
+            task = in_flight.popleft()
+            task.join()
+            if task.exception is not None:
+                print('Error fetching video sub-range:', repr(task.exception))
+                return
+            if task.value is None:
+                return
+            if zero_copy:
+                yield memoryview(task.value)
+            else:
+                yield bytes(task.value)
+    finally:
+        gevent.killall(list(in_flight))
+        if cache is not None:
+            cache.save(key)
+
+
+def proxy_video_ranges(env, start_response, key, start, end,
+                       chunk_size=VIDEO_CHUNK_SIZE):
+    '''Serves the byte range start-end (inclusive) of a googlevideo file.
+
+    If the video cache is enabled, the parts that were downloaded before are
+    read from it and only the missing holes are fetched from upstream. Large
+    holes are fetched over several connections at once if
+    settings.parallel_video_connections is above 1.'''
+    cache = video_cache.video_cache
+    url = upstream_url(env, video=True)
+    use_tor = video_use_tor(env)
+    total_length = key[2]
+
+    params = urllib.parse.parse_qs(env['QUERY_STRING'])
+    mime_type = params.get('mime', ['application/octet-stream'])[0]
+    response_headers = [
+        ('Content-Type', mime_type),
+        ('Content-Length', str(end - start + 1)),
+        ('Accept-Ranges', 'bytes'),
+        ('Access-Control-Allow-Origin', '*'),
+    ]
+    if 'HTTP_RANGE' in env:
+        status = '206 Partial Content'
+        response_headers.append(
+            ('Content-Range', 'bytes %d-%d/%d' % (start, end, total_length)))
+    else:
+        status = '200 OK'
+
+    zero_copy = server_allows_zero_copy(env)
+    buffer = relay_buffers.acquire(chunk_size)
+    try:
+        yield from _proxy_video_range_parts(
+            start_response, cache, key, url, use_tor, start, end,
+            status, response_headers, buffer, zero_copy)
+    finally:
+        relay_buffers.release(buffer)
+
+
+def _proxy_video_range_parts(start_response, cache, key, url, use_tor,
+                             start, end, status, response_headers, buffer,
+                             zero_copy):
+    if cache is None:
+        entry, parts = None, [(False, start, end)]
+    else:
+        entry, parts = cache.plan(key, start, end)
+    connections = settings.parallel_video_connections
+    headers_sent = False
+
+    def fetch_range(url, start, end):
+        return fetch_video_range(url, use_tor, start, end)
+
+    def on_part(position, content_part):
+        if cache is not None:
+            cache.write(key, position, content_part)
+
+    for is_cached, part_start, part_end in parts:
+        if is_cached:
+            if not headers_sent:
+                start_response(status, response_headers)
+                headers_sent = True
+            if (yield from cache.read(entry, part_start, part_end)):
+                continue
+            # evicted since it was planned, so fetch it from upstream
+
+        # With parallel connections, still fetch the first sub-range on its
+        # own so upstream errors can be passed along before anything is sent
+        if (connections > 1
+                and part_end - part_start + 1 > 2*PARALLEL_SUBRANGE_SIZE):
+            single_end = part_start + PARALLEL_SUBRANGE_SIZE - 1
+        else:
+            single_end = part_end
+
+        response, cleanup_func, url = fetch_known_target(
+            url,
+            lambda target: fetch_range(target, part_start, single_end))
+        if not (response.status == 206
+                or (response.status == 200 and part_start == 0)):
             print('Error: YouTube returned "%d %s" while routing %s' % (
                 response.status, response.reason, url.split('?')[0]))
+            try:
+                if headers_sent:
+                    return
+                # Nothing sent yet, so pass the response along as it is
+                upstream_headers = response.getheaders()
+                if isinstance(upstream_headers,
+                              urllib3._collections.HTTPHeaderDict):
+                    upstream_headers = upstream_headers.items()
+                start_response(
+                    str(response.status) + ' ' + response.reason,
+                    list(upstream_headers)
+                    + [('Access-Control-Allow-Origin', '*')])
+                yield from relay_response(response, buffer, zero_copy)
+                return
+            finally:
+                cleanup_func(response)
 
-        total_received = 0
-        retry = False
-        while True:
-            # a bit over 3 seconds of 360p video
-            # we want each TCP packet to transmit in large multiples,
-            # such as 65,536, so we shouldn't read in small chunks
-            # such as 8192 lest that causes the socket library to limit the
-            # TCP window size
-            # Might need fine-tuning, since this gives us 4*65536
-            # The tradeoff is that larger values (such as 6 seconds) only
-            # allows video to buffer in those increments, meaning user must
-            # wait until the entire chunk is downloaded before video starts
-            # playing
-            content_part = response.read(32*8192)
-            total_received += len(content_part)
-            if not content_part:
-                # Sometimes YouTube closes the connection before sending all of
-                # the content. Retry with a range request for the missing
-                # content. See
-                # https://github.com/user234683/youtube-local/issues/40
-                if total_received < content_length:
-                    if 'Range' in send_headers:
-                        int_range = parse_range(send_headers['Range'],
-                                                content_length)
-                        if not int_range: # give up b/c unrecognized range
-                            break
-                        start, end = int_range
-                    else:
-                        start, end = 0, (content_length - 1)
-
-                    fail_byte = start + total_received
-                    send_headers['Range'] = 'bytes=%d-%d' % (fail_byte, end)
-                    print(
-                        'Warning: YouTube closed the connection before byte',
-                        str(fail_byte) + '.', 'Expected', start+content_length,
-                        'bytes.'
-                    )
-
-                    retry = True
-                    first_attempt = False
-                    if fail_byte == current_attempt_position:
-                        try_num += 1
-                    else:
-                        try_num = 1
-                        current_attempt_position = fail_byte
-                break
-            yield content_part
-        cleanup_func(response)
-        if retry:
-            # YouTube will return 503 Service Unavailable if you do a bunch
-            # of range requests too quickly.
-            time.sleep(1)
-            continue
+        if not headers_sent:
+            start_response(status, response_headers)
+            headers_sent = True
+
+        try:
+            position = yield from relay_resumable(
+                url, fetch_range, response, cleanup_func, part_start,
+                single_end, buffer, zero_copy, on_part)
+        finally:
+            if cache is not None:
+                cache.save(key)
+        if position <= single_end:
+            return
+
+        if single_end < part_end:
+            for content_part in fetch_subranges_parallel(
+                    url, use_tor, single_end + 1, part_end, connections,
+                    cache, key, zero_copy):
+                position += len(content_part)
+                yield content_part
+            if position <= part_end:
+                return
+
+
+class BandwidthStream:
+    '''Token bucket for one video stream, refilled at the rate the
+    scheduler currently gives the stream'''
+
+    def __init__(self, scheduler, client, weight):
+        self.scheduler = scheduler
+        self.client = client
+        self.weight = weight
+        self.tokens = 0
+        self.last_time = time.monotonic()
+        # counted in the shares until then; see BandwidthScheduler.IDLE_TIME
+        self.active_until = self.last_time + scheduler.IDLE_TIME
+
+    def throttle(self, amount):
+        '''Waits until amount more bytes may be sent'''
+        now = time.monotonic()
+        rate = self.scheduler.stream_rate(self, now)
+        if rate is None:
+            self.tokens = 0
         else:
-            break
-    else: # no break
-        print('Error: YouTube closed the connection before',
-              'providing all content. Retried three times:', url.split('?')[0])
+            self.tokens = min(self.tokens + (now - self.last_time)*rate,
+                              rate*self.scheduler.BURST_SECONDS)
+        self.last_time = now
+        if rate is None:
+            self.active_until = now + self.scheduler.IDLE_TIME
+            return
+        self.tokens -= amount
+        wait_time = max(-self.tokens/rate, 0)
+        self.active_until = now + wait_time + self.scheduler.IDLE_TIME
+        if wait_time:
+            gevent.sleep(wait_time)
+
+    def close(self):
+        self.scheduler.streams.discard(self)
+
+
+class BandwidthScheduler:
+    '''Shares the global and per client video bandwidth limits fairly
+    between the streams being relayed.
+
+    Each stream gets a part of both limits in proportion to its weight among
+    the streams sending at the time, so one client downloading a large file
+    can't take the bandwidth other clients need. Downloads (recognised by
+    the /videoplayback/name/ suffix) get a lower weight than playback.
+    Rates are in bytes per second, 0 meaning unlimited.
+
+    A stream that hasn't sent anything for IDLE_TIME, such as playback
+    whose buffer in the browser is full, is left out of the shares until it
+    sends again, so the streams that are sending get its part.'''
+
+    PLAYBACK_WEIGHT = 4
+    DOWNLOAD_WEIGHT = 1
+    # how much unused allowance a stream can save up and send at once
+    BURST_SECONDS = 0.5
+    IDLE_TIME = 1
+
+    def __init__(self, global_rate=0, client_rate=0):
+        self.global_rate = global_rate
+        self.client_rate = client_rate
+        self.streams = set()
+
+    def is_limited(self):
+        return bool(self.global_rate or self.client_rate)
+
+    def open_stream(self, client, download=False):
+        weight = self.DOWNLOAD_WEIGHT if download else self.PLAYBACK_WEIGHT
+        stream = BandwidthStream(self, client, weight)
+        self.streams.add(stream)
+        return stream
+
+    def stream_rate(self, stream, now=None):
+        '''The rate stream may currently send at, or None if unlimited'''
+        if now is None:
+            now = time.monotonic()
+        sending = [other for other in self.streams
+                   if other is stream or other.active_until > now]
+        rate = None
+        if self.global_rate:
+            total_weight = sum(other.weight for other in sending)
+            rate = self.global_rate*stream.weight/total_weight
+        if self.client_rate:
+            client_weight = sum(other.weight for other in sending
+                                if other.client == stream.client)
+            client_share = self.client_rate*stream.weight/client_weight
+            if rate is None or client_share < rate:
+                rate = client_share
+        return rate
+
+    def set_rates(self, global_rate, client_rate):
+        self.global_rate = global_rate
+        self.client_rate = client_rate
+
+
+video_bandwidth = BandwidthScheduler(
+    settings.video_bandwidth_limit*1024, settings.client_bandwidth_limit*1024)
+
+
+def _update_bandwidth_limits(old_value, new_value):
+    video_bandwidth.set_rates(settings.video_bandwidth_limit*1024,
+                              settings.client_bandwidth_limit*1024)
+
+
+settings.add_setting_changed_hook('video_bandwidth_limit',
+                                  _update_bandwidth_limits)
+settings.add_setting_changed_hook('client_bandwidth_limit',
+                                  _update_bandwidth_limits)
 
 
 def proxy_video(env, start_response):
-    yield from proxy_site(env, start_response, video=True)
+    if env['REQUEST_METHOD'] == 'HEAD':
+        yield from proxy_head(env, start_response, video=True)
+        return
+    if not video_bandwidth.is_limited():
+        yield from _proxy_video(env, start_response)
+        return
+    stream = video_bandwidth.open_stream(
+        env['REMOTE_ADDR'], download='/videoplayback/name/' in env['PATH_INFO'])
+    try:
+        for content_part in _proxy_video(env, start_response):
+            stream.throttle(len(content_part))
+            yield content_part
+    finally:
+        stream.close()
+
 
+def _proxy_video(env, start_response):
+    if (video_cache.video_cache is not None
+            or settings.parallel_video_connections > 1):
+        metadata = upstream_metadata.get(upstream_url(env, video=True))
+        key = video_cache.cache_key(
+            env['QUERY_STRING'],
+            metadata.content_length if metadata is not None else None)
+        if key is not None:
+            byte_range = requested_range(env, key[2])
+            if byte_range is not None:
+                yield from proxy_video_ranges(env, start_response, key,
+                                              *byte_range)
+                return
+    yield from proxy_site(env, start_response, video=True,
+                          chunk_size=VIDEO_CHUNK_SIZE)
 
-site_handlers = {
-    'youtube.com': yt_app,
-    'youtube-nocookie.com': yt_app,
-    'youtu.be': youtu_be,
-    'ytimg.com': proxy_site,
-    'yt3.ggpht.com': proxy_site,
-    'lh3.googleusercontent.com': proxy_site,
-    'sponsor.ajay.app': proxy_site,
-    'googlevideo.com': proxy_video,
-}
+
+class ConcurrencyClass:
+    '''Limits how many requests of one class are handled at once.
+
+    Requests beyond the limit wait in a first come first served queue. When
+    the queue is full, or a request has waited longer than queue_timeout,
+    it is turned away with 503 so it doesn't hold up the other classes.
+    A limit of 0 means unlimited.'''
+
+    def __init__(self, name, limit, max_queue, queue_timeout):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.rejected = 0
+        # an Event for each waiting request, set when it is given a slot
+        self.waiters = collections.deque()
+
+    @property
+    def waiting(self):
+        return len(self.waiters)
+
+    def _has_room(self):
+        return not self.limit or self.active < self.limit
+
+    def acquire(self):
+        '''Returns whether the request may go ahead'''
+        if self._has_room() and not self.waiters:
+            self.active += 1
+            return True
+        if len(self.waiters) >= self.max_queue:
+            self.rejected += 1
+            return False
+        given_slot = gevent.event.Event()
+        self.waiters.append(given_slot)
+        # the slot is counted in active by whoever sets given_slot
+        try:
+            given_slot.wait(timeout=self.queue_timeout)
+        except BaseException:
+            if given_slot.is_set():
+                self.release()
+            else:
+                self.waiters.remove(given_slot)
+            raise
+        if given_slot.is_set():
+            return True
+        self.waiters.remove(given_slot)
+        self.rejected += 1
+        return False
+
+    def release(self):
+        self.active -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        while self.waiters and self._has_room():
+            self.active += 1
+            self.waiters.popleft().set()
+
+    def set_limit(self, limit):
+        '''Changes the limit, letting in as many waiting requests as it now
+        allows. When lowered, requests in flight finish as usual and new ones
+        wait until active is under the new limit.'''
+        self.limit = limit
+        self._wake_waiters()
+
+
+# In order of priority. Pages wait for a slot for as long as it takes, images
+# for a while, and video is refused quickly so that a burst of streams can't
+# starve everything else.
+concurrency_classes = collections.OrderedDict([
+    ('page', ConcurrencyClass('page', settings.page_concurrency_limit,
+                              max_queue=1000, queue_timeout=None)),
+    ('image', ConcurrencyClass('image', settings.image_concurrency_limit,
+                               max_queue=500, queue_timeout=30)),
+    ('video', ConcurrencyClass('video', settings.video_concurrency_limit,
+                               max_queue=20, queue_timeout=5)),
+])
+
+
+def _make_limit_hook(class_name):
+    def hook(old_value, new_value):
+        concurrency_classes[class_name].set_limit(new_value)
+    return hook
+
+
+for class_name in concurrency_classes:
+    settings.add_setting_changed_hook(class_name + '_concurrency_limit',
+                                      _make_limit_hook(class_name))
+
+
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+
+def local_only(view):
+    '''Makes view, which shows the internals of the server, answer 403 to
+    foreign addresses unless settings.allow_foreign_status_pages is set'''
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if (flask.request.remote_addr not in LOCAL_ADDRESSES
+                and not settings.allow_foreign_status_pages):
+            flask.abort(403)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@local_only
+def concurrency_status():
+    lines = ['class\tactive\tlimit\twaiting\trejected']
+    for concurrency_class in concurrency_classes.values():
+        lines.append('%s\t%d\t%s\t%d\t%d' % (
+            concurrency_class.name, concurrency_class.active,
+            concurrency_class.limit or 'none', concurrency_class.waiting,
+            concurrency_class.rejected))
+    return flask.Response('\n'.join(lines) + '\n', mimetype='text/plain')
+
+
+yt_app.add_url_rule('/concurrency_status', 'concurrency_status',
+                    concurrency_status)
+
+
+@local_only
+def connection_pool_status():
+    lines = ['pool\thost\tsize\tidle\topened\trequests']
+    for stats in util.connection_pool_stats():
+        lines.append('%s\t%s\t%d\t%d\t%d\t%d' % stats)
+    return flask.Response('\n'.join(lines) + '\n', mimetype='text/plain')
+
+
+yt_app.add_url_rule('/connection_pool_status', 'connection_pool_status',
+                    connection_pool_status)
+
+
+requests_active = metrics.Gauge(
+    'yt_requests_active', 'Requests being handled, by concurrency class',
+    ('class',))
+requests_waiting = metrics.Gauge(
+    'yt_requests_waiting',
+    'Requests waiting for their concurrency class to have room', ('class',))
+
+
+def collect_concurrency_metrics():
+    for concurrency_class in concurrency_classes.values():
+        requests_active.set(concurrency_class.active, concurrency_class.name)
+        requests_waiting.set(concurrency_class.waiting,
+                             concurrency_class.name)
+
+
+metrics.add_collector(collect_concurrency_metrics)
+
+
+@local_only
+def metrics_page():
+    return flask.Response(metrics.render(),
+                          mimetype='text/plain; version=0.0.4')
+
+
+yt_app.add_url_rule('/metrics', 'metrics', metrics_page)
+
+
+class SiteRouter:
+    '''Maps hosts to the handler registered for the longest matching domain
+    suffix, so that i.ytimg.com is handled by the handler for ytimg.com.
+
+    The result for each host is cached, since the same few hosts are
+    requested over and over.'''
+
+    def __init__(self, cache_size=1024):
+        self.routes = {}    # suffix -> (handler, ConcurrencyClass)
+        self.host_cache = cachetools.LRUCache(maxsize=cache_size)
+
+    def register(self, suffix, handler, concurrency_class):
+        '''Handle requests to suffix and its subdomains with handler,
+        limited by the named class in concurrency_classes'''
+        self.routes[suffix] = (handler, concurrency_classes[concurrency_class])
+        self.host_cache.clear()
+
+    def lookup(self, host):
+        '''Returns (handler, ConcurrencyClass), or None if no handler is
+        registered for host'''
+        try:
+            return self.host_cache[host]
+        except KeyError:
+            pass
+        name = host
+        while True:
+            route = self.routes.get(name)
+            if route is not None:
+                break
+            dot = name.find('.')
+            if dot == -1:
+                break
+            name = name[dot+1:]
+        self.host_cache[host] = route
+        return route
+
+
+site_router = SiteRouter()
+site_router.register('youtube.com', yt_app, 'page')
+site_router.register('youtube-nocookie.com', yt_app, 'page')
+site_router.register('youtu.be', youtu_be, 'page')
+site_router.register('ytimg.com', proxy_image, 'image')
+site_router.register('yt3.ggpht.com', proxy_image, 'image')
+site_router.register('lh3.googleusercontent.com', proxy_image, 'image')
+site_router.register('sponsor.ajay.app', proxy_site, 'image')
+site_router.register('googlevideo.com', proxy_video, 'video')
+
+
+# XXX: Is this regex safe from REDOS?
+# python STILL doesn't have a proper regular expression engine like grep uses built in...
+URL_RE = re.compile(r'(?:https?://)?([\w-]+(?:\.[\w-]+)+?)(/.*|$)')
 
 
 def split_url(url):
     ''' Split https://sub.example.com/foo/bar.html into ('sub.example.com', '/foo/bar.html')'''
-    # XXX: Is this regex safe from REDOS?
-    # python STILL doesn't have a proper regular expression engine like grep uses built in...
-    match = re.match(r'(?:https?://)?([\w-]+(?:\.[\w-]+)+?)(/.*|$)', url)
+    match = URL_RE.match(url)
     if match is None:
         raise ValueError('Invalid or unsupported url: ' + url)
 
@@ -208,7 +1168,7 @@ def site_dispatch(env, start_response):
         path = env['PATH_INFO']
 
         if (method == "POST"
-                and client_address not in ('127.0.0.1', '::1')
+                and client_address not in LOCAL_ADDRESSES
                 and not settings.allow_foreign_post_requests):
             yield error_code('403 Forbidden', start_response)
             return
@@ -224,23 +1184,27 @@ def site_dispatch(env, start_response):
             yield error_code('404 Not Found', start_response)
             return
 
-        base_name = ''
-        for domain in reversed(env['SERVER_NAME'].split('.')):
-            if base_name == '':
-                base_name = domain
-            else:
-                base_name = domain + '.' + base_name
-
-            try:
-                handler = site_handlers[base_name]
-            except KeyError:
-                continue
-            else:
-                yield from handler(env, start_response)
-                break
-        else:   # did not break
+        route = site_router.lookup(env['SERVER_NAME'])
+        if route is None:
             yield error_code('404 Not Found', start_response)
             return
+        handler, concurrency_class = route
+        if not concurrency_class.acquire():
+            start_response('503 Service Unavailable', [('Retry-After', '5')])
+            yield b'503 Service Unavailable'
+            return
+        if concurrency_class.name == 'page':
+            # for the greenlets the page spawns, which have no flask
+            # request context to tell
+            util.set_refresh_requested(env.get('HTTP_CACHE_CONTROL'))
+            if settings.page_time_budget:
+                util.set_deadline(settings.page_time_budget)
+        try:
+            yield from handler(env, start_response)
+        finally:
+            util.clear_deadline()
+            util.clear_refresh_requested()
+            concurrency_class.release()
     except Exception:
         start_response('500 Internal Server Error', ())
         yield b'500 Internal Server Error'
@@ -279,6 +1243,8 @@ if __name__ == '__main__':
 
     print('Starting httpserver at http://%s:%s/' %
           (ip_server, settings.port_number))
+    if settings.warm_up_connections:
+        util.warm_up_connections()
     server.serve_forever()
 
 # for uwsgi, gunicorn, etc.
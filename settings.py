@@ -37,6 +37,17 @@ SETTINGS_INFO = collections.OrderedDict([
         'category': 'network',
     }),
 
+    ('tor_circuits', {
+        'label': 'Tor circuits',
+        'type': int,
+        'default': 1,
+        'comment': '''Number of Tor circuits to spread requests over. Above 1, a circuit whose exit node gets
+blocked by YouTube is replaced on its own, instead of changing the identity of every circuit.
+Videos, and the pages their urls come from, always use the first circuit, since video urls
+only work from the IP address that requested them''',
+        'category': 'network',
+    }),
+
     ('tor_port', {
         'type': int,
         'default': 9050,
@@ -76,6 +87,16 @@ For security reasons, enabling this is not recommended.''',
         'category': 'network',
     }),
 
+    ('allow_foreign_status_pages', {
+        'type': bool,
+        'default': False,
+        'comment': '''Lets foreign addresses see /metrics, /concurrency_status and /connection_pool_status,
+which show the urls and hosts requested and the state of the connection pools.
+For security reasons, enabling this is not recommended.''',
+        'hidden': True,
+        'category': 'network',
+    }),
+
     ('subtitles_mode', {
         'type': int,
         'default': 0,
@@ -242,6 +263,164 @@ Archive: https://archive.ph/OZQbN''',
         'category': 'network',
     }),
 
+    ('image_cache_size', {
+        'label': 'Image cache size (MB)',
+        'type': int,
+        'default': 0,
+        'comment': '''Maximum disk space used to keep thumbnails and avatars when routing images,
+so they don't need to be downloaded again. 0 disables the cache''',
+        'category': 'network',
+    }),
+
+    ('video_cache_size', {
+        'label': 'Video cache size (MB)',
+        'type': int,
+        'default': 0,
+        'comment': '''Maximum disk space used to keep video data that has already been downloaded,
+so that seeking back or rewatching doesn't download it again. 0 disables the cache''',
+        'category': 'network',
+    }),
+
+    ('parallel_video_connections', {
+        'label': 'Parallel video connections',
+        'type': int,
+        'default': 1,
+        'comment': '''Number of connections to use at once when downloading a large part of a video.
+Above 1, the part is split into smaller range requests which are downloaded at the same time,
+which helps when YouTube throttles the speed of each connection''',
+        'options': [
+            (1, '1 (Off)'),
+            (2, '2'),
+            (4, '4'),
+            (8, '8'),
+        ],
+        'category': 'network',
+    }),
+
+    ('response_cache_size', {
+        'label': 'Response cache size (MB)',
+        'type': int,
+        'default': 0,
+        'comment': '''Memory used to keep search results, channel tabs, playlists and comments from YouTube
+for a few minutes, so opening them again doesn't need another request. Reloading a page always
+fetches it again. 0 disables the cache''',
+        'category': 'network',
+    }),
+
+    ('response_disk_cache_size', {
+        'label': 'Response disk cache size (MB)',
+        'type': int,
+        'default': 0,
+        'comment': '''Disk space used to also keep cached responses on disk, so they are kept across restarts.
+Only used when the response cache is enabled. 0 keeps them in memory only''',
+        'category': 'network',
+    }),
+
+    ('connection_pool_size', {
+        'label': 'Connections kept open per host',
+        'type': int,
+        'default': 10,
+        'comment': '''Number of connections to each YouTube server to keep open for reuse, so that
+requests made at the same time don't need new connections afterwards''',
+        'category': 'network',
+    }),
+
+    ('connection_pool_host_sizes', {
+        'type': str,
+        'default': '',
+        'comment': '''Connections kept open for particular hosts and their subdomains, instead of the number above.
+For example: www.youtube.com=16, ytimg.com=24''',
+        'hidden': True,
+        'category': 'network',
+    }),
+
+    ('warm_up_connections', {
+        'label': 'Open connections on startup',
+        'type': bool,
+        'default': False,
+        'comment': '''Connect to the main YouTube servers when starting, so the first pages load faster''',
+        'category': 'network',
+    }),
+
+    ('page_time_budget', {
+        'label': 'Page time budget',
+        'type': int,
+        'default': 30,
+        'comment': '''Seconds a page may take to load from YouTube. Requests to YouTube for the page time out when
+this runs out, and optional parts such as comments are left out when it is nearly used up, instead of
+the page taking several timeouts to load. 0 for no limit''',
+        'category': 'network',
+    }),
+
+    ('dns_cache', {
+        'label': 'Cache DNS lookups',
+        'type': bool,
+        'default': True,
+        'comment': '''Remember the addresses of YouTube servers for a few minutes, so new connections to them
+don't need to wait for DNS. Not used when routing through Tor''',
+        'category': 'network',
+    }),
+
+    ('async_dns', {
+        'label': 'Use c-ares for DNS',
+        'type': bool,
+        'default': False,
+        'comment': '''Look up addresses with the c-ares resolver built into gevent, instead of the system resolver
+run in a thread pool''',
+        'category': 'network',
+    }),
+
+    ('use_http2', {
+        'label': 'Use HTTP/2 for YouTube pages',
+        'type': bool,
+        'default': False,
+        'comment': '''Send requests for YouTube pages and API calls over one HTTP/2 connection per host,
+instead of several HTTP/1.1 connections. Needs the h2 Python package. Not used when routing through Tor''',
+        'category': 'network',
+    }),
+
+    ('video_bandwidth_limit', {
+        'label': 'Video bandwidth limit (KB/s)',
+        'type': int,
+        'default': 0,
+        'comment': '''Maximum total speed at which videos are routed through YT Local, shared fairly between
+the videos being watched, with downloads getting a smaller share than playback. 0 for no limit''',
+        'category': 'network',
+    }),
+
+    ('client_bandwidth_limit', {
+        'label': 'Per client video bandwidth limit (KB/s)',
+        'type': int,
+        'default': 0,
+        'comment': '''Maximum speed at which videos are routed to any one client address. 0 for no limit''',
+        'category': 'network',
+    }),
+
+    ('page_concurrency_limit', {
+        'type': int,
+        'default': 0,
+        'comment': '''Maximum number of page requests handled at once, further requests wait. 0 for no limit''',
+        'hidden': True,
+        'category': 'network',
+    }),
+
+    ('image_concurrency_limit', {
+        'type': int,
+        'default': 0,
+        'comment': '''Maximum number of image requests handled at once. 0 for no limit''',
+        'hidden': True,
+        'category': 'network',
+    }),
+
+    ('video_concurrency_limit', {
+        'type': int,
+        'default': 0,
+        'comment': '''Maximum number of video streams relayed at once. Further streams wait briefly,
+then get a 503 error, so they can't crowd out page loads. 0 for no limit''',
+        'hidden': True,
+        'category': 'network',
+    }),
+
     ('use_comments_js', {
         'label': 'Enable comments.js',
         'type': bool,
@@ -9,6 +9,8 @@ import socket
 def disable_network_calls(monkeypatch):
     def stunted_get(*args, **kwargs):
         raise RuntimeError('Network access not allowed during testing!')
-    monkeypatch.setattr(urllib.request, 'Request', stunted_get)
+    # Request objects are still needed to work with http.cookiejar, so block
+    # opening them instead
+    monkeypatch.setattr(urllib.request.OpenerDirector, 'open', stunted_get)
     monkeypatch.setattr(urllib3.PoolManager, 'request', stunted_get)
     monkeypatch.setattr(socket, 'socket', stunted_get)
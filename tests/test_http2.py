@@ -0,0 +1,261 @@
+import pytest
+h2 = pytest.importorskip('h2')
+import h2.config
+import h2.connection
+import h2.events
+
+from youtube import http2, util
+import settings
+import gevent
+import gevent.event
+import gevent.queue
+import io
+import socket
+import urllib.parse
+import urllib3
+
+
+class MemorySocket:
+    '''One end of an in-memory connection'''
+    def __init__(self, incoming, outgoing):
+        self.incoming = incoming
+        self.outgoing = outgoing
+
+    def sendall(self, data):
+        if data:
+            self.outgoing.put(bytes(data))
+
+    def recv(self, size):
+        return self.incoming.get()
+
+    def close(self):
+        self.outgoing.put(b'')
+
+
+def memory_socket_pair():
+    a_to_b, b_to_a = gevent.queue.Queue(), gevent.queue.Queue()
+    return MemorySocket(b_to_a, a_to_b), MemorySocket(a_to_b, b_to_a)
+
+
+def serve_h2(sock, answer_together):
+    '''Stand-in server which answers each request with its method, path and
+    body. Waits until answer_together requests are in before answering.'''
+    connection = h2.connection.H2Connection(config=h2.config.H2Configuration(
+        client_side=False, header_encoding='utf-8'))
+    connection.initiate_connection()
+    sock.sendall(connection.data_to_send())
+    requests = {}
+    complete = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return
+        for event in connection.receive_data(data):
+            if isinstance(event, h2.events.RequestReceived):
+                headers = dict(event.headers)
+                requests[event.stream_id] = (
+                    headers[':method'] + ' ' + headers[':path'] + ' ').encode()
+            elif isinstance(event, h2.events.DataReceived):
+                requests[event.stream_id] += event.data
+                connection.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2.events.StreamEnded):
+                complete.append(event.stream_id)
+        if len(complete) >= answer_together:
+            for stream_id in complete:
+                connection.send_headers(stream_id, [
+                    (':status', '200'),
+                    ('content-type', 'text/plain'),
+                    ('set-cookie', 'a=1'),
+                    ('set-cookie', 'b=2'),
+                ])
+                connection.send_data(stream_id, requests.pop(stream_id),
+                                     end_stream=True)
+            complete = []
+        sock.sendall(connection.data_to_send())
+
+
+def make_pool(answer_together=1):
+    connections = []
+
+    def connect(host, port, timeout):
+        client_sock, server_sock = memory_socket_pair()
+        gevent.spawn(serve_h2, server_sock, answer_together)
+        connections.append(host)
+        return client_sock
+    return http2.HTTP2Pool(connect=connect), connections
+
+
+def test_requests_share_one_connection():
+    pool, connections = make_pool(answer_together=3)
+
+    def get(path):
+        response = pool.request('GET', 'https://www.youtube.com' + path,
+                                {'User-Agent': 'test'}, timeout=5)
+        return response.status, response.read()
+
+    tasks = [gevent.spawn(get, '/watch?v=%d' % i) for i in range(3)]
+    gevent.joinall(tasks, raise_error=True)
+    assert [task.value for task in tasks] == [
+        (200, b'GET /watch?v=%d ' % i) for i in range(3)]
+    assert connections == ['www.youtube.com']
+
+
+def test_fetch_url_over_http2(monkeypatch):
+    pool, connections = make_pool()
+    monkeypatch.setattr(settings, 'use_http2', True)
+    monkeypatch.setattr(settings, 'route_tor', 0)
+    monkeypatch.setattr(util, 'http2_pool', pool)
+    content = util.fetch_url('https://www.youtube.com/youtubei/v1/next',
+                             data='{"videoId": "abc"}')
+    assert content == b'POST /youtubei/v1/next {"videoId": "abc"}'
+
+    response, cleanup_func = util.fetch_url_response(
+        'https://m.youtube.com/')
+    assert response.headers.getlist('Set-Cookie') == ['a=1', 'b=2']
+    assert response.final_url == 'https://m.youtube.com/'
+    response.read()
+    cleanup_func(response)
+    assert connections == ['www.youtube.com', 'm.youtube.com']
+
+
+def test_only_refusal_turns_http2_off():
+    errors = [socket.timeout('timed out'),
+              http2.HTTP2Unsupported('www.youtube.com does not support')]
+    attempts = []
+
+    def connect(host, port, timeout):
+        attempts.append(host)
+        raise errors.pop(0)
+    pool = http2.HTTP2Pool(connect=connect)
+    url = 'https://www.youtube.com/'
+    assert pool.request('GET', url, {}, timeout=5) is None
+    assert pool.request('GET', url, {}, timeout=5) is None
+    assert pool.request('GET', url, {}, timeout=5) is None
+    # tried again after the timeout, but not after the refusal
+    assert attempts == ['www.youtube.com']*2
+
+
+def test_failed_connection_falls_back(monkeypatch):
+    connections = []
+
+    def connect(host, port, timeout):
+        client_sock, server_sock = memory_socket_pair()
+        if not connections:
+            # stale connection: closed before answering anything
+            client_sock.incoming.put(b'')
+        else:
+            gevent.spawn(serve_h2, server_sock, 1)
+        connections.append(host)
+        return client_sock
+    pool = http2.HTTP2Pool(connect=connect)
+    monkeypatch.setattr(settings, 'use_http2', True)
+    monkeypatch.setattr(settings, 'route_tor', 0)
+    monkeypatch.setattr(util, 'http2_pool', pool)
+    http1_requests = []
+
+    def request(method, url, **kwargs):
+        http1_requests.append(url)
+        return urllib3.response.HTTPResponse(
+            body=io.BytesIO(b'over HTTP/1.1'), status=200,
+            preload_content=False, request_url=url)
+    monkeypatch.setattr(util.connection_pool, 'request', request)
+
+    url = 'https://www.youtube.com/watch?v=abc'
+    assert util.fetch_url(url) == b'over HTTP/1.1'
+    assert http1_requests == [url]
+    assert not pool.connections
+    assert util.fetch_url(url) == b'GET /watch?v=abc '
+    assert connections == ['www.youtube.com']*2
+
+
+def test_warm_up_uses_http2_connections(monkeypatch):
+    pool, connections = make_pool()
+    monkeypatch.setattr(settings, 'use_http2', True)
+    monkeypatch.setattr(settings, 'route_tor', 0)
+    monkeypatch.setattr(util, 'http2_pool', pool)
+    http1_hosts = []
+
+    def request(method, url, **kwargs):
+        http1_hosts.append(urllib.parse.urlsplit(url).hostname)
+    monkeypatch.setattr(util.connection_pool, 'request', request)
+
+    util.warm_up_connections(connections_per_host=1)
+    gevent.sleep(0.01)
+    assert sorted(connections) == sorted(http2.HOSTS)
+    assert http1_hosts == ['i.ytimg.com']
+
+
+def test_stream_timeout_leaves_other_streams(monkeypatch):
+    '''One stream timing out doesn't break the others on the connection'''
+    send_body = gevent.event.Event()
+
+    def serve(sock):
+        # answers the headers of the first request at once and its body
+        # when send_body is set; never answers the second
+        connection = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=False))
+        connection.initiate_connection()
+        sock.sendall(connection.data_to_send())
+
+        def send_first_body():
+            send_body.wait()
+            connection.send_data(1, b'first body', end_stream=True)
+            sock.sendall(connection.data_to_send())
+        gevent.spawn(send_first_body)
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                return
+            for event in connection.receive_data(data):
+                if (isinstance(event, h2.events.RequestReceived)
+                        and event.stream_id == 1):
+                    connection.send_headers(1, [(':status', '200')])
+            sock.sendall(connection.data_to_send())
+
+    def connect(host, port, timeout):
+        client_sock, server_sock = memory_socket_pair()
+        gevent.spawn(serve, server_sock)
+        return client_sock
+    pool = http2.HTTP2Pool(connect=connect)
+
+    first = pool.request('GET', 'https://www.youtube.com/a', {}, timeout=5)
+    assert first.status == 200
+    assert pool.request('GET', 'https://www.youtube.com/b', {},
+                        timeout=0.05) is None
+    send_body.set()
+    assert first.read() == b'first body'
+    connection = pool.connections[('www.youtube.com', 443)]
+    assert connection.is_usable()
+
+
+def test_fallback_keeps_to_page_deadline(monkeypatch):
+    class SlowFailingPool:
+        def request(self, method, url, headers, body=None, timeout=15):
+            gevent.sleep(0.2)
+            return None
+    monkeypatch.setattr(settings, 'use_http2', True)
+    monkeypatch.setattr(settings, 'route_tor', 0)
+    monkeypatch.setattr(util, 'http2_pool', SlowFailingPool())
+    http1_timeouts = []
+
+    def request(method, url, timeout=None, **kwargs):
+        http1_timeouts.append(timeout)
+        return urllib3.response.HTTPResponse(
+            body=io.BytesIO(b'over HTTP/1.1'), status=200,
+            preload_content=False, request_url=url)
+    monkeypatch.setattr(util.connection_pool, 'request', request)
+
+    def make_page(seconds):
+        util.set_deadline(seconds)
+        try:
+            return util.fetch_url('https://www.youtube.com/')
+        finally:
+            util.clear_deadline()
+
+    assert gevent.spawn(make_page, 10).get() == b'over HTTP/1.1'
+    assert 9 < http1_timeouts[0] < 9.9
+    with pytest.raises(util.FetchError) as excinfo:
+        gevent.spawn(make_page, 0.1).get()
+    assert excinfo.value.code == '504'
+    assert len(http1_timeouts) == 1
@@ -0,0 +1,62 @@
+from youtube import image_cache
+
+
+def test_content_addressed_storage(tmp_path):
+    cache = image_cache.ImageCache(str(tmp_path), 1000)
+    first = cache.put('https://i.ytimg.com/vi/a/mqdefault.jpg', b'x'*100,
+                      'image/jpeg')
+    second = cache.put('https://i.ytimg.com/vi/a/mqdefault.jpg?sqp=1',
+                       b'x'*100, 'image/jpeg')
+    assert first.etag == second.etag
+    assert len(cache.blobs) == 1
+    assert cache.total_bytes == 100
+    assert cache.get('https://i.ytimg.com/vi/a/mqdefault.jpg?sqp=1') == first
+    assert cache.get('https://i.ytimg.com/vi/b/mqdefault.jpg') is None
+
+
+def test_eviction_and_persistence(tmp_path):
+    cache = image_cache.ImageCache(str(tmp_path), 250)
+    for name in ('a', 'b', 'c'):
+        cache.put('https://yt3.ggpht.com/' + name, name.encode()*100,
+                  'image/webp')
+    # least recently used image was evicted along with its url
+    assert cache.total_bytes == 200
+    assert cache.get('https://yt3.ggpht.com/a') is None
+    cache._save_index()
+
+    reloaded = image_cache.ImageCache(str(tmp_path), 250)
+    image = reloaded.get('https://yt3.ggpht.com/c')
+    assert image.content == b'c'*100
+    assert image.content_type == 'image/webp'
+
+
+def test_eviction_removes_only_evicted_urls(tmp_path):
+    cache = image_cache.ImageCache(str(tmp_path), 250)
+    cache.put('https://yt3.ggpht.com/a', b'a'*100, 'image/webp')
+    cache.put('https://yt3.ggpht.com/a?s=88', b'a'*100, 'image/webp')
+    cache.put('https://yt3.ggpht.com/b', b'b'*100, 'image/webp')
+    # a url that now points to different content leaves the old blob's set
+    cache.put('https://yt3.ggpht.com/b', b'B'*100, 'image/webp')
+    assert set(cache.urls) == {'https://yt3.ggpht.com/b'}
+    assert list(cache.hash_urls.values()) == [{'https://yt3.ggpht.com/b'}]
+
+
+def test_revalidation(tmp_path, monkeypatch):
+    now = [1000000]
+    monkeypatch.setattr(image_cache.time, 'time', lambda: now[0])
+    cache = image_cache.ImageCache(str(tmp_path), 1000)
+    url = 'https://yt3.ggpht.com/avatar'
+    cache.put(url, b'x'*10, 'image/jpeg', '"upstream"',
+              'Sat, 01 Jan 2000 00:00:00 GMT')
+    cache.put('https://i.ytimg.com/vi/a/default.jpg', b'y'*10, 'image/jpeg')
+    assert cache.revalidation_headers(url) is None
+
+    now[0] += cache.REVALIDATE_AGE
+    assert cache.revalidation_headers(url) == {
+        'If-None-Match': '"upstream"',
+        'If-Modified-Since': 'Sat, 01 Jan 2000 00:00:00 GMT',
+    }
+    assert cache.revalidation_headers(
+        'https://i.ytimg.com/vi/a/default.jpg') == {}
+    cache.mark_validated(url)
+    assert cache.revalidation_headers(url) is None
@@ -0,0 +1,42 @@
+from youtube import metrics
+import pytest
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(metrics, 'registry', [])
+    monkeypatch.setattr(metrics, 'collectors', [])
+
+
+def test_render(registry):
+    requests = metrics.Counter('test_requests_total', 'Requests',
+                               ('endpoint', 'status'))
+    latency = metrics.Histogram('test_latency_seconds', 'Latency',
+                                ('endpoint',), buckets=(0.1, 1))
+    idle = metrics.Gauge('test_idle', 'Idle connections')
+    metrics.add_collector(lambda: idle.set(3))
+
+    requests.inc('watch', 200)
+    requests.inc('watch', 200)
+    requests.inc('say "hi"\n', 429)
+    for value in (0.05, 0.1, 0.5, 2):
+        latency.observe(value, 'watch')
+
+    assert metrics.render() == r'''# HELP test_requests_total Requests
+# TYPE test_requests_total counter
+test_requests_total{endpoint="say \"hi\"\n",status="429"} 1
+test_requests_total{endpoint="watch",status="200"} 2
+# HELP test_latency_seconds Latency
+# TYPE test_latency_seconds histogram
+test_latency_seconds_bucket{endpoint="watch",le="0.1"} 2
+test_latency_seconds_bucket{endpoint="watch",le="1.0"} 3
+test_latency_seconds_bucket{endpoint="watch",le="+Inf"} 4
+test_latency_seconds_sum{endpoint="watch"} 2.65
+test_latency_seconds_count{endpoint="watch"} 4
+# HELP test_idle Idle connections
+# TYPE test_idle gauge
+test_idle 3
+'''
+
+    with pytest.raises(TypeError):
+        requests.inc('watch')
@@ -0,0 +1,33 @@
+from youtube import resolver
+import socket
+
+
+def test_resolver_cache():
+    lookups = []
+
+    def getaddrinfo(host, port, family, type):
+        lookups.append(host)
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                 ('192.0.2.%d' % len(lookups), port))]
+
+    dns = resolver.Resolver(getaddrinfo)
+    assert dns.resolve('www.youtube.com', 443) == [
+        (socket.AF_INET, ('192.0.2.1', 443))]
+    assert dns.resolve('www.youtube.com', 443) == [
+        (socket.AF_INET, ('192.0.2.1', 443))]
+    assert lookups == ['www.youtube.com']
+    assert dns.hits == 1 and dns.misses == 1
+
+    # googlevideo hosts don't take space from the others
+    dns.resolve('rr1---sn-abc.googlevideo.com', 443)
+    assert list(dns.cache) == [('www.youtube.com', 443)]
+    assert list(dns.googlevideo_cache) == [
+        ('rr1---sn-abc.googlevideo.com', 443)]
+
+    assert dns.take_lookup_time() > 0
+    assert dns.take_lookup_time() == 0
+
+    dns.invalidate('www.youtube.com', 443)
+    assert dns.resolve('www.youtube.com', 443) == [
+        (socket.AF_INET, ('192.0.2.3', 443))]
+    assert len(lookups) == 3
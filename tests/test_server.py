@@ -0,0 +1,511 @@
+import server
+import gevent
+import http.client
+import io
+import pytest
+import urllib3
+
+
+def test_concurrency_limit_changed_while_queued():
+    concurrency_class = server.ConcurrencyClass(
+        'page', 1, max_queue=10, queue_timeout=None)
+    assert concurrency_class.acquire()
+    waiters = [gevent.spawn(concurrency_class.acquire) for i in range(3)]
+    gevent.sleep(0)
+    assert concurrency_class.waiting == 3
+
+    concurrency_class.set_limit(2)
+    gevent.sleep(0)
+    assert waiters[0].value is True
+    assert concurrency_class.waiting == 2
+
+    # unlimited lets everyone waiting in
+    concurrency_class.set_limit(0)
+    gevent.joinall(waiters, timeout=1)
+    assert [waiter.value for waiter in waiters] == [True, True, True]
+    assert concurrency_class.active == 4
+
+    # lowered: requests in flight finish, then the queue waits for room
+    concurrency_class.set_limit(2)
+    for i in range(2):
+        concurrency_class.release()
+    waiter = gevent.spawn(concurrency_class.acquire)
+    gevent.sleep(0)
+    assert concurrency_class.waiting == 1
+    concurrency_class.release()
+    assert waiter.get(timeout=1) is True
+    assert concurrency_class.active == 2
+
+
+def test_concurrency_queue_timeout():
+    concurrency_class = server.ConcurrencyClass(
+        'video', 1, max_queue=1, queue_timeout=0.01)
+    assert concurrency_class.acquire()
+    waiter = gevent.spawn(concurrency_class.acquire)
+    gevent.sleep(0)
+    assert not concurrency_class.acquire()     # queue is full
+    assert waiter.get(timeout=1) is False
+    assert concurrency_class.waiting == 0
+    assert concurrency_class.rejected == 2
+
+
+def test_stale_image_revalidated(tmp_path, monkeypatch):
+    cache = server.image_cache.ImageCache(str(tmp_path), 1000)
+    monkeypatch.setattr(server.image_cache, 'image_cache', cache)
+    url = 'https://yt3.ggpht.com/avatar'
+    cache.put(url, b'old', 'image/jpeg', '"v1"')
+    sent_headers = []
+    responses = [(304, b''), (200, b'new')]
+
+    def fetch_url_response(url, headers, *args, **kwargs):
+        sent_headers.append(headers)
+        status, body = responses.pop(0)
+        response = urllib3.response.HTTPResponse(
+            body=io.BytesIO(body), status=status, preload_content=False,
+            headers={'ETag': '"v2"', 'Content-Type': 'image/jpeg'})
+        return response, (lambda r: None)
+    monkeypatch.setattr(server.util, 'fetch_url_response', fetch_url_response)
+
+    def get_image():
+        env = {'REQUEST_METHOD': 'GET', 'SERVER_NAME': 'yt3.ggpht.com',
+               'PATH_INFO': '/avatar', 'QUERY_STRING': ''}
+        return b''.join(server.proxy_image(env, lambda *args: None))
+
+    assert get_image() == b'old'
+    assert sent_headers == []
+    for expected in (b'old', b'new'):
+        cache.urls[url] = cache.urls[url][0:4] + (0,)
+        assert get_image() == expected
+    assert [headers.get('If-None-Match') for headers in sent_headers] == [
+        '"v1"', '"v1"']
+    assert cache.urls[url][2] == '"v2"'
+
+
+def test_host_failures_pruned(monkeypatch):
+    now = [1000]
+    monkeypatch.setattr(server.time, 'monotonic', lambda: now[0])
+    tracker = server.HostFailureTracker()
+    tracker.record('www.youtube.com')
+    assert not tracker.failures
+    for i in range(3):
+        tracker.record('rr1---sn-abc.googlevideo.com')
+    assert tracker.is_failing('rr1---sn-abc.googlevideo.com')
+
+    now[0] += tracker.WINDOW + 1
+    tracker.record('rr2---sn-def.googlevideo.com')
+    assert list(tracker.failures) == ['rr2---sn-def.googlevideo.com']
+
+
+@pytest.mark.parametrize('path', ['/metrics', '/concurrency_status',
+                                  '/connection_pool_status'])
+def test_status_pages_local_only(path, monkeypatch):
+    monkeypatch.setattr(server.settings, 'allow_foreign_status_pages', False)
+    client = server.yt_app.test_client()
+
+    def status(address):
+        return client.get(
+            path, environ_base={'REMOTE_ADDR': address}).status_code
+
+    assert status('127.0.0.1') == 200
+    assert status('::1') == 200
+    assert status('192.0.2.1') == 403
+    monkeypatch.setattr(server.settings, 'allow_foreign_status_pages', True)
+    assert status('192.0.2.1') == 200
+
+
+class FakeClock:
+    '''Stands in for time.monotonic and gevent.sleep'''
+    def __init__(self, monkeypatch):
+        self.now = 1000.0
+        self.slept = []
+        monkeypatch.setattr(server.time, 'monotonic', lambda: self.now)
+        monkeypatch.setattr(server.gevent, 'sleep', self.sleep)
+
+    def sleep(self, seconds=0):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def test_bandwidth_shares(monkeypatch):
+    clock = FakeClock(monkeypatch)
+    scheduler = server.BandwidthScheduler(global_rate=1000, client_rate=600)
+    playback = scheduler.open_stream('192.0.2.1')
+    download = scheduler.open_stream('192.0.2.1', download=True)
+    other_client = scheduler.open_stream('192.0.2.2', download=True)
+    # global: weights 4, 1, 1 of 1000; per client: 4 and 1 of 600
+    assert scheduler.stream_rate(playback) == 480
+    assert scheduler.stream_rate(download) == 120
+    assert scheduler.stream_rate(other_client) == 1000/6
+
+    # streams that stop sending give their share to the others
+    clock.now += scheduler.IDLE_TIME + 1
+    assert scheduler.stream_rate(other_client) == 600
+    download.close()
+    playback.throttle(0)
+    assert scheduler.stream_rate(playback) == 600
+    assert scheduler.stream_rate(other_client) == 200
+
+
+def test_bandwidth_throttle_timing(monkeypatch):
+    clock = FakeClock(monkeypatch)
+    scheduler = server.BandwidthScheduler(global_rate=1000)
+    stream = scheduler.open_stream('192.0.2.1')
+    start = clock.now
+    for i in range(10):
+        stream.throttle(500)
+    assert clock.now - start == pytest.approx(5)
+    stream.close()
+
+    # unused allowance is saved up for at most BURST_SECONDS
+    stream = scheduler.open_stream('192.0.2.1')
+    clock.now += 10
+    clock.slept.clear()
+    stream.throttle(500)
+    assert clock.slept == []
+    stream.throttle(500)
+    assert clock.slept == [pytest.approx(0.5)]
+
+
+class FakeSocket:
+    def __init__(self, data):
+        self.data = data
+
+    def makefile(self, mode):
+        return io.BytesIO(self.data)
+
+
+def upstream_response(body, content_length, status='200 OK'):
+    raw = http.client.HTTPResponse(FakeSocket(
+        b'HTTP/1.1 %s\r\nContent-Length: %d\r\n\r\n' % (
+            status.encode(), content_length)
+        + body))
+    raw.begin()
+    return urllib3.response.HTTPResponse.from_httplib(
+        raw, preload_content=False, decode_content=False)
+
+
+def test_relay_response():
+    body = bytes(range(256))*100
+    response = upstream_response(body, len(body))
+    relayed = b''.join(relay_pieces(response, limit=None))
+    assert relayed == body
+    assert response.tell() == len(body)
+    assert response.length_remaining == 0
+
+
+def test_relay_response_limit():
+    body = bytes(range(256))*100
+    response = upstream_response(body, len(body))
+    assert b''.join(relay_pieces(response, limit=1000)) == body[0:1000]
+    assert response.tell() == 1000
+    assert response.length_remaining == len(body) - 1000
+
+
+def test_relay_truncated_response():
+    '''The relay stops where the body was cut off, and urllib3's counters
+    show how much is missing so the caller can resume'''
+    body = bytes(range(256))*10
+    response = upstream_response(body, len(body) + 500)
+    assert b''.join(relay_pieces(response, limit=None)) == body
+    assert response.tell() == len(body)
+    assert response.length_remaining == 500
+
+
+class ReadOnlyBody:
+    '''File object without readinto'''
+    def __init__(self, data):
+        self.file = io.BytesIO(data)
+
+    def read(self, amount=-1):
+        return self.file.read(amount)
+
+    def close(self):
+        self.file.close()
+
+
+def test_relay_response_without_readinto():
+    body = b'abcdefghij'*1000
+    response = urllib3.response.HTTPResponse(
+        body=ReadOnlyBody(body), preload_content=False, decode_content=False,
+        headers={'Content-Length': str(len(body))})
+    assert not hasattr(response._fp, 'readinto')
+    assert b''.join(relay_pieces(response, limit=None)) == body
+    assert response.tell() == len(body)
+
+
+def relay_pieces(response, limit):
+    buffer = bytearray(4096)
+    return [bytes(piece) for piece in
+            server.relay_response(response, buffer, True, limit=limit)]
+
+
+VIDEO_URL = 'https://rr1---sn-abcdef.googlevideo.com/videoplayback?id=1'
+VIDEO_DATA = bytes(range(256))*40
+
+
+def range_response(start, end, content_length=None):
+    '''206 response with the bytes start-end of VIDEO_DATA'''
+    body = VIDEO_DATA[start:end+1]
+    if content_length is None:
+        content_length = len(body)
+    return (upstream_response(body, content_length, '206 Partial Content'),
+            lambda response: response.release_conn())
+
+
+def test_subranges_yielded_in_order(monkeypatch):
+    monkeypatch.setattr(server, 'PARALLEL_SUBRANGE_SIZE', 1000)
+    requested = []
+    def fetch_video_range(url, use_tor, start, end):
+        requested.append((start, end))
+        # later sub-ranges finish first
+        gevent.sleep(0.05 - start/200000)
+        return range_response(start, end)
+    monkeypatch.setattr(server, 'fetch_video_range', fetch_video_range)
+
+    parts = list(server.fetch_subranges_parallel(
+        VIDEO_URL, False, 100, 5599, connections=4))
+    assert b''.join(parts) == VIDEO_DATA[100:5600]
+    assert [len(part) for part in parts] == [1000]*5 + [500]
+    # the last sub-range is only as long as what is left
+    assert sorted(requested) == [(100 + i*1000, 1099 + i*1000)
+                                 for i in range(5)] + [(5100, 5599)]
+
+
+def test_failed_subrange_stops_siblings(monkeypatch):
+    monkeypatch.setattr(server, 'PARALLEL_SUBRANGE_SIZE', 1000)
+    finished = []
+    def fetch_video_range(url, use_tor, start, end):
+        if start == 1000:
+            return (upstream_response(b'', 0, '403 Forbidden'),
+                    lambda response: response.release_conn())
+        if start > 1000:
+            gevent.sleep(0.1)
+        finished.append(start)
+        return range_response(start, end)
+    monkeypatch.setattr(server, 'fetch_video_range', fetch_video_range)
+
+    parts = list(server.fetch_subranges_parallel(
+        VIDEO_URL, False, 0, 9999, connections=4))
+    assert b''.join(parts) == VIDEO_DATA[0:1000]
+    # the sub-ranges after the failed one were abandoned
+    gevent.sleep(0.2)
+    assert finished == [0]
+
+
+def test_video_range_parts_fetched_in_parallel(monkeypatch):
+    monkeypatch.setattr(server, 'PARALLEL_SUBRANGE_SIZE', 1000)
+    monkeypatch.setattr(server.settings, 'parallel_video_connections', 3)
+    requested = []
+    def fetch_video_range(url, use_tor, start, end):
+        requested.append((start, end))
+        gevent.sleep(0.05 - start/200000)
+        return range_response(start, end)
+    monkeypatch.setattr(server, 'fetch_video_range', fetch_video_range)
+
+    statuses = []
+    parts = server._proxy_video_range_parts(
+        lambda status, headers: statuses.append(status), None, None,
+        VIDEO_URL + '&parts=1', False, 0, 4499, '200 OK', [],
+        bytearray(4096), False)
+    assert b''.join(parts) == VIDEO_DATA[0:4500]
+    assert statuses == ['200 OK']
+    # the first sub-range on its own, then the rest in parallel
+    assert requested[0] == (0, 999)
+    assert sorted(requested[1:]) == [(1000, 1999), (2000, 2999),
+                                     (3000, 3999), (4000, 4499)]
+
+
+def video_env(url_path, **extra):
+    env = {
+        'REQUEST_METHOD': 'GET',
+        'SERVER_NAME': 'rr1---sn-abcdef.googlevideo.com',
+        'PATH_INFO': url_path,
+        'QUERY_STRING': 'id=1',
+    }
+    env.update(extra)
+    return env
+
+
+def record_metadata(url, content_length):
+    response = upstream_response(b'', 0, '206 Partial Content')
+    response.headers['Content-Range'] = 'bytes 0-99/%d' % content_length
+    response.headers['Content-Type'] = 'video/mp4'
+    server.upstream_metadata.record(url, response)
+
+
+def test_cached_head(monkeypatch):
+    def head(*args, **kwargs):
+        raise AssertionError('HEAD went upstream')
+    monkeypatch.setattr(server.util, 'head', head)
+    env = video_env('/videoplayback/head', REQUEST_METHOD='HEAD')
+    record_metadata(server.upstream_url(env, video=True), 5000)
+
+    responses = []
+    body = server.proxy_head(
+        env, lambda status, headers: responses.append((status, headers)),
+        video=True)
+    assert list(body) == []
+    status, headers = responses[0]
+    assert status == '200 OK'
+    assert ('Content-Length', '5000') in headers
+    assert ('Content-Type', 'video/mp4') in headers
+
+
+def test_open_range_resolved_from_metadata(monkeypatch):
+    env = video_env('/videoplayback/range', HTTP_RANGE='bytes=1000-')
+    url = server.upstream_url(env)
+    record_metadata(url, 5000)
+    sent_headers = []
+    def fetch_url_response(url, headers, **kwargs):
+        sent_headers.append(headers)
+        return range_response(1000, 4999)
+    monkeypatch.setattr(server.util, 'fetch_url_response', fetch_url_response)
+
+    body = server.proxy_site(env, lambda status, headers: None)
+    assert b''.join(body) == VIDEO_DATA[1000:5000]
+    assert sent_headers[0]['Range'] == 'bytes=1000-4999'
+
+
+def test_requested_range():
+    assert server.requested_range({}, 5000) == (0, 4999)
+    assert server.requested_range({'HTTP_RANGE': 'bytes=1000-'}, 5000) == (
+        1000, 4999)
+    assert server.requested_range({'HTTP_RANGE': 'bytes=10-99999'}, 5000) == (
+        10, 4999)
+    assert server.requested_range({'HTTP_RANGE': 'bytes=5000-'}, 5000) is None
+
+
+def test_upstream_metadata_expires():
+    cache = server.UpstreamMetadataCache(ttl=0.05)
+    response = upstream_response(b'', 0, '206 Partial Content')
+    response.headers['Content-Range'] = 'bytes 0-99/5000'
+    cache.record('https://example.com/a', response)
+    assert cache.get('https://example.com/a').content_length == 5000
+    gevent.sleep(0.1)
+    assert cache.get('https://example.com/a') is None
+
+
+def linear_scan(routes, host):
+    '''How hosts were matched to handlers before SiteRouter'''
+    base_name = ''
+    for domain in reversed(host.split('.')):
+        if base_name == '':
+            base_name = domain
+        else:
+            base_name = domain + '.' + base_name
+        if base_name in routes:
+            return routes[base_name]
+    return None
+
+
+@pytest.mark.parametrize('host', [
+    'youtube.com', 'www.youtube.com', 'm.youtube.com',
+    'www.youtube-nocookie.com', 'youtu.be', 'i.ytimg.com', 'i9.ytimg.com',
+    'ytimg.com', 'yt3.ggpht.com', 'ggpht.com', 'lh3.googleusercontent.com',
+    'sponsor.ajay.app', 'rr1---sn-abcdef.googlevideo.com',
+    'redirector.googlevideo.com', 'googlevideo.com', 'example.com',
+    'notyoutube.com', 'com',
+])
+def test_site_router_matches_linear_scan(host):
+    router = server.site_router
+    assert router.lookup(host) == linear_scan(router.routes, host)
+
+
+def test_site_router_longest_suffix():
+    router = server.SiteRouter()
+    router.register('ytimg.com', 'ytimg', 'image')
+    router.register('i.ytimg.com', 'i.ytimg', 'image')
+    assert router.lookup('i.ytimg.com')[0] == 'i.ytimg'
+    assert router.lookup('s.i.ytimg.com')[0] == 'i.ytimg'
+    assert router.lookup('i9.ytimg.com')[0] == 'ytimg'
+    assert router.lookup('ytimg.com')[0] == 'ytimg'
+    assert router.lookup('xytimg.com') is None
+
+
+def test_site_router_host_cache():
+    router = server.SiteRouter(cache_size=2)
+    router.register('googlevideo.com', 'video', 'video')
+    route = router.lookup('rr1---sn-abcdef.googlevideo.com')
+    assert route[0] == 'video'
+    assert router.host_cache['rr1---sn-abcdef.googlevideo.com'] is route
+    assert router.lookup('rr1---sn-abcdef.googlevideo.com') is route
+    assert router.lookup('example.com') is None
+    assert router.lookup('example.com') is None
+
+    # least recently used hosts are dropped, registering clears the cache
+    router.lookup('rr2---sn-abcdef.googlevideo.com')
+    assert 'rr1---sn-abcdef.googlevideo.com' not in router.host_cache
+    router.register('rr2---sn-abcdef.googlevideo.com', 'host', 'video')
+    assert router.lookup('rr2---sn-abcdef.googlevideo.com')[0] == 'host'
+
+
+def yield_all(generator, parts):
+    '''Collects the pieces of generator into parts and returns its return
+    value'''
+    while True:
+        try:
+            parts.append(bytes(next(generator)))
+        except StopIteration as e:
+            return e.value
+
+
+def test_relay_resumes_truncated_stream(monkeypatch):
+    monkeypatch.setattr(server, 'host_failures', server.HostFailureTracker())
+    delays = []
+    monkeypatch.setattr(server.gevent, 'sleep', delays.append)
+    requested = []
+    def fetch_range(url, start, end):
+        requested.append('bytes=%d-%d' % (start, end))
+        # the first resumption is cut off too
+        if len(requested) == 1:
+            return range_response(start, start + 699, end - start + 1)
+        return range_response(start, end)
+
+    # cut off after 1234 of the 4000 bytes 500-4499
+    response, cleanup_func = range_response(500, 1733, 4000)
+    relayed = []
+    relayed_parts = []
+    position = yield_all(server.relay_resumable(
+        VIDEO_URL, fetch_range, response, cleanup_func, 500, 4499,
+        bytearray(1000), False, on_part=lambda *args: relayed.append(args)),
+        relayed_parts)
+    assert requested == ['bytes=1734-4499', 'bytes=2434-4499']
+    assert b''.join(relayed_parts) == VIDEO_DATA[500:4500]
+    assert position == 4500
+    # on_part is told the position of each piece
+    offset = 500
+    for part_position, content_part in relayed:
+        assert part_position == offset
+        offset += len(content_part)
+    # each cut at a new position starts the backoff over
+    assert len(delays) == 2
+    assert all(0.25 <= delay <= 0.5 for delay in delays)
+
+
+def test_relay_gives_up_at_stuck_position(monkeypatch):
+    monkeypatch.setattr(server, 'host_failures', server.HostFailureTracker())
+    monkeypatch.setattr(server.random, 'uniform', lambda low, high: high)
+    delays = []
+    monkeypatch.setattr(server.gevent, 'sleep', delays.append)
+    requested = []
+    def fetch_range(url, start, end):
+        requested.append((start, end))
+        return range_response(start, start - 1, end - start + 1)
+
+    response, cleanup_func = range_response(0, 999, 4000)
+    parts = []
+    position = yield_all(server.relay_resumable(
+        VIDEO_URL, fetch_range, response, cleanup_func, 0, 3999,
+        bytearray(1000), False), parts)
+    assert position == 1000
+    assert b''.join(parts) == VIDEO_DATA[0:1000]
+    assert requested == [(1000, 3999)]*server.RETRY_MAX_TRIES
+    assert delays == [0.5, 1, 2]
+
+
+@pytest.mark.parametrize('try_num', range(1, 10))
+def test_retry_delay(try_num):
+    bound = min(server.RETRY_BASE_DELAY*2**(try_num - 1), 8)
+    assert server.RETRY_MAX_DELAY == 8
+    for i in range(100):
+        assert bound/2 <= server.retry_delay(try_num) <= bound
@@ -0,0 +1,215 @@
+from youtube import subscriptions
+import pytest
+
+
+def test_autocheck_scheduler():
+    scheduler = subscriptions.AutocheckScheduler()
+    scheduler.schedule('a', 30)
+    scheduler.schedule('b', 10)
+    scheduler.schedule('c', 20)
+    assert scheduler.changed.is_set()
+    scheduler.changed.clear()
+    scheduler.schedule('d', 40)
+    # not the earliest job, so the dispatcher needn't wake up
+    assert not scheduler.changed.is_set()
+
+    scheduler.schedule('b', 50)     # reschedule
+    scheduler.cancel('c')
+    scheduler.mute(['d'])
+    scheduler.schedule('d', 5)      # muted channels stay unscheduled
+    assert len(scheduler) == 2
+    assert scheduler.next_check_time() == 30
+    assert scheduler.pop() == 'a'
+    assert scheduler.pop() == 'b'
+    assert scheduler.next_check_time() is None
+
+    scheduler.unmute(['d'], lambda channel_id: 60)
+    assert scheduler.pop() == 'd'
+
+
+def test_autocheck_scheduler_compaction():
+    scheduler = subscriptions.AutocheckScheduler()
+    for i in range(1000):
+        scheduler.schedule(i, i)
+    for i in range(990):
+        scheduler.cancel(i)
+    assert len(scheduler.heap) < 100
+    assert [scheduler.pop() for i in range(10)] == list(range(990, 1000))
+
+    # rescheduling leaves cancelled entries behind too
+    for cycle in range(100):
+        for i in range(990, 1000):
+            scheduler.schedule(i, cycle*1000 + i)
+    assert len(scheduler.heap) < 100
+    assert [scheduler.pop() for i in range(10)] == list(range(990, 1000))
+
+
+def make_video(channel_id, video_id, time_published):
+    return {'id': video_id, 'title': 'Video ' + video_id, 'duration': '1:00',
+            'time_published': time_published, 'is_time_published_exact': True,
+            'description': '', 'channel_id': channel_id}
+
+
+def test_save_check_results(tmp_path, monkeypatch):
+    monkeypatch.setattr(subscriptions, 'database_path',
+                        str(tmp_path/'subscriptions.sqlite'))
+    monkeypatch.setattr(subscriptions.settings, 'autocheck_subscriptions',
+                        True)
+    monkeypatch.setattr(subscriptions, 'autocheck_scheduler',
+                        subscriptions.AutocheckScheduler())
+    subscriptions._subscribe([('UCa', 'A'), ('UCb', 'B')])
+    broken_video = make_video('UCb', 'b2', 200)
+    del broken_video['title']
+    subscriptions._save_check_results([
+        subscriptions.CheckResult(
+            'UCa', 'A', [make_video('UCa', 'a1', 100)], 5000, 1000),
+        subscriptions.CheckResult(
+            'UCb', 'B', [make_video('UCb', 'b1', 100), broken_video], 5000,
+            1000),
+        subscriptions.CheckResult('UCgone', 'Gone', [], 5000, 1000),
+    ])
+
+    def read(cursor):
+        return (
+            cursor.execute('PRAGMA journal_mode').fetchone()[0],
+            cursor.execute('SELECT video_id FROM videos').fetchall(),
+            cursor.execute('''SELECT yt_channel_id, time_last_checked
+                              FROM subscribed_channels
+                              ORDER BY yt_channel_id''').fetchall(),
+        )
+    journal_mode, videos, channels = subscriptions.with_open_db(read)
+    assert journal_mode == 'wal'
+    # the broken result is rolled back without losing the others
+    assert videos == [('a1',)]
+    assert channels == [('UCa', 1000), ('UCb', 0)]
+    # the channel unsubscribed from during its check isn't checked again
+    assert list(subscriptions.autocheck_scheduler.entries) == ['UCa']
+
+
+def test_check_results_batched(monkeypatch):
+    import gevent
+    import gevent.queue
+    batches = []
+    monkeypatch.setattr(subscriptions, 'check_results_queue',
+                        gevent.queue.Queue())
+    monkeypatch.setattr(subscriptions, '_save_check_results', batches.append)
+    monkeypatch.setattr(subscriptions, 'CHECK_RESULTS_BATCH_SIZE', 3)
+    for i in range(4):
+        subscriptions.check_results_queue.put(i)
+    writer = gevent.spawn(subscriptions.check_results_writer)
+    gevent.sleep(subscriptions.CHECK_RESULTS_BATCH_TIME + 0.2)
+    writer.kill()
+    assert batches == [[0, 1, 2], [3]]
+
+
+def test_connections_reused_and_migrated(tmp_path, monkeypatch):
+    path = str(tmp_path/'subscriptions.sqlite')
+    monkeypatch.setattr(subscriptions, 'database_path', path)
+    monkeypatch.setattr(subscriptions, 'connection_managers', {})
+    with subscriptions.open_database() as connection:
+        with connection as cursor:
+            assert cursor.execute('SELECT version FROM db_info').fetchall(
+                ) == [(subscriptions.schema_version(),)]
+    with subscriptions.open_database() as connection_2:
+        # the same connection, given back after the first use
+        assert connection_2 is connection
+        with subscriptions.open_database() as connection_3:
+            assert connection_3 is not connection
+
+    def add_column(cursor):
+        cursor.execute('ALTER TABLE videos ADD COLUMN test integer')
+    version = subscriptions.schema_version() + 1
+    monkeypatch.setattr(subscriptions, 'migrations',
+                        subscriptions.migrations + [(version, add_column)])
+    # the migration is done once, by the first connection after a restart
+    for i in range(2):
+        subscriptions.connection_managers.pop(path).close()
+        with subscriptions.open_database() as connection:
+            with connection as cursor:
+                assert cursor.execute(
+                    'SELECT version FROM db_info').fetchall() == [(version,)]
+                cursor.execute('SELECT test FROM videos')
+
+
+def test_feed_pages(tmp_path, monkeypatch):
+    monkeypatch.setattr(subscriptions, 'database_path',
+                        str(tmp_path/'subscriptions.sqlite'))
+    monkeypatch.setattr(subscriptions, 'feed_video_counts', {})
+    subscriptions._subscribe([('UCa', 'A'), ('UCb', 'B')])
+    # pairs of videos published at the same time, so the id breaks ties
+    subscriptions._save_check_results([
+        subscriptions.CheckResult(
+            channel_id, channel_id,
+            [make_video(channel_id, '%s%03d' % (channel_id, i),
+                        1000.25 + i//2)
+             for i in range(75)], 5000, 1000)
+        for channel_id in ('UCa', 'UCb')])
+    all_videos = subscriptions.with_open_db(
+        lambda cursor: subscriptions._get_videos(cursor, 1000))[0]
+    assert len(all_videos) == 150
+
+    pages = []
+    ctoken = None
+    while True:
+        videos, prev_ctoken, ctoken = subscriptions.with_open_db(
+            subscriptions._get_videos, 60, ctoken)
+        assert (prev_ctoken is None) == (not pages)
+        pages.append((videos, prev_ctoken))
+        if ctoken is None:
+            break
+    assert [len(videos) for videos, prev_ctoken in pages] == [60, 60, 30]
+    assert sum((videos for videos, prev_ctoken in pages), []) == all_videos
+
+    # malformed tokens give the first page
+    first_page = subscriptions.with_open_db(subscriptions._get_videos, 60)
+    for ctoken in ('b', 'bnan_1_2', 'x1_2_3', pages[1][1] + 'x'):
+        assert subscriptions.with_open_db(
+            subscriptions._get_videos, 60, ctoken) == first_page
+
+    # going back from the last page gives the same pages again
+    assert subscriptions.with_open_db(
+        subscriptions._get_videos, 60, pages[2][1])[0] == pages[1][0]
+    assert subscriptions.with_open_db(
+        subscriptions._get_videos, 60, pages[1][1])[0] == pages[0][0]
+
+    # the count is kept up to date once it's known
+    assert subscriptions.with_open_db(
+        subscriptions._get_feed_video_count) == 150
+    subscriptions._save_check_results([subscriptions.CheckResult(
+        'UCa', 'A', [make_video('UCa', 'UCa999', 2000),
+                     make_video('UCa', 'UCa000', 1000)], 5000, 1000)])
+    assert subscriptions.feed_video_counts == {None: 151}
+
+
+@pytest.mark.parametrize('time', [1.5e16, float('inf'), -1.0, 1000.25, 1000])
+def test_feed_ctoken_times(time):
+    ctoken = subscriptions._feed_ctoken('b', [None]*3 + [time] + [None]*3
+                                        + [time, 7])
+    match = subscriptions.FEED_CTOKEN_RE.fullmatch(ctoken)
+    assert [float(match.group(2)), float(match.group(3)),
+            int(match.group(4))] == [time, time, 7]
+
+
+def test_channel_check_skips_response_cache(monkeypatch):
+    from youtube import util
+    import io
+    import urllib3
+    calls = []
+
+    def fetch_url_response(url, *args, **kwargs):
+        calls.append(url)
+        response = urllib3.response.HTTPResponse(
+            body=io.BytesIO(b'page %d' % len(calls)), status=200,
+            preload_content=False)
+        return response, (lambda r: None)
+
+    monkeypatch.setattr(util, 'fetch_url_response', fetch_url_response)
+    monkeypatch.setattr(util, 'response_cache', util.ResponseCache(1024*1024))
+    # the channel page caches the response
+    assert subscriptions.channel.get_channel_first_page(
+        channel_id='UCa') == b'page 1'
+    # but checking the channel for new videos goes to YouTube
+    assert subscriptions._get_channel_videos_first_page(
+        'UCa', 'A') == b'page 2'
+    assert subscriptions.channel.get_channel_first_page(
+        channel_id='UCa') == b'page 2'
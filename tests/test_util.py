@@ -74,3 +74,339 @@ def test_exit_node_retry(monkeypatch, new_identities_till_success):
         with pytest.raises(util.FetchError) as excinfo:
             util.fetch_url('url')
         assert int(excinfo.value.code) == 429
+
+
+def test_single_flight():
+    import gevent
+    single_flight = util.SingleFlight()
+    calls = []
+
+    def slow_fetch(value):
+        calls.append(value)
+        gevent.sleep(0.01)
+        return value
+
+    tasks = [gevent.spawn(single_flight.do, 'key', slow_fetch, i)
+             for i in range(5)]
+    gevent.joinall(tasks)
+    assert calls == [0]
+    assert [task.value for task in tasks] == [0]*5
+    assert single_flight.shared_count == 4
+
+    # nothing is kept once the call is done
+    assert single_flight.do('key', slow_fetch, 7) == 7
+
+
+def test_single_flight_exception():
+    import gevent
+    single_flight = util.SingleFlight()
+
+    def failing_fetch():
+        gevent.sleep(0.01)
+        raise util.FetchError('429')
+
+    tasks = [gevent.spawn(single_flight.do, 'key', failing_fetch)
+             for i in range(3)]
+    gevent.joinall(tasks)
+    assert all(isinstance(task.exception, util.FetchError) for task in tasks)
+
+
+def test_response_cache(monkeypatch):
+    calls = []
+
+    def fetch_url_response(url, *args, **kwargs):
+        calls.append(url)
+        return MockResponse(body='result %d' % len(calls)), (lambda r: None)
+
+    monkeypatch.setattr(util, 'fetch_url_response', fetch_url_response)
+    monkeypatch.setattr(util, 'response_cache', util.ResponseCache(1024*1024))
+    assert util.fetch_url('url', debug_name='search_results') == b'result 1'
+    assert util.fetch_url('url', debug_name='search_results') == b'result 1'
+    assert util.fetch_url('url', data='body',
+                          debug_name='search_results') == b'result 2'
+    # not a cached endpoint
+    assert util.fetch_url('url', debug_name='watch') == b'result 3'
+    # refresh goes to the network and updates the cache
+    assert util.fetch_url('url', debug_name='search_results',
+                          refresh=True) == b'result 4'
+    assert util.fetch_url('url', debug_name='search_results') == b'result 4'
+    assert util.response_cache.hits == 2
+    assert util.response_cache.misses == 2
+
+
+def test_refresh_reaches_spawned_greenlets(monkeypatch):
+    import gevent
+    calls = []
+
+    def fetch_url_response(url, *args, **kwargs):
+        calls.append(url)
+        return MockResponse(body='result %d' % len(calls)), (lambda r: None)
+
+    monkeypatch.setattr(util, 'fetch_url_response', fetch_url_response)
+    monkeypatch.setattr(util, 'response_cache', util.ResponseCache(1024*1024))
+
+    def make_page(cache_control):
+        util.set_refresh_requested(cache_control)
+        try:
+            # like the comments or player fetched alongside a watch page
+            return gevent.spawn(util.fetch_url, 'url',
+                                debug_name='search_results').get()
+        finally:
+            util.clear_refresh_requested()
+
+    assert gevent.spawn(make_page, None).get() == b'result 1'
+    assert gevent.spawn(make_page, 'max-age=0').get() == b'result 2'
+    assert gevent.spawn(make_page, None).get() == b'result 2'
+    assert gevent.spawn(make_page, 'no-cache').get() == b'result 3'
+
+
+def test_response_cache_expiry_and_disk(tmp_path, monkeypatch):
+    cache = util.ResponseCache(1024*1024, str(tmp_path), 1024*1024)
+    key = util.ResponseCache.key('GET', 'url', None, 'channel_tab')
+    cache.put(key, b'content', 60)
+    cache.put('expired', b'old content', -1)
+    assert cache.get('expired') is None
+
+    reloaded = util.ResponseCache(1024*1024, str(tmp_path), 1024*1024)
+    assert reloaded.get(key) == b'content'
+    assert list(reloaded.disk_entries) == [key]
+
+
+def test_single_flight_abandoned():
+    import gevent
+    single_flight = util.SingleFlight()
+
+    def slow_fetch(value):
+        gevent.sleep(0.01)
+        return value
+
+    leader = gevent.spawn(single_flight.do, 'key', slow_fetch, 1)
+    follower = gevent.spawn(single_flight.do, 'key', slow_fetch, 2)
+    gevent.sleep(0)
+    leader.kill()
+    follower.join()
+    assert follower.value == 2
+
+
+def test_fetch_url_shares_exit_node_retry(monkeypatch):
+    import gevent
+    new_identity_state = NewIdentityState(1)
+    responses = []
+
+    def fetch_url_response(*args, **kwargs):
+        gevent.sleep(0.01)
+        response = new_identity_state.fetch_url_response()
+        responses.append(response[0].status)
+        return response
+
+    monkeypatch.setattr(settings, 'route_tor', 1)
+    monkeypatch.setattr(util, 'tor_manager', util.TorManager())
+    MockController.signal = new_identity_state.new_identity
+    monkeypatch.setattr(stem.control, 'Controller', MockController)
+    monkeypatch.setattr(util, 'fetch_url_response', fetch_url_response)
+    tasks = [gevent.spawn(util.fetch_url, 'url') for i in range(3)]
+    gevent.joinall(tasks, raise_error=True)
+    assert [task.value for task in tasks] == [b'success']*3
+    assert responses == [429, 200]
+    assert new_identity_state.new_identities_till_success == 0
+
+
+def test_cookies_through_redirects(monkeypatch):
+    import http.cookiejar
+
+    class MockPool:
+        def __init__(self):
+            self.requests = []
+
+        def request(self, method, url, headers=None, **kwargs):
+            self.requests.append((method, url, headers.get('Cookie')))
+            if len(self.requests) == 1:
+                return MockResponse(status=302, headers={
+                    'Location': '/next',
+                    'Set-Cookie': 'session=abc; Path=/',
+                })
+            return MockResponse()
+
+    pool = MockPool()
+    monkeypatch.setattr(util, 'get_pool', lambda *args: pool)
+    cookiejar = http.cookiejar.CookieJar()
+    response, cleanup_func = util.fetch_url_response(
+        'https://www.youtube.com/start', data='x',
+        cookiejar_send=cookiejar, cookiejar_receive=cookiejar)
+    assert response.final_url == 'https://www.youtube.com/next'
+    assert pool.requests == [
+        ('POST', 'https://www.youtube.com/start', None),
+        ('GET', 'https://www.youtube.com/next', 'session=abc'),
+    ]
+    assert [cookie.name for cookie in cookiejar] == ['session']
+
+
+def test_decode_content():
+    import brotli
+    import gzip
+    content = b'abc'*100000
+    assert util.decode_content(gzip.compress(content), 'gzip') == content
+    assert util.decode_content(brotli.compress(content), 'br') == content
+    assert util.decode_content(gzip.compress(content[:10])
+                               + gzip.compress(content[10:]),
+                               'gzip') == content
+    assert util.decode_content(content, 'identity') == content
+    with pytest.raises(EOFError):
+        util.decode_content(gzip.compress(content)[:-20], 'gzip')
+
+
+def test_fetch_url_decoded_size_limit(monkeypatch):
+    import gzip
+    body = gzip.compress(bytes(1024*1024))
+
+    def fetch_url_response(*args, **kwargs):
+        return (MockResponse(body=body, headers={'Content-Encoding': 'gzip'}),
+                (lambda r: None))
+
+    monkeypatch.setattr(util, 'fetch_url_response', fetch_url_response)
+    assert len(util.fetch_url('url')) == 1024*1024
+    assert b''.join(util.fetch_url_stream('url')) == bytes(1024*1024)
+    with pytest.raises(util.FetchError):
+        util.fetch_url('url', max_size=1000*1000)
+
+
+def test_tor_circuit_retired_on_429(monkeypatch):
+    monkeypatch.setattr(settings, 'route_tor', 1)
+    monkeypatch.setattr(settings, 'tor_circuits', 3)
+    monkeypatch.setattr(util, 'tor_manager', util.TorManager())
+    MockController.signal = lambda *args: pytest.fail('new identity used')
+    monkeypatch.setattr(stem.control, 'Controller', MockController)
+    circuits_used = []
+
+    def fetch_url_response(*args, tor_circuit=None, **kwargs):
+        circuits_used.append(tor_circuit)
+        if len(circuits_used) == 1:
+            return MockResponse(body=html429, status=429), (lambda r: None)
+        return MockResponse(), (lambda r: None)
+
+    monkeypatch.setattr(util, 'fetch_url_response', fetch_url_response)
+    monkeypatch.setattr(util.metrics, 'registry', [])
+    monkeypatch.setattr(util, 'fetch_responses', util.metrics.Counter(
+        'test_responses', '', ('endpoint', 'status')))
+    monkeypatch.setattr(util, 'tor_identity_changes', util.metrics.Counter(
+        'test_identity_changes', '', ('kind',)))
+    original_circuits = list(util.tor_manager.circuits)
+    assert util.fetch_url('url', debug_name='watch') == b'success'
+    assert util.fetch_responses.get('watch', 429) == 1
+    assert util.fetch_responses.get('watch', 200) == 1
+    assert util.tor_identity_changes.get('circuit') == 1
+    assert util.tor_identity_changes.get('newnym') is None
+    blocked_circuit = circuits_used[0]
+    assert blocked_circuit not in util.tor_manager.circuits
+    assert len(util.tor_manager.circuits) == 3
+    assert sum(circuit in original_circuits
+               for circuit in util.tor_manager.circuits) == 2
+    assert circuits_used[1] in util.tor_manager.circuits
+    assert len({circuit.credentials
+                for circuit in util.tor_manager.circuits}) == 3
+
+
+def test_first_tor_circuit_kept_on_spread_429(monkeypatch):
+    monkeypatch.setattr(settings, 'route_tor', 1)
+    monkeypatch.setattr(settings, 'tor_circuits', 3)
+    monkeypatch.setattr(util, 'tor_manager', util.TorManager())
+    monkeypatch.setattr(stem.control, 'Controller', MockController)
+    circuits_used = []
+
+    def fetch_url_response(*args, tor_circuit=None, **kwargs):
+        circuits_used.append(tor_circuit)
+        if len(circuits_used) <= 2:
+            return MockResponse(body=html429, status=429), (lambda r: None)
+        return MockResponse(), (lambda r: None)
+
+    monkeypatch.setattr(util, 'fetch_url_response', fetch_url_response)
+    first_circuit = util.tor_manager.circuits[0]
+    assert util.fetch_url('url', debug_name='search') == b'success'
+    assert first_circuit not in circuits_used
+    assert util.tor_manager.circuits[0] is first_circuit
+    assert not any(circuit in util.tor_manager.circuits
+                   for circuit in circuits_used[0:2])
+
+
+def test_pool_sizes(monkeypatch):
+    monkeypatch.setattr(settings, 'connection_pool_size', 10)
+    monkeypatch.setattr(settings, 'connection_pool_host_sizes',
+                        'www.youtube.com=16, ytimg.com=24, bad')
+    assert util.pool_size('www.youtube.com') == 16
+    assert util.pool_size('i.ytimg.com') == 24
+    assert util.pool_size('m.youtube.com') == 10
+    manager = util.SizedPoolManager()
+    pool = manager.connection_from_host('i.ytimg.com', 443, 'https')
+    assert pool.pool.maxsize == 24
+
+
+def test_deadline(monkeypatch):
+    import gevent
+    timeouts = []
+
+    def fetch_url_response(url, headers, timeout=15, **kwargs):
+        timeouts.append(timeout)
+        return MockResponse(), (lambda r: None)
+
+    monkeypatch.setattr(util, 'fetch_url_response', fetch_url_response)
+
+    def make_page():
+        util.set_deadline(10)
+        try:
+            # greenlets spawned for the page share its deadline
+            task = gevent.spawn(util.fetch_url, 'url')
+            task.join()
+            assert task.value == b'success'
+            assert util.have_time_for_optional_step()
+            util.set_deadline(2)
+            assert not util.have_time_for_optional_step()
+            util.set_deadline(-1)
+            with pytest.raises(util.FetchError) as excinfo:
+                util.fetch_url('url')
+            assert excinfo.value.code == '504'
+        finally:
+            util.clear_deadline()
+        assert util.time_remaining() is None
+
+    gevent.spawn(make_page).get()
+    assert len(timeouts) == 1 and 9 < timeouts[0] <= 10
+    util.fetch_url('url')
+    assert timeouts[1] == 15
+
+
+def test_shared_fetch_with_different_deadlines(monkeypatch):
+    import gevent
+    import socket
+    timeouts = []
+
+    def fetch_url_response(url, headers, timeout=15, **kwargs):
+        timeouts.append(timeout)
+        if len(timeouts) == 1:
+            gevent.sleep(timeout)
+            raise socket.timeout('timed out')
+        return MockResponse(), (lambda r: None)
+
+    monkeypatch.setattr(util, 'fetch_url_response', fetch_url_response)
+
+    def make_page(seconds):
+        util.set_deadline(seconds)
+        try:
+            return util.fetch_url('url')
+        finally:
+            util.clear_deadline()
+
+    leader = gevent.spawn(make_page, 0.2)
+    gevent.sleep(0)
+    follower = gevent.spawn(make_page, 10)
+    hurried = gevent.spawn(make_page, 0.05)
+    # doesn't wait for the leader past its own deadline
+    hurried.join(timeout=0.15)
+    assert isinstance(hurried.exception, util.FetchError)
+    assert hurried.exception.code == '504'
+    assert not leader.ready()
+
+    # the leader ran out of its time, but the follower has plenty left
+    gevent.joinall([leader, follower], timeout=5)
+    assert isinstance(leader.exception, socket.timeout)
+    assert follower.value == b'success'
+    assert len(timeouts) == 2 and timeouts[1] > 9
@@ -0,0 +1,131 @@
+from youtube import video_cache
+import pytest
+
+
+def test_range_set_merging():
+    ranges = video_cache.RangeSet()
+    assert ranges.add(10, 20) == 10
+    assert ranges.add(30, 40) == 10
+    assert ranges.add(15, 35) == 10     # only the gap is new
+    assert ranges.ranges == [[10, 40]]
+    assert ranges.add(40, 50) == 10     # touching intervals are joined
+    assert ranges.ranges == [[10, 50]]
+
+
+def test_range_set_plan():
+    ranges = video_cache.RangeSet([(10, 20), (30, 40)])
+    assert ranges.plan(0, 50) == [
+        (False, 0, 10), (True, 10, 20), (False, 20, 30),
+        (True, 30, 40), (False, 40, 50),
+    ]
+    assert ranges.plan(12, 18) == [(True, 12, 18)]
+    assert ranges.plan(20, 30) == [(False, 20, 30)]
+
+
+@pytest.mark.parametrize('query_string, expected', [
+    ('id=o-abc&itag=251&clen=1000&mime=audio%2Fwebm', ('o-abc', '251', 1000)),
+    ('id=o-abc&itag=251', None),
+    ('id=o-abc&itag=251&clen=notanumber', None),
+])
+def test_cache_key(query_string, expected):
+    assert video_cache.cache_key(query_string) == expected
+
+
+def test_cache_holes_and_persistence(tmp_path):
+    key = ('o-abc', '251', 100)
+    cache = video_cache.VideoCache(str(tmp_path), 1000)
+    cache.write(key, 10, b'a'*10)
+    cache.write(key, 50, b'b'*10)
+    cache.save(key)
+    entry, parts = cache.plan(key, 0, 99)
+    assert parts == [
+        (False, 0, 9), (True, 10, 19), (False, 20, 49),
+        (True, 50, 59), (False, 60, 99),
+    ]
+    assert b''.join(cache.read(entry, 50, 59)) == b'b'*10
+
+    reloaded = video_cache.VideoCache(str(tmp_path), 1000)
+    assert reloaded.total_bytes == 20
+    assert reloaded.plan(key, 10, 19)[1] == [(True, 10, 19)]
+
+
+def test_cache_lru_eviction(tmp_path):
+    cache = video_cache.VideoCache(str(tmp_path), 25)
+    first, second, third = [('id%d' % i, '18', 100) for i in range(3)]
+    cache.write(first, 0, b'x'*10)
+    cache.write(second, 0, b'x'*10)
+    cache.plan(first, 0, 9)    # first is now more recently used
+    cache.write(third, 0, b'x'*10)
+    assert list(cache.entries) == [first, third]
+    assert cache.total_bytes == 20
+
+
+def read_all(reader):
+    '''Returns what the cache.read generator returns and the bytes'''
+    parts = []
+    while True:
+        try:
+            parts.append(next(reader))
+        except StopIteration as e:
+            return e.value, b''.join(parts)
+
+
+def test_cache_entries_being_read_are_kept(tmp_path):
+    cache = video_cache.VideoCache(str(tmp_path), 25)
+    cache.READ_SIZE = 4
+    first, second, third = [('id%d' % i, '18', 100) for i in range(3)]
+    cache.write(first, 0, b'a'*10)
+    cache.write(second, 0, b'b'*10)
+
+    entry, parts = cache.plan(first, 0, 9)
+    assert parts == [(True, 0, 9)]
+    reader = cache.read(entry, 0, 9)
+    assert next(reader) == b'aaaa'
+    cache.write(third, 0, b'c'*10)     # second is evicted instead
+    assert list(cache.entries) == [first, third]
+    assert read_all(reader) == (True, b'a'*6)
+
+    # evicted between plan and read: a miss instead of an error
+    entry, parts = cache.plan(first, 0, 9)
+    cache.set_max_bytes(0)
+    assert not cache.entries
+    assert read_all(cache.read(entry, 0, 9)) == (False, b'')
+
+
+def test_cache_file_kept_open_while_used(tmp_path):
+    key = ('o-abc', '251', 100)
+    cache = video_cache.VideoCache(str(tmp_path), 1000)
+    cache.write(key, 0, b'a'*10)
+    entry = cache.entries[key]
+    f = entry.file
+    cache.write(key, 10, b'b'*10)
+    assert entry.file is f
+    cache.save(key)
+    assert entry.file is None and f.closed
+
+    # a reader keeps it open until it's done, writes in between are seen
+    entry, parts = cache.plan(key, 0, 19)
+    reader = cache.read(entry, 0, 19)
+    assert next(reader) == b'a'*10 + b'b'*10
+    cache.write(key, 20, b'c'*10)
+    cache.save(key)
+    assert entry.file is not None
+    assert read_all(reader) == (True, b'')
+    assert entry.file is None
+    assert b''.join(cache.read(entry, 15, 24)) == b'b'*5 + b'c'*5
+
+
+def test_cache_entry_larger_than_cache(tmp_path):
+    cache = video_cache.VideoCache(str(tmp_path), 25)
+    first, second, third = [('id%d' % i, '18', 100) for i in range(3)]
+    cache.write(first, 0, b'x'*30)
+    assert not cache.entries
+
+    cache.write(second, 0, b'x'*10)
+    cache.write(third, 0, b'x'*20)
+    assert list(cache.entries) == [third]
+    # the rest of third won't fit even with nothing else in the cache
+    cache.write(third, 20, b'x'*10)
+    cache.write(third, 10, b'x'*5)     # already cached, so it fits
+    assert cache.plan(third, 0, 99)[1] == [(True, 0, 19), (False, 20, 99)]
+    assert cache.total_bytes == 20
@@ -154,7 +154,22 @@ def post_process_comments_info(comments_info):
     )
 
 
+def skipped_comments_info(video_id, sort=0, lc=''):
+    '''For when the page ran out of time before the comments loaded'''
+    return {
+        'error': 'Comments were left out because YouTube is responding '
+                 'slowly. Use the link above to load them.',
+        'comment_links': [(
+            'Load comments',
+            util.URL_ORIGIN + '/comments?ctoken='
+            + make_comment_ctoken(video_id, sort=sort, lc=lc)
+        )],
+    }
+
+
 def video_comments(video_id, sort=0, offset=0, lc='', secret_key=''):
+    if settings.comments_mode and not util.have_time_for_optional_step():
+        return skipped_comments_info(video_id, sort, lc)
     try:
         if settings.comments_mode:
             comments_info = {'error': None}
@@ -0,0 +1,387 @@
+'''Optional HTTP/2 transport for YouTube's page and API hosts
+
+Concurrent requests to the same host are sent as streams over one TLS
+connection, instead of each taking a connection from the urllib3 pool, so
+the requests for a watch page (the page, player and comments) don't each pay
+for a handshake. Needs the h2 package; without it, or for hosts that don't
+offer HTTP/2, requests are made over HTTP/1.1 as before.
+'''
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+    have_h2 = True
+except ImportError:
+    have_h2 = False
+
+import collections
+import http.client
+import io
+import socket
+import ssl
+import time
+import urllib.parse
+
+import gevent
+import gevent.event
+import gevent.lock
+import gevent.queue
+import urllib3
+
+HOSTS = {'www.youtube.com', 'm.youtube.com', 'youtubei.googleapis.com'}
+
+READ_SIZE = 65536
+# How much the server may send on each stream, and on the whole connection,
+# before we have read it
+STREAM_WINDOW_SIZE = 1024*1024
+CONNECTION_WINDOW_SIZE = 16*1024*1024
+
+# Headers which are specific to HTTP/1.1 connections and not allowed in HTTP/2
+CONNECTION_HEADERS = {'connection', 'host', 'keep-alive', 'proxy-connection',
+                      'transfer-encoding', 'upgrade'}
+
+
+class StreamError(ConnectionError):
+    pass
+
+
+class HTTP2Unsupported(ConnectionError):
+    '''The host doesn't offer HTTP/2'''
+
+
+class ResponseBody(io.RawIOBase):
+    '''Body of the response on one stream, as a file object for
+    urllib3's HTTPResponse. Filled in by the connection's reader.'''
+
+    def __init__(self, connection, stream_id, timeout):
+        io.RawIOBase.__init__(self)
+        self.connection = connection
+        self.stream_id = stream_id
+        self.timeout = timeout
+        # (data, flow controlled length) pairs, then None at the end, or an
+        # exception if the stream failed
+        self.chunks = gevent.queue.Queue()
+        self.pending = memoryview(b'')
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.pending:
+            if self.finished:
+                return 0
+            try:
+                chunk = self.chunks.get(timeout=self.timeout)
+            except gevent.queue.Empty:
+                raise socket.timeout('Timed out reading HTTP/2 response')
+            if chunk is None:
+                self.finished = True
+                return 0
+            if isinstance(chunk, Exception):
+                self.finished = True
+                raise chunk
+            data, flow_controlled_length = chunk
+            self.connection.acknowledge(self.stream_id, flow_controlled_length)
+            self.pending = memoryview(data)
+        amount = min(len(buffer), len(self.pending))
+        buffer[0:amount] = self.pending[0:amount]
+        self.pending = self.pending[amount:]
+        return amount
+
+    def close(self):
+        if not self.finished:
+            self.finished = True
+            self.connection.reset_stream(self.stream_id)
+        io.RawIOBase.close(self)
+
+
+class HTTP2Connection:
+    '''A client HTTP/2 connection over sock, which must already be
+    connected, with TLS and h2 negotiated if needed. A reader greenlet
+    hands incoming frames to the streams waiting for them.'''
+
+    def __init__(self, sock, authority):
+        self.sock = sock
+        self.authority = authority
+        self.h2 = h2.connection.H2Connection(config=h2.config.H2Configuration(
+            client_side=True, header_encoding='utf-8'))
+        # guards both the h2 state machine and writes to the socket
+        self.lock = gevent.lock.RLock()
+        self.streams = {}   # stream_id -> (AsyncResult for headers, body)
+        self.window_updated = gevent.event.Event()
+        self.error = None
+        self.going_away = False
+        with self.lock:
+            self.h2.initiate_connection()
+            self.h2.update_settings({
+                h2.settings.SettingCodes.INITIAL_WINDOW_SIZE:
+                    STREAM_WINDOW_SIZE,
+            })
+            self.h2.increment_flow_control_window(
+                CONNECTION_WINDOW_SIZE - 65535)
+            self._flush()
+        self.reader = gevent.spawn(self._read_loop)
+
+    def is_usable(self):
+        return self.error is None and not self.going_away
+
+    def _flush(self):
+        data = self.h2.data_to_send()
+        if data:
+            self.sock.sendall(data)
+
+    def request(self, method, path, headers, body=None, timeout=15):
+        '''Sends a request on a new stream and returns an urllib3
+        HTTPResponse once the response headers have arrived'''
+        if self.error is not None:
+            raise self.error
+        request_headers = [
+            (':method', method),
+            (':authority', self.authority),
+            (':scheme', 'https'),
+            (':path', path),
+        ]
+        request_headers += [(name.lower(), value)
+                            for name, value in headers.items()
+                            if name.lower() not in CONNECTION_HEADERS]
+        headers_result = gevent.event.AsyncResult()
+        with self.lock:
+            stream_id = self.h2.get_next_available_stream_id()
+            response_body = ResponseBody(self, stream_id, timeout)
+            self.h2.send_headers(stream_id, request_headers,
+                                 end_stream=not body)
+            self.streams[stream_id] = (headers_result, response_body)
+            self._flush()
+        try:
+            if body:
+                self._send_body(stream_id, body, timeout)
+            status, response_headers = headers_result.get(timeout=timeout)
+        except gevent.Timeout:
+            self.reset_stream(stream_id)
+            raise socket.timeout('Timed out waiting for HTTP/2 response')
+        return urllib3.response.HTTPResponse(
+            body=response_body, headers=response_headers, status=status,
+            reason=http.client.responses.get(status, ''),
+            preload_content=False, decode_content=False)
+
+    def _send_body(self, stream_id, body, timeout):
+        view = memoryview(body)
+        while view:
+            with self.lock:
+                size = min(len(view), self.h2.max_outbound_frame_size,
+                           self.h2.local_flow_control_window(stream_id))
+                if size > 0:
+                    self.h2.send_data(stream_id, view[0:size].tobytes(),
+                                      end_stream=(size == len(view)))
+                    self._flush()
+                    view = view[size:]
+                    continue
+                self.window_updated.clear()
+            if not self.window_updated.wait(timeout):
+                raise gevent.Timeout()
+            if self.error is not None:
+                raise self.error
+
+    def acknowledge(self, stream_id, length):
+        '''Lets the server send length more bytes, since they were read'''
+        if self.error is not None or not length:
+            return
+        with self.lock:
+            self.h2.acknowledge_received_data(length, stream_id)
+            self._flush()
+
+    def reset_stream(self, stream_id):
+        with self.lock:
+            if self.streams.pop(stream_id, None) is None:
+                return
+            try:
+                self.h2.reset_stream(stream_id, h2.errors.ErrorCodes.CANCEL)
+                self._flush()
+            except (h2.exceptions.ProtocolError, OSError):
+                pass
+
+    def _read_loop(self):
+        try:
+            while True:
+                data = self.sock.recv(READ_SIZE)
+                if not data:
+                    raise ConnectionResetError(
+                        'HTTP/2 connection closed by server')
+                with self.lock:
+                    for event in self.h2.receive_data(data):
+                        self._handle_event(event)
+                    self._flush()
+        except Exception as e:
+            self._fail(e)
+        except gevent.GreenletExit:
+            self._fail(ConnectionAbortedError('HTTP/2 connection closed'))
+
+    def _handle_event(self, event):
+        if isinstance(event, (h2.events.WindowUpdated,
+                              h2.events.RemoteSettingsChanged)):
+            self.window_updated.set()
+            return
+        if isinstance(event, h2.events.ConnectionTerminated):
+            # streams up to last_stream_id will still be answered
+            self.going_away = True
+            error = StreamError('HTTP/2 connection closed by server (%s)'
+                                % event.error_code)
+            for stream_id in list(self.streams):
+                if stream_id > (event.last_stream_id or 0):
+                    self._fail_stream(stream_id, error)
+            return
+        stream = self.streams.get(getattr(event, 'stream_id', None))
+        if stream is None:
+            return
+        headers_result, response_body = stream
+        if isinstance(event, h2.events.ResponseReceived):
+            status = None
+            response_headers = urllib3._collections.HTTPHeaderDict()
+            for name, value in event.headers:
+                if name == ':status':
+                    status = int(value)
+                elif not name.startswith(':'):
+                    response_headers.add(name, value)
+            headers_result.set((status, response_headers))
+        elif isinstance(event, h2.events.DataReceived):
+            response_body.chunks.put(
+                (event.data, event.flow_controlled_length))
+        elif isinstance(event, h2.events.StreamEnded):
+            del self.streams[event.stream_id]
+            response_body.chunks.put(None)
+        elif isinstance(event, h2.events.StreamReset):
+            self._fail_stream(event.stream_id, StreamError(
+                'HTTP/2 stream reset by server (%s)' % event.error_code))
+
+    def _fail_stream(self, stream_id, error):
+        headers_result, response_body = self.streams.pop(stream_id)
+        if not headers_result.ready():
+            headers_result.set_exception(error)
+        response_body.chunks.put(error)
+
+    def _fail(self, error):
+        self.error = error
+        self.window_updated.set()
+        for stream_id in list(self.streams):
+            self._fail_stream(stream_id, error)
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def close(self):
+        self.reader.kill(block=False)
+        self._fail(ConnectionAbortedError('HTTP/2 connection closed'))
+
+
+def connect_tls(host, port, timeout, address=None):
+    '''Opens a TLS connection to host which has negotiated HTTP/2. If
+    address is given, connects to it instead of looking up host.'''
+    context = ssl.create_default_context()
+    context.set_alpn_protocols(['h2'])
+    sock = socket.create_connection(address or (host, port), timeout=timeout)
+    try:
+        sock = context.wrap_socket(sock, server_hostname=host)
+    except BaseException:
+        sock.close()
+        raise
+    if sock.selected_alpn_protocol() != 'h2':
+        sock.close()
+        raise HTTP2Unsupported(host + ' does not support HTTP/2')
+    # the reader waits for frames indefinitely; each stream has a timeout
+    sock.settimeout(None)
+    return sock
+
+
+class HTTP2Pool:
+    '''Keeps one HTTP/2 connection per host, shared by all requests to it'''
+
+    # how long to use HTTP/1.1 for a host after connecting with HTTP/2 failed
+    RETRY_AFTER = 10*60
+
+    def __init__(self, connect=connect_tls):
+        self.connect = connect
+        self.connections = {}
+        self.unavailable_until = {}
+        self.locks = collections.defaultdict(gevent.lock.Semaphore)
+
+    def get_connection(self, host, port, timeout):
+        '''Returns a usable connection to host, or None if HTTP/2 can't be
+        used for it right now. Only a host that doesn't offer HTTP/2 is left
+        alone for RETRY_AFTER; other connection errors may well not happen
+        again, so the next request tries again.'''
+        key = (host, port)
+        # so that concurrent first requests share one new connection
+        with self.locks[key]:
+            connection = self.connections.get(key)
+            if connection is not None:
+                if connection.is_usable():
+                    return connection
+                connection.close()
+                del self.connections[key]
+            if time.monotonic() < self.unavailable_until.get(key, 0):
+                return None
+            try:
+                sock = self.connect(host, port, timeout)
+            except HTTP2Unsupported as e:
+                print('Using HTTP/1.1 for %s: %s' % (host, e))
+                self.unavailable_until[key] = time.monotonic() + self.RETRY_AFTER
+                return None
+            except OSError as e:
+                print('Using HTTP/1.1 for this request to %s: %s' % (host, e))
+                return None
+            authority = host if port == 443 else '%s:%d' % (host, port)
+            connection = HTTP2Connection(sock, authority)
+            self.connections[key] = connection
+            return connection
+
+    def _drop(self, key, connection):
+        '''Stops using connection for new requests. Streams already on it
+        are left to finish, or have failed with it.'''
+        if self.connections.get(key) is connection:
+            del self.connections[key]
+
+    def request(self, method, url, headers, body=None, timeout=15):
+        '''Returns an urllib3 HTTPResponse with the response to the request,
+        or None if it should be made over HTTP/1.1 instead. That includes
+        when the connection or the stream fails before the response headers
+        arrive, such as on a stale connection or one the server is closing.
+
+        A stream that times out or is reset on its own doesn't affect the
+        others on its connection, so the connection is only given up when it
+        has failed or is going away.'''
+        url_parts = urllib.parse.urlsplit(url)
+        if url_parts.scheme != 'https':
+            return None
+        key = (url_parts.hostname, url_parts.port or 443)
+        connection = self.get_connection(*key, timeout)
+        if connection is None:
+            return None
+        path = url_parts.path or '/'
+        if url_parts.query:
+            path += '?' + url_parts.query
+        try:
+            response = connection.request(method, path, headers, body,
+                                          timeout)
+        except h2.exceptions.TooManyStreamsError:
+            return None
+        except h2.exceptions.ProtocolError as e:
+            print('HTTP/2 request to %s failed, using HTTP/1.1: %r'
+                  % (url_parts.hostname, e))
+            # the h2 state machine can't be trusted after this
+            self._drop(key, connection)
+            connection.close()
+            return None
+        except OSError as e:
+            # the stream has been reset already if it timed out
+            print('HTTP/2 request to %s failed, using HTTP/1.1: %r'
+                  % (url_parts.hostname, e))
+            if not connection.is_usable():
+                self._drop(key, connection)
+            return None
+        response.final_url = url
+        return response
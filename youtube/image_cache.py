@@ -0,0 +1,232 @@
+'''Persistent cache for proxied thumbnails and avatars
+
+Images are stored content-addressed: each distinct image is one file named by
+the sha256 of its bytes, and an index maps image urls to those files. The
+same avatar or thumbnail served under several urls is therefore only stored
+once, and the hash doubles as a strong ETag for the browser. Recently used
+images are also kept in memory.
+
+Avatars and some thumbnails can change under the same url, so the upstream
+ETag and Last-Modified of each url are kept too, and a url that hasn't been
+checked for REVALIDATE_AGE is revalidated with a conditional request.
+'''
+import settings
+
+import cachetools
+import collections
+import gevent
+import hashlib
+import json
+import os
+import time
+import traceback
+
+CachedImage = collections.namedtuple(
+    'CachedImage', ('content', 'content_type', 'etag'))
+
+
+class ImageCache:
+    '''Size-bounded LRU store of images, with an in-memory hot tier'''
+
+    # delay before writing out the url index after it changes, so that a page
+    # full of new thumbnails results in one write
+    INDEX_SAVE_DELAY = 30
+    # how long an image is used before checking upstream whether it changed
+    REVALIDATE_AGE = 24*3600
+
+    def __init__(self, directory, max_bytes, memory_bytes=16*1024*1024):
+        self.directory = directory
+        self.blob_directory = os.path.join(directory, 'blobs')
+        self.index_path = os.path.join(directory, 'index.json')
+        self.max_bytes = max_bytes
+        # url -> (hash, content_type, upstream etag, upstream last modified,
+        #         time last validated)
+        self.urls = {}
+        self.hash_urls = {}     # hash -> set of urls, to evict them with it
+        self.blobs = collections.OrderedDict()  # hash -> size, least recent first
+        self.total_bytes = 0
+        self.memory = cachetools.LRUCache(maxsize=memory_bytes, getsizeof=len)
+        self.save_greenlet = None
+        self._load()
+
+    def _load(self):
+        try:
+            names = os.listdir(self.blob_directory)
+        except FileNotFoundError:
+            names = []
+        blobs = []
+        for name in names:
+            if name.endswith('.tmp'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.blob_directory, name))
+            except OSError:
+                continue
+            blobs.append((stat.st_mtime, name, stat.st_size))
+        for mtime, name, size in sorted(blobs):
+            self.blobs[name] = size
+            self.total_bytes += size
+
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                urls = json.load(f)
+        except FileNotFoundError:
+            urls = {}
+        except (OSError, ValueError):
+            print('Warning: Ignoring corrupt image cache index')
+            urls = {}
+        for url, value in urls.items():
+            if value[0] not in self.blobs:
+                continue
+            if len(value) == 2:
+                # from before validators were kept; revalidate on next use
+                value = value + [None, None, 0]
+            self._set_url(url, tuple(value))
+        self.evict()
+
+    def _blob_path(self, content_hash):
+        return os.path.join(self.blob_directory, content_hash)
+
+    def _save_index(self):
+        self.save_greenlet = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = self.index_path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.urls, f)
+            os.replace(temp_path, self.index_path)
+        except OSError:
+            traceback.print_exc()
+
+    def _schedule_index_save(self):
+        if self.save_greenlet is None:
+            self.save_greenlet = gevent.spawn_later(self.INDEX_SAVE_DELAY,
+                                                    self._save_index)
+
+    def _set_url(self, url, value):
+        old_value = self.urls.get(url)
+        if old_value is not None and old_value[0] != value[0]:
+            self._forget_url(url)
+        self.urls[url] = value
+        self.hash_urls.setdefault(value[0], set()).add(url)
+
+    def _forget_url(self, url):
+        content_hash = self.urls.pop(url)[0]
+        urls = self.hash_urls[content_hash]
+        urls.discard(url)
+        if not urls:
+            del self.hash_urls[content_hash]
+
+    def get(self, url):
+        '''Returns a CachedImage, or None if url isn't cached'''
+        try:
+            content_hash, content_type = self.urls[url][0:2]
+        except KeyError:
+            return None
+        content = self.memory.get(content_hash)
+        if content is None:
+            try:
+                with open(self._blob_path(content_hash), 'rb') as f:
+                    content = f.read()
+            except OSError:
+                self._forget_url(url)
+                self._schedule_index_save()
+                return None
+            self.memory[content_hash] = content
+        if content_hash in self.blobs:
+            self.blobs.move_to_end(content_hash)
+        return CachedImage(content, content_type, '"' + content_hash + '"')
+
+    def revalidation_headers(self, url):
+        '''Returns None if the cached image for url was checked upstream
+        recently enough. Otherwise returns the headers to make the request
+        for it conditional with, which are empty if upstream gave no
+        validators.'''
+        try:
+            upstream_etag, last_modified, time_validated = self.urls[url][2:]
+        except KeyError:
+            return None
+        if time.time() - time_validated < self.REVALIDATE_AGE:
+            return None
+        headers = {}
+        if upstream_etag is not None:
+            headers['If-None-Match'] = upstream_etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def mark_validated(self, url):
+        '''Records that upstream said the image for url hasn't changed'''
+        value = self.urls.get(url)
+        if value is not None:
+            self.urls[url] = value[0:4] + (time.time(),)
+            self._schedule_index_save()
+
+    def put(self, url, content, content_type, upstream_etag=None,
+            last_modified=None):
+        '''Stores content as the image for url and returns a CachedImage.
+        upstream_etag and last_modified are the validators upstream sent
+        with it.'''
+        content_hash = hashlib.sha256(content).hexdigest()
+        if content_hash not in self.blobs:
+            try:
+                os.makedirs(self.blob_directory, exist_ok=True)
+                temp_path = self._blob_path(content_hash) + '.tmp'
+                with open(temp_path, 'wb') as f:
+                    f.write(content)
+                os.replace(temp_path, self._blob_path(content_hash))
+            except OSError:
+                traceback.print_exc()
+            else:
+                self.blobs[content_hash] = len(content)
+                self.total_bytes += len(content)
+        else:
+            self.blobs.move_to_end(content_hash)
+        self._set_url(url, (content_hash, content_type, upstream_etag,
+                            last_modified, time.time()))
+        self.memory[content_hash] = content
+        self._schedule_index_save()
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+        return CachedImage(content, content_type, '"' + content_hash + '"')
+
+    def evict(self):
+        '''Remove least recently used images until under max_bytes'''
+        evicted = False
+        while self.blobs and self.total_bytes > self.max_bytes:
+            content_hash, size = self.blobs.popitem(last=False)
+            self.total_bytes -= size
+            self.memory.pop(content_hash, None)
+            for url in self.hash_urls.pop(content_hash, ()):
+                del self.urls[url]
+            evicted = True
+            try:
+                os.remove(self._blob_path(content_hash))
+            except OSError:
+                pass
+        if evicted:
+            self._schedule_index_save()
+
+    def set_max_bytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.evict()
+
+
+cache_directory = os.path.join(settings.data_dir, 'image_cache')
+image_cache = None
+
+
+def set_cache_size(old_value=None, value=None):
+    global image_cache
+    if value is None:
+        value = settings.image_cache_size
+    if not value:
+        image_cache = None
+    elif image_cache is None:
+        image_cache = ImageCache(cache_directory, value*1024*1024)
+    else:
+        image_cache.set_max_bytes(value*1024*1024)
+
+
+set_cache_size()
+settings.add_setting_changed_hook('image_cache_size', set_cache_size)
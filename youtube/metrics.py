@@ -0,0 +1,123 @@
+'''Counters and histograms about the requests made to YouTube, served at
+/metrics in the Prometheus text format, so that it can be seen which
+endpoint is slow or failing.
+
+Metrics register themselves on creation. Values that are cheaper to read
+when asked for, like the state of the connection pools, are set in
+functions added with add_collector, which run before each render.
+'''
+import bisect
+
+# seconds; fetches time out after 15 by default
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   15, 30)
+
+registry = []
+collectors = []
+
+
+def add_collector(collector):
+    collectors.append(collector)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+def escape_label_value(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, escape_label_value(value))
+                          for name, value in pairs) + '}'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}    # tuple of label values -> value
+        registry.append(self)
+
+    def _key(self, label_values):
+        if len(label_values) != len(self.labelnames):
+            raise TypeError('%s takes labels %s, got %r'
+                            % (self.name, self.labelnames, label_values))
+        return tuple(str(value) for value in label_values)
+
+    def get(self, *label_values):
+        return self.values.get(self._key(label_values))
+
+    def clear(self):
+        self.values.clear()
+
+    def samples(self):
+        '''Generates (name, label pairs, value) for each sample'''
+        for key, value in sorted(self.values.items()):
+            yield self.name, list(zip(self.labelnames, key)), value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        key = self._key(label_values)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *label_values):
+        self.values[self._key(label_values)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(float(bucket) for bucket in buckets)
+
+    def observe(self, value, *label_values):
+        key = self._key(label_values)
+        entry = self.values.get(key)
+        if entry is None:
+            # [count in each bucket (not cumulative), sum]
+            entry = self.values[key] = [[0]*(len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for key, (counts, total) in sorted(self.values.items()):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield (self.name + '_bucket',
+                       labels + [('le', format_value(bound))], cumulative)
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+
+def render():
+    '''Returns all metrics in the Prometheus text exposition format'''
+    for collector in collectors:
+        collector()
+    lines = []
+    for metric in registry:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.type))
+        for name, labels, value in metric.samples():
+            lines.append('%s%s %s' % (name, format_labels(labels),
+                                      format_value(value)))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,199 @@
+'''DNS resolution for the direct connections made by the fetch layer
+
+Lookups go through a backend, either the system resolver run in gevent's
+thread pool or c-ares if settings.async_dns is on, and the results are cached
+so that a new connection to a recently used host doesn't wait for DNS.
+googlevideo hosts get a cache of their own, since there are many of them and
+each is only used for a short while; in a shared cache they would push out
+the few hosts that every page needs. Connections through Tor are resolved by
+Tor and don't use this.
+'''
+import settings
+
+import cachetools
+import socket
+import time
+
+import gevent.local
+import urllib3
+import urllib3.connection
+import urllib3.exceptions
+import urllib3.util.connection
+
+# gevent's c-ares binding doesn't report the TTLs of records, so entries are
+# kept for a fixed time, short enough to follow YouTube's DNS load balancing
+CACHE_TIME = 5*60
+GOOGLEVIDEO_CACHE_TIME = 60
+
+
+class Resolver:
+    def __init__(self, backend=None, cache=True):
+        # getaddrinfo-like function, None meaning socket.getaddrinfo
+        self.backend = backend
+        self.use_cache = cache
+        self.cache = cachetools.TTLCache(maxsize=256, ttl=CACHE_TIME)
+        self.googlevideo_cache = cachetools.TTLCache(
+            maxsize=2048, ttl=GOOGLEVIDEO_CACHE_TIME)
+        self.hits = 0
+        self.misses = 0
+        self.lookup_time = 0.0
+        # lookup and connect times of the current greenlet, for reporting
+        # with requests
+        self.local = gevent.local.local()
+
+    def _cache_for(self, host):
+        if host.endswith('.googlevideo.com'):
+            return self.googlevideo_cache
+        return self.cache
+
+    def resolve(self, host, port):
+        '''Returns a list of (family, socket address) to try connecting to'''
+        cache = self._cache_for(host)
+        key = (host, port)
+        if self.use_cache:
+            try:
+                addresses = cache[key]
+            except KeyError:
+                pass
+            else:
+                self.hits += 1
+                return addresses
+        self.misses += 1
+
+        start_time = time.monotonic()
+        getaddrinfo = self.backend or socket.getaddrinfo
+        try:
+            address_info = getaddrinfo(
+                host, port, urllib3.util.connection.allowed_gai_family(),
+                socket.SOCK_STREAM)
+        finally:
+            lookup_time = time.monotonic() - start_time
+            self.lookup_time += lookup_time
+            self.add_time('lookup_time', lookup_time)
+        addresses = [(family, address)
+                     for family, type, proto, name, address in address_info]
+        if self.use_cache:
+            cache[key] = addresses
+        return addresses
+
+    def invalidate(self, host, port):
+        self._cache_for(host).pop((host, port), None)
+
+    def add_time(self, kind, seconds):
+        setattr(self.local, kind, getattr(self.local, kind, 0) + seconds)
+
+    def take_time(self, kind):
+        '''Returns the time of the given kind the current greenlet spent
+        since the last call'''
+        seconds = getattr(self.local, kind, 0)
+        setattr(self.local, kind, 0)
+        return seconds
+
+    def take_lookup_time(self):
+        return self.take_time('lookup_time')
+
+    def take_connect_time(self):
+        '''Time spent opening connections, including TLS handshakes but not
+        lookups'''
+        return self.take_time('connect_time')
+
+
+def _make_backend():
+    if not settings.async_dns:
+        return None
+    try:
+        import gevent.resolver.ares
+    except ImportError:
+        print('Warning: c-ares is not available in this gevent build, '
+              'using the system resolver')
+        return None
+    return gevent.resolver.ares.Resolver().getaddrinfo
+
+
+resolver = Resolver(_make_backend(), settings.dns_cache)
+
+
+def _update_resolver(old_value, new_value):
+    resolver.backend = _make_backend()
+    resolver.use_cache = settings.dns_cache
+    resolver.cache.clear()
+    resolver.googlevideo_cache.clear()
+
+
+settings.add_setting_changed_hook('async_dns', _update_resolver)
+settings.add_setting_changed_hook('dns_cache', _update_resolver)
+
+
+class ResolvingConnectionMixin:
+    '''For urllib3 connections: looks up the host with resolver, instead of
+    urllib3 doing it for every new connection'''
+
+    def connect(self):
+        start_time = time.monotonic()
+        lookup_time = getattr(resolver.local, 'lookup_time', 0)
+        try:
+            super().connect()
+        finally:
+            lookup_time = (getattr(resolver.local, 'lookup_time', 0)
+                           - lookup_time)
+            resolver.add_time('connect_time',
+                              time.monotonic() - start_time - lookup_time)
+
+    def _new_conn(self):
+        try:
+            addresses = resolver.resolve(self._dns_host, self.port)
+        except OSError as e:
+            raise urllib3.exceptions.NewConnectionError(
+                self, 'Failed to establish a new connection: %s' % e)
+
+        error = None
+        for family, address in addresses:
+            sock = None
+            try:
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                for option in self.socket_options or ():
+                    sock.setsockopt(*option)
+                if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(self.timeout)
+                if self.source_address:
+                    sock.bind(self.source_address)
+                sock.connect(address)
+                return sock
+            except socket.timeout:
+                error = urllib3.exceptions.ConnectTimeoutError(
+                    self, 'Connection to %s timed out. (connect timeout=%s)'
+                    % (self.host, self.timeout))
+            except OSError as e:
+                error = urllib3.exceptions.NewConnectionError(
+                    self, 'Failed to establish a new connection: %s' % e)
+            if sock is not None:
+                sock.close()
+
+        # the addresses may be out of date
+        resolver.invalidate(self._dns_host, self.port)
+        raise error
+
+
+class ResolvingHTTPConnection(ResolvingConnectionMixin,
+                              urllib3.connection.HTTPConnection):
+    pass
+
+
+class ResolvingHTTPSConnection(ResolvingConnectionMixin,
+                               urllib3.connection.HTTPSConnection):
+    pass
+
+
+class ResolvingHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = ResolvingHTTPConnection
+
+
+class ResolvingHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = ResolvingHTTPSConnection
+
+
+# for PoolManager.pool_classes_by_scheme
+POOL_CLASSES = {
+    'http': ResolvingHTTPConnectionPool,
+    'https': ResolvingHTTPSConnectionPool,
+}
@@ -6,14 +6,18 @@ import sqlite3
 import os
 import time
 import gevent
+import gevent.event
+import gevent.lock
+import gevent.queue
 import json
 import traceback
 import contextlib
 import defusedxml.ElementTree
 import urllib
-import math
 import secrets
 import collections
+import heapq
+import itertools
 import calendar # bullshit! https://bugs.python.org/issue6280
 import csv
 import re
@@ -29,53 +33,172 @@ thumbnails_directory = os.path.join(settings.data_dir, "subscription_thumbnails"
 database_path = os.path.join(settings.data_dir, "subscriptions.sqlite")
 
 
-def open_database():
-    if not os.path.exists(settings.data_dir):
-        os.makedirs(settings.data_dir)
-    connection = sqlite3.connect(database_path, check_same_thread=False)
+def _create_tables(cursor):
+    '''The schema at version 1, which databases start from'''
+    cursor.execute('''CREATE TABLE IF NOT EXISTS subscribed_channels (
+                          id integer PRIMARY KEY,
+                          yt_channel_id text UNIQUE NOT NULL,
+                          channel_name text NOT NULL,
+                          time_last_checked integer DEFAULT 0,
+                          next_check_time integer DEFAULT 0,
+                          muted integer DEFAULT 0
+                      )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS videos (
+                          id integer PRIMARY KEY,
+                          sql_channel_id integer NOT NULL REFERENCES subscribed_channels(id) ON UPDATE CASCADE ON DELETE CASCADE,
+                          video_id text UNIQUE NOT NULL,
+                          title text NOT NULL,
+                          duration text,
+                          time_published integer NOT NULL,
+                          is_time_published_exact integer DEFAULT 0,
+                          time_noticed integer NOT NULL,
+                          description text,
+                          watched integer default 0
+                      )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS tag_associations (
+                          id integer PRIMARY KEY,
+                          tag text NOT NULL,
+                          sql_channel_id integer NOT NULL REFERENCES subscribed_channels(id) ON UPDATE CASCADE ON DELETE CASCADE,
+                          UNIQUE(tag, sql_channel_id)
+                      )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS db_info (
+                          version integer DEFAULT 1
+                      )''')
+
+
+def _add_indexes(cursor):
+    # The subscriptions feed, newest first. The rowid (videos.id) comes after
+    # the columns in every index, so this also orders videos noticed and
+    # published at the same time.
+    cursor.execute('''CREATE INDEX IF NOT EXISTS videos_time_noticed
+                      ON videos (time_noticed, time_published)''')
+    # The latest videos of a channel, when checking it. With video_id
+    # included, the index alone answers that query. Also used when deleting
+    # a channel's videos on unsubscribing.
+    cursor.execute('''CREATE INDEX IF NOT EXISTS videos_channel
+                      ON videos (sql_channel_id, time_published, video_id)''')
+    # The tags of a channel. Channels with a tag are found with the index
+    # from the UNIQUE(tag, sql_channel_id) constraint.
+    cursor.execute('''CREATE INDEX IF NOT EXISTS tag_associations_channel
+                      ON tag_associations (sql_channel_id, tag)''')
+    # statistics for the query planner, to choose between the indexes
+    cursor.execute('''ANALYZE''')
+
+
+# (version, function) pairs. Each function takes a cursor and changes the
+# schema from the previous version to its version. Add new ones at the end.
+migrations = [
+    (2, _add_indexes),
+]
+
+
+def schema_version():
+    return migrations[-1][0] if migrations else 1
+
+
+def _migrate(connection):
+    '''Creates the tables if needed and brings the schema up to date, going
+    by the version in db_info'''
+    with connection as cursor:
+        # explicitly, since sqlite3 doesn't begin transactions for DDL, and
+        # a migration should be done completely or not at all
+        cursor.execute('''BEGIN''')
+        _create_tables(cursor)
+        row = cursor.execute('''SELECT version FROM db_info''').fetchone()
+        if row is None:
+            cursor.execute('''INSERT INTO db_info (version) VALUES (1)''')
+            version = 1
+        else:
+            version = row[0]
+        if version > schema_version():
+            raise Exception('subscriptions.sqlite is from a newer version (schema version %d)' % version)
+        for migration_version, migrate in migrations:
+            if version < migration_version:
+                print('Updating subscriptions database to version %d' % migration_version)
+                migrate(cursor)
+                cursor.execute('''UPDATE db_info SET version = ?''', [migration_version])
+
+
+class ConnectionManager:
+    '''Keeps connections to the database open for reuse. A greenlet has a
+    connection to itself while it uses it, and gives it back afterwards for
+    the next greenlet, so connections are never shared but also aren't
+    opened for each use. Since they live on, sqlite3's cache of prepared
+    statements on each connection is reused as well.
+
+    The schema is created and migrated when the first connection is opened,
+    instead of on every use.'''
+
+    # connections kept open while not in use
+    MAX_IDLE = 4
+    # prepared statements cached by each connection, enough for every query
+    # in this file
+    CACHED_STATEMENTS = 256
+
+    def __init__(self, path):
+        self.path = path
+        self.idle = []
+        self.schema_ready = False
+        self.schema_lock = gevent.lock.BoundedSemaphore(1)
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        connection = sqlite3.connect(
+            self.path, check_same_thread=False,
+            cached_statements=self.CACHED_STATEMENTS)
+        try:
+            connection.execute('''PRAGMA foreign_keys = 1''')
+            # With write-ahead logging, readers (the subscriptions page) don't
+            # wait for writers, and a commit appends to the log instead of
+            # rewriting pages. synchronous = NORMAL syncs only at checkpoints
+            # rather than on every commit; in WAL mode this can't corrupt the
+            # database, though the last commits may be lost in a power failure.
+            connection.execute('''PRAGMA journal_mode = WAL''')
+            connection.execute('''PRAGMA synchronous = NORMAL''')
+            if not self.schema_ready:
+                with self.schema_lock:
+                    if not self.schema_ready:
+                        _migrate(connection)
+                        self.schema_ready = True
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self.idle.pop() if self.idle else self._connect()
+        try:
+            yield connection
+        finally:
+            if connection.in_transaction:
+                # left over from an error
+                connection.rollback()
+            if len(self.idle) < self.MAX_IDLE:
+                self.idle.append(connection)
+            else:
+                connection.close()
 
-    try:
-        cursor = connection.cursor()
-        cursor.execute('''PRAGMA foreign_keys = 1''')
-        # Create tables if they don't exist
-        cursor.execute('''CREATE TABLE IF NOT EXISTS subscribed_channels (
-                              id integer PRIMARY KEY,
-                              yt_channel_id text UNIQUE NOT NULL,
-                              channel_name text NOT NULL,
-                              time_last_checked integer DEFAULT 0,
-                              next_check_time integer DEFAULT 0,
-                              muted integer DEFAULT 0
-                          )''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS videos (
-                              id integer PRIMARY KEY,
-                              sql_channel_id integer NOT NULL REFERENCES subscribed_channels(id) ON UPDATE CASCADE ON DELETE CASCADE,
-                              video_id text UNIQUE NOT NULL,
-                              title text NOT NULL,
-                              duration text,
-                              time_published integer NOT NULL,
-                              is_time_published_exact integer DEFAULT 0,
-                              time_noticed integer NOT NULL,
-                              description text,
-                              watched integer default 0
-                          )''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS tag_associations (
-                              id integer PRIMARY KEY,
-                              tag text NOT NULL,
-                              sql_channel_id integer NOT NULL REFERENCES subscribed_channels(id) ON UPDATE CASCADE ON DELETE CASCADE,
-                              UNIQUE(tag, sql_channel_id)
-                          )''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS db_info (
-                              version integer DEFAULT 1
-                          )''')
-
-        connection.commit()
-    except:
-        connection.rollback()
-        connection.close()
-        raise
+    def close(self):
+        while self.idle:
+            self.idle.pop().close()
 
-    # https://stackoverflow.com/questions/19522505/using-sqlite3-in-python-with-with-keyword
-    return contextlib.closing(connection)
+
+connection_managers = {}
+
+
+def open_database():
+    '''Returns a context manager for a connection to the database, for use
+    as "with open_database() as connection:". Use "with connection" inside
+    it for a transaction.'''
+    try:
+        manager = connection_managers[database_path]
+    except KeyError:
+        manager = connection_managers[database_path] = ConnectionManager(
+            database_path)
+    return manager.connection()
 
 
 def with_open_db(function, *args, **kwargs):
@@ -147,38 +270,91 @@ def _unsubscribe(cursor, channel_ids):
 
     gevent.spawn(delete_thumbnails, to_delete)
     cursor.executemany("DELETE FROM subscribed_channels WHERE yt_channel_id=?", ((channel_id, ) for channel_id in channel_ids))
-
-
-def _get_videos(cursor, number_per_page, offset, tag=None):
-    '''Returns a full page of videos with an offset, and a value good enough to be used as the total number of videos'''
-    # We ask for the next 9 pages from the database
-    # Then the actual length of the results tell us if there are more than 9 pages left, and if not, how many there actually are
-    # This is done since there are only 9 page buttons on display at a time
-    # If there are more than 9 pages left, we give a fake value in place of the real number of results if the entire database was queried without limit
-    # This fake value is sufficient to get the page button generation macro to display 9 page buttons
-    # If we wish to display more buttons this logic must change
-    # We cannot use tricks with the sql id for the video since we frequently have filters and other restrictions in place on the results anyway
-    # TODO: This is probably not the ideal solution
+    feed_video_counts.clear()
+    for channel_id in channel_ids:
+        autocheck_scheduler.cancel(channel_id)
+        autocheck_scheduler.muted.discard(channel_id)
+
+
+# Continuation token for the page of the feed before (b) or after (a) a
+# video, given by its time_noticed, time_published and id. The times are
+# written with %r, since they can have fractions (see
+# youtube_timestamp_to_posix), so any repr of a float but nan is taken.
+FEED_CTOKEN_NUMBER = r'(-?(?:inf|\d+(?:\.\d*)?(?:e[-+]?\d+)?))'
+FEED_CTOKEN_RE = re.compile(r'([ab])%s_%s_(\d+)'
+                            % (FEED_CTOKEN_NUMBER, FEED_CTOKEN_NUMBER))
+
+
+def _feed_ctoken(direction, row):
+    time_published, time_noticed, sql_video_id = row[3], row[7], row[8]
+    return '%s%r_%r_%d' % (direction, time_noticed, time_published,
+                           sql_video_id)
+
+
+def _get_videos(cursor, number_per_page, ctoken=None, tag=None):
+    '''Returns a page of videos, newest first, and continuation tokens for
+    the previous and the next page, which are None if there isn't one.
+
+    Pages start from the (time_noticed, time_published, id) of the video at
+    their edge instead of an offset, so later pages are as quick to get as
+    the first one. The order is the same as the videos_time_noticed index.'''
+    direction = None
+    match = FEED_CTOKEN_RE.fullmatch(ctoken or '')
+    if match:
+        direction = match.group(1)
+        edge = [float(match.group(2)), float(match.group(3)),
+                int(match.group(4))]
+
+    statement = '''SELECT video_id, title, duration, time_published, is_time_published_exact, channel_name, yt_channel_id, time_noticed, videos.id
+                     FROM videos
+                     INNER JOIN subscribed_channels on videos.sql_channel_id = subscribed_channels.id
+                  '''
+    parameters = []
     if tag is not None:
-        db_videos = cursor.execute('''SELECT video_id, title, duration, time_published, is_time_published_exact, channel_name, yt_channel_id
-                                      FROM videos
-                                      INNER JOIN subscribed_channels on videos.sql_channel_id = subscribed_channels.id
-                                      INNER JOIN tag_associations on videos.sql_channel_id = tag_associations.sql_channel_id
-                                      WHERE tag = ? AND muted = 0
-                                      ORDER BY time_noticed DESC, time_published DESC
-                                      LIMIT ? OFFSET ?''', (tag, number_per_page*9, offset)).fetchall()
+        statement += '''INNER JOIN tag_associations on videos.sql_channel_id = tag_associations.sql_channel_id
+                          WHERE tag = ? AND muted = 0
+                       '''
+        parameters.append(tag)
     else:
-        db_videos = cursor.execute('''SELECT video_id, title, duration, time_published, is_time_published_exact, channel_name, yt_channel_id
-                                      FROM videos
-                                      INNER JOIN subscribed_channels on videos.sql_channel_id = subscribed_channels.id
-                                      WHERE muted = 0
-                                      ORDER BY time_noticed DESC, time_published DESC
-                                      LIMIT ? OFFSET ?''', (number_per_page*9, offset)).fetchall()
-
-    pseudo_number_of_videos = offset + len(db_videos)
+        statement += '''WHERE muted = 0
+                       '''
+    if direction == 'b':
+        statement += '''AND (time_noticed, time_published, videos.id) < (?, ?, ?)
+                          ORDER BY time_noticed DESC, time_published DESC, videos.id DESC
+                       '''
+        parameters += edge
+    elif direction == 'a':
+        statement += '''AND (time_noticed, time_published, videos.id) > (?, ?, ?)
+                          ORDER BY time_noticed, time_published, videos.id
+                       '''
+        parameters += edge
+    else:
+        statement += '''ORDER BY time_noticed DESC, time_published DESC, videos.id DESC
+                       '''
+    # one more than a page, to know whether there is another page after it
+    statement += '''LIMIT ?'''
+    parameters.append(number_per_page + 1)
+    db_videos = cursor.execute(statement, parameters).fetchall()
+
+    if direction == 'a':
+        if len(db_videos) <= number_per_page:
+            # back to the newest videos
+            return _get_videos(cursor, number_per_page, None, tag)
+        db_videos = db_videos[number_per_page-1::-1]
+        prev_ctoken = _feed_ctoken('a', db_videos[0])
+        next_ctoken = _feed_ctoken('b', db_videos[-1])
+    else:
+        has_next_page = len(db_videos) > number_per_page
+        db_videos = db_videos[0:number_per_page]
+        prev_ctoken = None
+        if direction == 'b' and db_videos:
+            prev_ctoken = _feed_ctoken('a', db_videos[0])
+        next_ctoken = None
+        if has_next_page:
+            next_ctoken = _feed_ctoken('b', db_videos[-1])
 
     videos = []
-    for db_video in db_videos[0:number_per_page]:
+    for db_video in db_videos:
         videos.append({
             'id':   db_video[0],
             'title':    db_video[1],
@@ -189,7 +365,41 @@ def _get_videos(cursor, number_per_page, offset, tag=None):
             'author_url': '/https://www.youtube.com/channel/' + db_video[6],
         })
 
-    return videos, pseudo_number_of_videos
+    return videos, prev_ctoken, next_ctoken
+
+
+# tag (None for all videos) -> number of videos in the feed for it. Counted
+# when first needed, then kept up to date as videos are added. Cleared when
+# channels are muted, unmuted, unsubscribed from or tagged, rather than
+# working out the change.
+feed_video_counts = {}
+
+
+def _get_feed_video_count(cursor, tag=None):
+    try:
+        return feed_video_counts[tag]
+    except KeyError:
+        pass
+    if tag is None:
+        count = cursor.execute('''SELECT COUNT(*)
+                                  FROM videos
+                                  INNER JOIN subscribed_channels on videos.sql_channel_id = subscribed_channels.id
+                                  WHERE muted = 0''').fetchone()[0]
+    else:
+        count = cursor.execute('''SELECT COUNT(*)
+                                  FROM videos
+                                  INNER JOIN subscribed_channels on videos.sql_channel_id = subscribed_channels.id
+                                  INNER JOIN tag_associations on videos.sql_channel_id = tag_associations.sql_channel_id
+                                  WHERE tag = ? AND muted = 0''', [tag]).fetchone()[0]
+    feed_video_counts[tag] = count
+    return count
+
+
+def _count_new_videos(cursor, channel_id, number_of_videos):
+    '''Adds newly stored videos of a channel to feed_video_counts'''
+    for tag in [None] + _get_tags(cursor, channel_id):
+        if tag in feed_video_counts:
+            feed_video_counts[tag] += number_of_videos
 
 
 def _get_subscribed_channels(cursor):
@@ -263,8 +473,15 @@ def _schedule_checking(cursor, channel_id, next_check_time):
     cursor.execute('''UPDATE subscribed_channels SET next_check_time = ? WHERE yt_channel_id = ?''', [int(next_check_time), channel_id])
 
 
-def _is_muted(cursor, channel_id):
-    return bool(cursor.execute('''SELECT muted FROM subscribed_channels WHERE yt_channel_id=?''', [channel_id]).fetchone()[0])
+def _next_check_time(cursor, channel_id):
+    '''The time the channel is scheduled to be checked at, or a random time
+    within the next hour if that has passed'''
+    row = cursor.execute('''SELECT next_check_time FROM subscribed_channels WHERE yt_channel_id=?''', [channel_id]).fetchone()
+    if row is None or row[0] is None or row[0] < time.time():
+        next_check_time = random_check_time_within_hour()
+        _schedule_checking(cursor, channel_id, next_check_time)
+        return next_check_time
+    return row[0]
 
 
 units = collections.OrderedDict([
@@ -347,78 +564,168 @@ def check_channel_worker():
 
 for i in range(0, 5):
     gevent.spawn(check_channel_worker)
-# ----------------------------
 
 
-# --- Auto checking system - Spaghetti code ---
-def autocheck_dispatcher():
-    '''Scans the auto_check_list. Sleeps until the earliest job is due, then adds that channel to the checking queue above. Can be sent a new job through autocheck_job_application'''
-    while True:
-        if len(autocheck_jobs) == 0:
-            new_job = autocheck_job_application.get()
-            autocheck_jobs.append(new_job)
-        else:
-            earliest_job_index = min(range(0, len(autocheck_jobs)), key=lambda index: autocheck_jobs[index]['next_check_time']) # https://stackoverflow.com/a/11825864
-            earliest_job = autocheck_jobs[earliest_job_index]
-            time_until_earliest_job = earliest_job['next_check_time'] - time.time()
-
-            if time_until_earliest_job <= -5:   # should not happen unless we're running extremely slow
-                print('ERROR: autocheck_dispatcher got job scheduled in the past, skipping and rescheduling: ' + earliest_job['channel_id'] + ', ' + earliest_job['channel_name'] + ', ' + str(earliest_job['next_check_time']))
-                next_check_time = time.time() + 3600*secrets.randbelow(60)/60
-                with_open_db(_schedule_checking, earliest_job['channel_id'], next_check_time)
-                autocheck_jobs[earliest_job_index]['next_check_time'] = next_check_time
-                continue
+# Results of channel checks, waiting for check_results_writer
+CheckResult = collections.namedtuple('CheckResult', [
+    'channel_id', 'channel_status_name', 'videos', 'next_check_time',
+    'time_retrieved'])
+check_results_queue = gevent.queue.Queue()
+# Most results committed in one transaction, and how long to wait for more
+# results to arrive after the first one of a batch
+CHECK_RESULTS_BATCH_SIZE = 200
+CHECK_RESULTS_BATCH_TIME = 0.5
+# ----------------------------
 
-            # make sure it's not muted
-            if with_open_db(_is_muted, earliest_job['channel_id']):
-                del autocheck_jobs[earliest_job_index]
-                continue
 
-            if time_until_earliest_job > 0: # it can become less than zero (in the past) when it's set to go off while the dispatcher is doing something else at that moment
-                try:
-                    new_job = autocheck_job_application.get(timeout=time_until_earliest_job)  # sleep for time_until_earliest_job time, but allow to be interrupted by new jobs
-                except gevent.queue.Empty: # no new jobs
-                    pass
-                else: # new job, add it to the list
-                    autocheck_jobs.append(new_job)
-                    continue
+# --- Auto checking system ---
+class AutocheckScheduler:
+    '''Keeps when each channel is next due to be checked, in a heap ordered
+    by that time, so that finding the next channel, adding one, rescheduling
+    one or cancelling one takes O(log n) with tens of thousands of channels.
+
+    Rescheduling or cancelling a channel doesn't search the heap for its
+    entry; the entry is marked as cancelled and skipped when it reaches the
+    top. The heap is rebuilt when cancelled entries outnumber the live ones.
+
+    Which channels are muted is kept here too, so the dispatcher doesn't need
+    the database to know not to check them.'''
+
+    def __init__(self):
+        self.heap = []      # [next_check_time, sequence number, channel_id]
+        self.entries = {}   # channel_id -> its live entry in heap
+        self.sequence = itertools.count()
+        self.muted = set()
+        # set when the earliest job changes, to wake up the dispatcher
+        self.changed = gevent.event.Event()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def schedule(self, channel_id, next_check_time):
+        '''Adds a job for channel_id, replacing its current one if any.
+        Does nothing if the channel is muted.'''
+        if channel_id in self.muted:
+            return
+        self._remove(channel_id)
+        entry = [next_check_time, next(self.sequence), channel_id]
+        self.entries[channel_id] = entry
+        heapq.heappush(self.heap, entry)
+        # rescheduling leaves the old entry behind
+        self._compact()
+        if self.heap[0] is entry:
+            self.changed.set()
+
+    def cancel(self, channel_id):
+        self._remove(channel_id)
+        self._compact()
+
+    def _remove(self, channel_id):
+        entry = self.entries.pop(channel_id, None)
+        if entry is not None:
+            entry[2] = None
+
+    def _compact(self):
+        if len(self.heap) > 2*len(self.entries) + 64:
+            self.heap = list(self.entries.values())
+            heapq.heapify(self.heap)
+
+    def _drop_cancelled(self):
+        while self.heap and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+
+    def next_check_time(self):
+        '''Returns the time of the earliest job, or None if there are none'''
+        self._drop_cancelled()
+        return self.heap[0][0] if self.heap else None
+
+    def pop(self):
+        '''Removes the earliest job and returns its channel_id'''
+        self._drop_cancelled()
+        next_check_time, sequence, channel_id = heapq.heappop(self.heap)
+        del self.entries[channel_id]
+        return channel_id
+
+    def mute(self, channel_ids):
+        for channel_id in channel_ids:
+            self.muted.add(channel_id)
+            self._remove(channel_id)
+        self._compact()
+
+    def unmute(self, channel_ids, next_check_time):
+        for channel_id in channel_ids:
+            if channel_id in self.muted:
+                self.muted.remove(channel_id)
+                self.schedule(channel_id, next_check_time(channel_id))
+
+    def clear(self):
+        self.heap = []
+        self.entries.clear()
+        self.muted.clear()
+        self.changed.set()
+
+
+autocheck_scheduler = AutocheckScheduler()
+
+
+def random_check_time_within_hour():
+    return time.time() + 3600*secrets.randbelow(60)/60
+
 
-            # no new jobs, time to execute the earliest job
-            channel_names[earliest_job['channel_id']] = earliest_job['channel_name']
-            checking_channels.add(earliest_job['channel_id'])
-            check_channels_queue.put(earliest_job['channel_id'])
-            del autocheck_jobs[earliest_job_index]
+def autocheck_dispatcher():
+    '''Sleeps until the earliest job in autocheck_scheduler is due, then adds
+    that channel to the checking queue above. Wakes up early if an earlier
+    job is added.'''
+    while True:
+        autocheck_scheduler.changed.clear()
+        next_check_time = autocheck_scheduler.next_check_time()
+        if next_check_time is None:
+            autocheck_scheduler.changed.wait()
+            continue
+
+        time_until_earliest_job = next_check_time - time.time()
+        if time_until_earliest_job > 0:
+            # it can become less than zero (in the past) when it's set to go
+            # off while the dispatcher is doing something else at that moment
+            autocheck_scheduler.changed.wait(timeout=time_until_earliest_job)
+            continue
+
+        channel_id = autocheck_scheduler.pop()
+        if time_until_earliest_job <= -5:   # should not happen unless we're running extremely slow
+            print('ERROR: autocheck_dispatcher got job scheduled in the past, skipping and rescheduling: ' + channel_id + ', ' + channel_names.get(channel_id, '') + ', ' + str(next_check_time))
+            next_check_time = random_check_time_within_hour()
+            with_open_db(_schedule_checking, channel_id, next_check_time)
+            autocheck_scheduler.schedule(channel_id, next_check_time)
+            continue
+
+        checking_channels.add(channel_id)
+        check_channels_queue.put(channel_id)
 
 
 dispatcher_greenlet = None
 
 
 def start_autocheck_system():
-    global autocheck_job_application
-    global autocheck_jobs
     global dispatcher_greenlet
 
-    # job application format: dict with keys (channel_id, channel_name, next_check_time)
-    autocheck_job_application = gevent.queue.Queue() # only really meant to hold 1 item, just reusing gevent's wait and timeout machinery
-
-    autocheck_jobs = [] # list of dicts with the keys (channel_id, channel_name, next_check_time). Stores all the channels that need to be autochecked and when to check them
+    autocheck_scheduler.clear()
     with open_database() as connection:
         with connection as cursor:
             now = time.time()
-            for row in cursor.execute('''SELECT yt_channel_id, channel_name, next_check_time FROM subscribed_channels WHERE muted != 1''').fetchall():
-
-                if row[2] is None:
-                    next_check_time = 0
-                else:
-                    next_check_time = row[2]
+            for channel_id, channel_name, next_check_time, muted in cursor.execute(
+                    '''SELECT yt_channel_id, channel_name, next_check_time, muted
+                       FROM subscribed_channels''').fetchall():
+                if muted:
+                    autocheck_scheduler.muted.add(channel_id)
+                    continue
 
                 # expired, check randomly within the next hour
-                # note: even if it isn't scheduled in the past right now, it might end up being if it's due soon and we dont start dispatching by then, see below where time_until_earliest_job is negative
-                if next_check_time < now:
-                    next_check_time = now + 3600*secrets.randbelow(60)/60
-                    row = (row[0], row[1], next_check_time)
-                    _schedule_checking(cursor, row[0], next_check_time)
-                autocheck_jobs.append({'channel_id': row[0], 'channel_name': row[1], 'next_check_time': next_check_time})
+                # note: even if it isn't scheduled in the past right now, it might end up being if it's due soon and we dont start dispatching by then, see autocheck_dispatcher
+                if next_check_time is None or next_check_time < now:
+                    next_check_time = random_check_time_within_hour()
+                    _schedule_checking(cursor, channel_id, next_check_time)
+                channel_names[channel_id] = channel_name
+                autocheck_scheduler.schedule(channel_id, next_check_time)
     dispatcher_greenlet = gevent.spawn(autocheck_dispatcher)
 
 
@@ -463,7 +770,10 @@ def _get_atoma_feed(channel_id):
 
 def _get_channel_videos_first_page(channel_id, channel_status_name):
     try:
-        return channel.get_channel_first_page(channel_id=channel_id)
+        # a check is for new uploads, so don't use the response cache, but
+        # update it for the channel page
+        return channel.get_channel_first_page(channel_id=channel_id,
+                                              refresh=True)
     except util.FetchError as e:
         if e.code == '429' and settings.route_tor:
             error_message = ('Error checking channel ' + channel_status_name
@@ -575,80 +885,143 @@ def _get_upstream_videos(channel_id):
     next_check_delay = randomized_upload_period/10    # check at 10x the channel posting rate. might want to fine tune this number
     next_check_time = int(time.time() + next_check_delay)
 
+    check_results_queue.put(CheckResult(
+        channel_id, channel_status_name, videos, next_check_time,
+        int(time.time())))
+
+
+def _save_check_result(cursor, result):
+    '''Adds the videos from a channel check to the database. Returns the
+    number of new videos, or None if the channel was unsubscribed from
+    while it was being checked.'''
+    channel_id = result.channel_id
+    videos = result.videos
+
+    # calculate how many new videos there are
+    existing_vids = set(row[0] for row in cursor.execute(
+        '''SELECT video_id
+           FROM videos
+           INNER JOIN subscribed_channels
+               ON videos.sql_channel_id = subscribed_channels.id
+           WHERE yt_channel_id=?
+           ORDER BY time_published DESC
+           LIMIT 30''', [channel_id]).fetchall())
+
+    # new videos the channel has uploaded since last time we checked
+    number_of_new_videos = 0
+    for video in videos:
+        if video['id'] in existing_vids:
+            break
+        number_of_new_videos += 1
+
+    row = cursor.execute('''SELECT time_last_checked, muted FROM subscribed_channels WHERE yt_channel_id=?''', [channel_id]).fetchone()
+    if row is None:     # unsubscribed while being checked
+        return None
+    is_first_check = row[0] in (None, 0)
+    muted = row[1]
+    rows = []
+    for i, video_item in enumerate(videos):
+        if (is_first_check
+                or number_of_new_videos > 6
+                or i >= number_of_new_videos):
+            # don't want a crazy ordering on first check or check in a long time, since we're ordering by time_noticed
+            # Last condition is for when the channel deleting videos
+            # causes new videos to appear at the end of the backlog.
+            # For instance, if we have 30 vids in the DB, and 1 vid
+            # that we previously saw has since been deleted,
+            # then a video we haven't seen before will appear as the
+            # 30th. Don't want this to be considered a newly noticed
+            # vid which would appear at top of subscriptions feed
+            time_noticed = video_item['time_published']
+        else:
+            time_noticed = result.time_retrieved
+        rows.append((
+            video_item['channel_id'],
+            video_item['id'],
+            video_item['title'],
+            video_item['duration'],
+            video_item['time_published'],
+            video_item['is_time_published_exact'],
+            time_noticed,
+            video_item['description'],
+        ))
+
+    inserted = cursor.executemany('''INSERT OR IGNORE INTO videos (
+                              sql_channel_id,
+                              video_id,
+                              title,
+                              duration,
+                              time_published,
+                              is_time_published_exact,
+                              time_noticed,
+                              description
+                          )
+                          VALUES ((SELECT id FROM subscribed_channels WHERE yt_channel_id=?), ?, ?, ?, ?, ?, ?, ?)''', rows)
+    cursor.execute('''UPDATE subscribed_channels
+                      SET time_last_checked = ?, next_check_time = ?
+                      WHERE yt_channel_id=?''', [result.time_retrieved, result.next_check_time, channel_id])
+    if not muted and inserted.rowcount > 0:
+        _count_new_videos(cursor, channel_id, inserted.rowcount)
+    return number_of_new_videos
+
+
+def _save_check_results(results):
+    '''Saves a batch of check results in one transaction'''
+    new_video_counts = []
     with open_database() as connection:
         with connection as cursor:
+            # an explicit transaction, so that releasing the savepoints below
+            # doesn't commit
+            cursor.execute('''BEGIN''')
+            for result in results:
+                # so that an error in one result doesn't lose the others
+                cursor.execute('''SAVEPOINT check_result''')
+                try:
+                    new_video_counts.append(_save_check_result(cursor, result))
+                except Exception:
+                    cursor.execute('''ROLLBACK TO check_result''')
+                    print('Error saving videos from ' + result.channel_status_name)
+                    traceback.print_exc()
+                    new_video_counts.append(None)
+                cursor.execute('''RELEASE check_result''')
+
+    for result, number_of_new_videos in zip(results, new_video_counts):
+        # failed to save, or unsubscribed from, so don't check it again
+        if number_of_new_videos is None:
+            continue
+        if settings.autocheck_subscriptions:
+            autocheck_scheduler.schedule(result.channel_id,
+                                         result.next_check_time)
+
+        if number_of_new_videos == 0:
+            print('No new videos from ' + result.channel_status_name)
+        elif number_of_new_videos == 1:
+            print('1 new video from ' + result.channel_status_name)
+        else:
+            print(str(number_of_new_videos) + ' new videos from ' + result.channel_status_name)
 
-            # calculate how many new videos there are
-            existing_vids = set(row[0] for row in cursor.execute(
-                '''SELECT video_id
-                   FROM videos
-                   INNER JOIN subscribed_channels
-                       ON videos.sql_channel_id = subscribed_channels.id
-                   WHERE yt_channel_id=?
-                   ORDER BY time_published DESC
-                   LIMIT 30''', [channel_id]).fetchall())
-
-            # new videos the channel has uploaded since last time we checked
-            number_of_new_videos = 0
-            for video in videos:
-                if video['id'] in existing_vids:
-                    break
-                number_of_new_videos += 1
-
-            is_first_check = cursor.execute('''SELECT time_last_checked FROM subscribed_channels WHERE yt_channel_id=?''', [channel_id]).fetchone()[0] in (None, 0)
-            time_videos_retrieved = int(time.time())
-            rows = []
-            for i, video_item in enumerate(videos):
-                if (is_first_check
-                        or number_of_new_videos > 6
-                        or i >= number_of_new_videos):
-                    # don't want a crazy ordering on first check or check in a long time, since we're ordering by time_noticed
-                    # Last condition is for when the channel deleting videos
-                    # causes new videos to appear at the end of the backlog.
-                    # For instance, if we have 30 vids in the DB, and 1 vid
-                    # that we previously saw has since been deleted,
-                    # then a video we haven't seen before will appear as the
-                    # 30th. Don't want this to be considered a newly noticed
-                    # vid which would appear at top of subscriptions feed
-                    time_noticed = video_item['time_published']
-                else:
-                    time_noticed = time_videos_retrieved
-                rows.append((
-                    video_item['channel_id'],
-                    video_item['id'],
-                    video_item['title'],
-                    video_item['duration'],
-                    video_item['time_published'],
-                    video_item['is_time_published_exact'],
-                    time_noticed,
-                    video_item['description'],
-                ))
-
-            cursor.executemany('''INSERT OR IGNORE INTO videos (
-                                      sql_channel_id,
-                                      video_id,
-                                      title,
-                                      duration,
-                                      time_published,
-                                      is_time_published_exact,
-                                      time_noticed,
-                                      description
-                                  )
-                                  VALUES ((SELECT id FROM subscribed_channels WHERE yt_channel_id=?), ?, ?, ?, ?, ?, ?, ?)''', rows)
-            cursor.execute('''UPDATE subscribed_channels
-                              SET time_last_checked = ?, next_check_time = ?
-                              WHERE yt_channel_id=?''', [int(time.time()), next_check_time, channel_id])
-
-            if settings.autocheck_subscriptions:
-                if not _is_muted(cursor, channel_id):
-                    autocheck_job_application.put({'channel_id': channel_id, 'channel_name': channel_names[channel_id], 'next_check_time': next_check_time})
-
-    if number_of_new_videos == 0:
-        print('No new videos from ' + channel_status_name)
-    elif number_of_new_videos == 1:
-        print('1 new video from ' + channel_status_name)
-    else:
-        print(str(number_of_new_videos) + ' new videos from ' + channel_status_name)
+
+def check_results_writer():
+    '''Writes the results of channel checks to the database. The only
+    writer of check results, so the checking workers don't contend for the
+    database, and results arriving close together are committed together
+    instead of paying for a sync each.'''
+    while True:
+        results = [check_results_queue.get()]
+        batch_deadline = time.monotonic() + CHECK_RESULTS_BATCH_TIME
+        while len(results) < CHECK_RESULTS_BATCH_SIZE:
+            try:
+                results.append(check_results_queue.get(
+                    timeout=max(batch_deadline - time.monotonic(), 0)))
+            except gevent.queue.Empty:
+                break
+        try:
+            _save_check_results(results)
+        except Exception:
+            traceback.print_exc()
+
+
+gevent.spawn(check_results_writer)
 
 
 def check_all_channels():
@@ -927,12 +1300,18 @@ def post_subscription_manager_page():
                 cursor.executemany('''UPDATE subscribed_channels
                                       SET muted = 1
                                       WHERE yt_channel_id = ?''', [(ci,) for ci in request.values.getlist('channel_ids')])
+                autocheck_scheduler.mute(request.values.getlist('channel_ids'))
             elif action == 'unmute':
                 cursor.executemany('''UPDATE subscribed_channels
                                       SET muted = 0
                                       WHERE yt_channel_id = ?''', [(ci,) for ci in request.values.getlist('channel_ids')])
+                autocheck_scheduler.unmute(
+                    request.values.getlist('channel_ids'),
+                    lambda channel_id: _next_check_time(cursor, channel_id))
             else:
                 flask.abort(400)
+    # tags and muting change which videos are in the feeds
+    feed_video_counts.clear()
 
     return flask.redirect(util.URL_ORIGIN + request.full_path, 303)
 
@@ -940,11 +1319,12 @@ def post_subscription_manager_page():
 @yt_app.route('/subscriptions', methods=['GET'])
 @yt_app.route('/feed/subscriptions', methods=['GET'])
 def get_subscriptions_page():
-    page = int(request.args.get('page', 1))
     with open_database() as connection:
         with connection as cursor:
             tag = request.args.get('tag', None)
-            videos, number_of_videos_in_db = _get_videos(cursor, 60, (page - 1)*60, tag)
+            videos, prev_ctoken, next_ctoken = _get_videos(
+                cursor, 60, request.args.get('ctoken'), tag)
+            number_of_videos = _get_feed_video_count(cursor, tag)
             for video in videos:
                 video['thumbnail'] = util.URL_ORIGIN + '/data/subscription_thumbnails/' + video['id'] + '.jpg'
                 video['type'] = 'video'
@@ -965,7 +1345,9 @@ def get_subscriptions_page():
     return flask.render_template('subscriptions.html',
         header_playlist_names=local_playlist.get_playlist_names(),
         videos=videos,
-        num_pages=math.ceil(number_of_videos_in_db/60),
+        prev_ctoken=prev_ctoken,
+        next_ctoken=next_ctoken,
+        number_of_videos=number_of_videos,
         parameters_dictionary=request.args,
         tags=tags,
         current_tag=tag,
@@ -1,14 +1,18 @@
 from datetime import datetime
 import settings
+from youtube import http2
+from youtube import metrics
+from youtube import resolver
 import socks
-import sockshandler
-import gzip
+import io
+import zlib
 try:
     import brotli
     have_brotli = True
 except ImportError:
     have_brotli = False
 import urllib.parse
+import urllib.request
 import re
 import time
 import os
@@ -16,10 +20,17 @@ import json
 import gevent
 import gevent.queue
 import gevent.lock
+import gevent.event
 import collections
+import cachetools
+import hashlib
+import flask
+import werkzeug.http
 import stem
 import stem.control
 import traceback
+import secrets
+import weakref
 
 # The trouble with the requests library: It ships its own certificate bundle via certifi
 #  instead of using the system certificate store, meaning self-signed certificates
@@ -56,7 +67,151 @@ import urllib3.contrib.socks
 
 URL_ORIGIN = "/https://www.youtube.com"
 
-connection_pool = urllib3.PoolManager(cert_reqs='CERT_REQUIRED')
+
+# Labelled with the debug_name of the request ('other' if it has none), or
+# 'head' for requests made with head()
+fetch_dns_seconds = metrics.Histogram(
+    'yt_fetch_dns_seconds',
+    'Time spent looking up hosts, for requests not routed through Tor',
+    ('endpoint',))
+fetch_connect_seconds = metrics.Histogram(
+    'yt_fetch_connect_seconds',
+    'Time spent opening connections, for requests not routed through Tor',
+    ('endpoint',))
+fetch_latency_seconds = metrics.Histogram(
+    'yt_fetch_latency_seconds',
+    'Time until the response headers arrived', ('endpoint',))
+fetch_read_seconds = metrics.Histogram(
+    'yt_fetch_read_seconds', 'Time spent reading the response body',
+    ('endpoint',))
+fetch_response_bytes = metrics.Counter(
+    'yt_fetch_response_bytes_total', 'Decoded size of response bodies',
+    ('endpoint',))
+fetch_responses = metrics.Counter(
+    'yt_fetch_responses_total', 'Responses by status code',
+    ('endpoint', 'status'))
+fetch_rate_limited = metrics.Counter(
+    'yt_fetch_rate_limited_total',
+    'Responses where YouTube blocked the request (429 or a captcha)',
+    ('endpoint',))
+fetch_cache_hits = metrics.Counter(
+    'yt_fetch_cache_hits_total', 'Requests answered from the response cache',
+    ('endpoint',))
+tor_identity_changes = metrics.Counter(
+    'yt_tor_identity_changes_total',
+    'New Tor identities (newnym) and replaced circuits (circuit) after being '
+    'blocked', ('kind',))
+pool_checkouts = metrics.Counter(
+    'yt_pool_checkouts_total',
+    'Requests sent, by the pool their connection came from (direct, tor or '
+    'http2)', ('pool',))
+pool_idle_connections = metrics.Gauge(
+    'yt_pool_idle_connections', 'Idle connections in each connection pool',
+    ('pool', 'host'))
+pool_connections_opened = metrics.Gauge(
+    'yt_pool_connections_opened',
+    'Connections opened by each connection pool since it was created',
+    ('pool', 'host'))
+
+def parse_pool_sizes(text):
+    '''Parses settings.connection_pool_host_sizes, a list like
+    "www.youtube.com=16, ytimg.com=24", into a dict'''
+    sizes = {}
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        host, _, size = item.partition('=')
+        try:
+            sizes[host.strip()] = int(size)
+        except ValueError:
+            print('Warning: Ignoring invalid connection pool size:', item)
+    return sizes
+
+
+def pool_size(host):
+    '''How many connections to keep open to host. Entries for a domain
+    also apply to its subdomains.'''
+    sizes = parse_pool_sizes(settings.connection_pool_host_sizes)
+    name = host
+    while True:
+        if name in sizes:
+            return sizes[name]
+        dot = name.find('.')
+        if dot == -1:
+            return settings.connection_pool_size
+        name = name[dot+1:]
+
+
+class SizedPoolsMixin:
+    '''For urllib3 pool managers: sizes each host's connection pool by
+    pool_size. urllib3's default of 1 means that when several greenlets
+    use a host at once, all but one of their connections are thrown away
+    afterwards, and the next requests pay for new TLS handshakes.'''
+
+    # the number of hosts to keep pools for, which is large so that the
+    # many googlevideo hosts don't push out the youtube.com pools
+    NUM_POOLS = 50
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        if request_context is None:
+            request_context = self.connection_pool_kw.copy()
+        request_context['maxsize'] = pool_size(host)
+        return super()._new_pool(scheme, host, port, request_context)
+
+
+class SizedPoolManager(SizedPoolsMixin, urllib3.PoolManager):
+    pass
+
+
+class SizedSOCKSProxyManager(SizedPoolsMixin,
+                             urllib3.contrib.socks.SOCKSProxyManager):
+    pass
+
+
+connection_pool = SizedPoolManager(num_pools=SizedPoolsMixin.NUM_POOLS,
+                                   cert_reqs='CERT_REQUIRED')
+# direct connections look up hosts through the cached resolver
+connection_pool.pool_classes_by_scheme = resolver.POOL_CLASSES
+
+
+class TorCircuit:
+    '''Connections through Tor that share a circuit. Tor puts streams with
+    different SOCKS credentials on different circuits (IsolateSOCKSAuth is
+    on by default), so each TorCircuit uses a random username and password
+    of its own.'''
+
+    def __init__(self):
+        self.credentials = secrets.token_hex(8)
+        self.old_pool = None
+        self.pool = self._new_pool()
+        self.pool_refresh_time = time.monotonic()
+
+    def _new_pool(self):
+        return SizedSOCKSProxyManager(
+            'socks5h://127.0.0.1:' + str(settings.tor_port) + '/',
+            username=self.credentials, password=self.credentials,
+            num_pools=SizedPoolsMixin.NUM_POOLS, cert_reqs='CERT_REQUIRED')
+
+    def refresh_pool(self):
+        self.pool.clear()
+
+        # Keep a reference for 5 min to avoid it getting garbage collected
+        # while sockets still in use
+        self.old_pool = self.pool
+
+        self.pool = self._new_pool()
+        self.pool_refresh_time = time.monotonic()
+
+    def get_pool(self):
+        # Tor changes circuits after 10 minutes:
+        # https://tor.stackexchange.com/questions/262/for-how-long-does-a-circuit-stay-alive
+        current_time = time.monotonic()
+
+        # close pool after 5 minutes
+        if current_time - self.pool_refresh_time > 300:
+            self.refresh_pool()
+
+        return self.pool
 
 
 class TorManager:
@@ -66,42 +221,65 @@ class TorManager:
     COOLDOWN_TIME = 14
 
     def __init__(self):
-        self.old_tor_connection_pool = None
-        self.tor_connection_pool = urllib3.contrib.socks.SOCKSProxyManager(
-            'socks5h://127.0.0.1:' + str(settings.tor_port) + '/',
-            cert_reqs='CERT_REQUIRED')
-        self.tor_pool_refresh_time = time.monotonic()
+        # With settings.tor_circuits above 1, requests are spread over that
+        # many circuits, and a circuit whose exit node gets blocked is
+        # replaced on its own. Otherwise everything goes over one circuit,
+        # and a blocked exit node means a new identity for all of Tor.
+        self.circuits = [TorCircuit()
+                         for i in range(max(settings.tor_circuits, 1))]
+        self.next_circuit = 0
+        # Keep references to replaced circuits for a while, for the same
+        # reason as TorCircuit.old_pool
+        self.retired_circuits = collections.deque(maxlen=16)
         settings.add_setting_changed_hook(
             'tor_port',
             lambda old_val, new_val: self.refresh_tor_connection_pool(),
         )
+        settings.add_setting_changed_hook(
+            'tor_circuits',
+            lambda old_val, new_val: self.set_circuit_count(new_val),
+        )
 
         self.new_identity_lock = gevent.lock.BoundedSemaphore(1)
         self.last_new_identity_time = time.monotonic() - 20
         self.try_num = 1
 
     def refresh_tor_connection_pool(self):
-        self.tor_connection_pool.clear()
-
-        # Keep a reference for 5 min to avoid it getting garbage collected
-        # while sockets still in use
-        self.old_tor_connection_pool = self.tor_connection_pool
-
-        self.tor_connection_pool = urllib3.contrib.socks.SOCKSProxyManager(
-            'socks5h://127.0.0.1:' + str(settings.tor_port) + '/',
-            cert_reqs='CERT_REQUIRED')
-        self.tor_pool_refresh_time = time.monotonic()
+        for circuit in self.circuits:
+            circuit.refresh_pool()
 
     def get_tor_connection_pool(self):
-        # Tor changes circuits after 10 minutes:
-        # https://tor.stackexchange.com/questions/262/for-how-long-does-a-circuit-stay-alive
-        current_time = time.monotonic()
-
-        # close pool after 5 minutes
-        if current_time - self.tor_pool_refresh_time > 300:
-            self.refresh_tor_connection_pool()
-
-        return self.tor_connection_pool
+        return self.circuits[0].get_pool()
+
+    def set_circuit_count(self, count):
+        count = max(count, 1)
+        self.retired_circuits.extend(self.circuits[count:])
+        del self.circuits[count:]
+        while len(self.circuits) < count:
+            self.circuits.append(TorCircuit())
+
+    def get_circuit(self, spread=False):
+        '''Returns the circuit for a request. The first circuit is used
+        unless spread is True, in which case requests take turns over the
+        others. The first circuit is kept out of the turns so that a block on
+        a spread request doesn't replace it, since the video urls handed out
+        so far only play from its exit node.'''
+        if not spread or len(self.circuits) == 1:
+            return self.circuits[0]
+        self.next_circuit = self.next_circuit % (len(self.circuits) - 1) + 1
+        return self.circuits[self.next_circuit]
+
+    def retire_circuit(self, circuit):
+        '''Replaces circuit, whose exit node is being blocked, with a new
+        one. Does nothing if it has already been replaced.'''
+        try:
+            index = self.circuits.index(circuit)
+        except ValueError:
+            return
+        print('Replacing Tor circuit %d' % index)
+        tor_identity_changes.inc('circuit')
+        self.retired_circuits.append(circuit)
+        self.circuits[index] = TorCircuit()
 
     def new_identity(self, time_failed_request_started):
         '''return error, or None if no error and the identity is fresh'''
@@ -139,6 +317,7 @@ class TorManager:
                     print('new_identity: Getting new identity')
                     controller.signal(stem.Signal.NEWNYM)
                     print('new_identity: NEWNYM signal sent')
+                    tor_identity_changes.inc('newnym')
                     self.last_new_identity_time = time.monotonic()
                 self.refresh_tor_connection_pool()
             except stem.SocketError:
@@ -165,31 +344,134 @@ class TorManager:
 tor_manager = TorManager()
 
 
-def get_pool(use_tor):
+def connect_http2(host, port, timeout):
+    family, address = resolver.resolver.resolve(host, port)[0]
+    return http2.connect_tls(host, port, timeout, address=address)
+
+
+http2_pool = http2.HTTP2Pool(connect_http2) if http2.have_h2 else None
+
+
+def use_http2(url, use_tor):
+    if not settings.use_http2 or http2_pool is None or use_tor:
+        return False
+    return urllib.parse.urlsplit(url).hostname in http2.HOSTS
+
+
+def get_pool(use_tor, tor_circuit=None):
     if not use_tor:
         return connection_pool
+    if tor_circuit is not None:
+        return tor_circuit.get_pool()
     return tor_manager.get_tor_connection_pool()
 
 
-class HTTPAsymmetricCookieProcessor(urllib.request.BaseHandler):
-    '''Separate cookiejars for receiving and sending'''
+def resize_connection_pools(old_value=None, value=None):
+    # pools are sized when created, so start over with new ones
+    connection_pool.clear()
+    tor_manager.refresh_tor_connection_pool()
+
+
+settings.add_setting_changed_hook('connection_pool_size',
+                                  resize_connection_pools)
+settings.add_setting_changed_hook('connection_pool_host_sizes',
+                                  resize_connection_pools)
+
+
+def connection_pool_stats():
+    '''Returns a (pool name, host, size, idle connections, connections
+    opened, requests made) tuple for each host with a connection pool'''
+    managers = [('direct', connection_pool)]
+    for i, circuit in enumerate(tor_manager.circuits):
+        managers.append(('tor circuit %d' % i, circuit.pool))
+    stats = []
+    for name, manager in managers:
+        for key in list(manager.pools.keys()):
+            pool = manager.pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            idle = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+            stats.append((name, pool.host, pool.pool.maxsize, idle,
+                          pool.num_connections, pool.num_requests))
+    return stats
+
+
+def collect_pool_metrics():
+    pool_idle_connections.clear()
+    pool_connections_opened.clear()
+    for name, host, size, idle, opened, requests in connection_pool_stats():
+        pool_idle_connections.set(idle, name, host)
+        pool_connections_opened.set(opened, name, host)
+
+
+metrics.add_collector(collect_pool_metrics)
+
+
+WARM_UP_HOSTS = ('www.youtube.com', 'm.youtube.com',
+                 'youtubei.googleapis.com', 'i.ytimg.com')
+
+
+def warm_up_connections(connections_per_host=2):
+    '''Opens connections to the busiest hosts in the background, so that
+    the first requests don't have to wait for TLS handshakes. Hosts that
+    requests go to over HTTP/2 get their one shared HTTP/2 connection.'''
+    pool = get_pool(settings.route_tor)
+
+    def warm_up(host):
+        try:
+            pool.request('HEAD', 'https://' + host + '/', retries=False,
+                         headers={'User-Agent': 'Python-urllib'}, timeout=15)
+        except (urllib3.exceptions.HTTPError, OSError) as e:
+            print('Could not open connection to %s: %s' % (host, e))
+
+    for host in WARM_UP_HOSTS:
+        if use_http2('https://' + host + '/', settings.route_tor):
+            gevent.spawn(http2_pool.get_connection, host, 443, 15)
+            continue
+        for i in range(min(connections_per_host, pool_size(host))):
+            gevent.spawn(warm_up, host)
+
+
+# Responses to these contain video urls, which only work from the IP address
+# that requested them, so they go over the same Tor circuit as the video
+PRIMARY_CIRCUIT_REQUESTS = {'watch', 'youtubei_player', 'hls_manifest.m3u8'}
+
+
+class CookieMiddleware:
+    '''Sends and receives cookies for requests made with urllib3. Separate
+    cookiejars are used for sending and receiving, either may be None.'''
+
+    class _ResponseInfo:
+        '''What http.cookiejar expects of response.info()'''
+        def __init__(self, headers):
+            self.headers = headers
+
+        def info(self):
+            return self
+
+        def get_all(self, name, default=None):
+            return self.headers.getlist(name) or default
+
     def __init__(self, cookiejar_send=None, cookiejar_receive=None):
-        import http.cookiejar
         self.cookiejar_send = cookiejar_send
         self.cookiejar_receive = cookiejar_receive
 
-    def http_request(self, request):
+    def request_headers(self, url, headers):
+        '''Returns a copy of headers with the cookies for url added'''
+        headers = dict(headers)
         if self.cookiejar_send is not None:
+            request = urllib.request.Request(url, headers=headers)
             self.cookiejar_send.add_cookie_header(request)
-        return request
+            cookie_header = request.get_header('Cookie')
+            if cookie_header:
+                headers['Cookie'] = cookie_header
+        return headers
 
-    def http_response(self, request, response):
+    def extract_cookies(self, url, response):
         if self.cookiejar_receive is not None:
-            self.cookiejar_receive.extract_cookies(response, request)
-        return response
-
-    https_request = http_request
-    https_response = http_response
+            self.cookiejar_receive.extract_cookies(
+                self._ResponseInfo(response.headers),
+                urllib.request.Request(url))
 
 
 class FetchError(Exception):
@@ -205,23 +487,200 @@ class FetchError(Exception):
         self.error_message = error_message
 
 
-def decode_content(content, encoding_header):
-    encodings = encoding_header.replace(' ', '').split(',')
-    for encoding in reversed(encodings):
-        if encoding == 'identity':
-            continue
+# Time budgets: the request handler sets a deadline for the page it is
+# serving, and fetch_url and head limit their timeouts to the time left, so a
+# slow YouTube gives an error page or a page with parts missing instead of
+# hanging. Greenlets spawned while making the page share the deadline of the
+# greenlet that spawned them.
+deadlines = weakref.WeakKeyDictionary()  # greenlet -> time.monotonic() value
+
+# Optional parts of a page, like the comments or the check for 403s on video
+# urls, are skipped when less than this many seconds are left
+OPTIONAL_STEP_TIME = 5
+
+
+def set_deadline(seconds):
+    deadlines[gevent.getcurrent()] = time.monotonic() + seconds
+
+
+def clear_deadline():
+    deadlines.pop(gevent.getcurrent(), None)
+
+
+def _value_for_greenlet(values):
+    '''Returns the value in values for the current greenlet, or else for the
+    greenlet that spawned it, and so on, or None if there is none'''
+    greenlet = gevent.getcurrent()
+    while greenlet is not None:
+        value = values.get(greenlet)
+        if value is not None:
+            return value
+        spawning_greenlet = getattr(greenlet, 'spawning_greenlet', None)
+        greenlet = spawning_greenlet() if spawning_greenlet else None
+    return None
+
+
+def time_remaining():
+    '''Returns the seconds left until the deadline of the current greenlet,
+    or None if there is none'''
+    deadline = _value_for_greenlet(deadlines)
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def out_of_time_error():
+    return FetchError('504', reason='Gateway Timeout',
+                      error_message='Ran out of time loading the page '
+                                    'from YouTube. Try reloading.')
+
+
+def budget_timeout(timeout):
+    '''Returns timeout, shortened to the time left until the deadline.
+    Raises FetchError if no time is left.'''
+    remaining = time_remaining()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise out_of_time_error()
+    return min(timeout, remaining)
+
+
+def have_time_for_optional_step():
+    remaining = time_remaining()
+    return remaining is None or remaining >= OPTIONAL_STEP_TIME
+
+
+# Responses are decompressed as they are read, so that the compressed and the
+# decompressed copy of a large page aren't both in memory at once. Responses
+# that decompress to more than this are treated as an error.
+MAX_DECODED_SIZE = 64*1024*1024
+DECODE_READ_SIZE = 64*1024
+
+
+class ContentDecoder:
+    '''Undoes the Content-Encoding of a response piece by piece. Raises
+    FetchError once the output grows beyond max_size.'''
+
+    def __init__(self, encoding_header, max_size=MAX_DECODED_SIZE):
+        encodings = encoding_header.replace(' ', '').split(',')
+        self.encodings = [encoding for encoding in reversed(encodings)
+                          if encoding in ('br', 'gzip')]
+        self.decompressors = [self._new_decompressor(encoding)
+                              for encoding in self.encodings]
+        self.max_size = max_size
+        self.input_size = 0
+        self.decoded_size = 0
+
+    @staticmethod
+    def _new_decompressor(encoding):
         if encoding == 'br':
-            content = brotli.decompress(content)
-        elif encoding == 'gzip':
-            content = gzip.decompress(content)
-    return content
+            return brotli.Decompressor()
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def _decompress(self, i, data):
+        decompressor = self.decompressors[i]
+        if self.encodings[i] == 'br':
+            return decompressor.process(data)
+        output = decompressor.decompress(data)
+        # there can be several gzip members one after another
+        while decompressor.eof and decompressor.unused_data:
+            data = decompressor.unused_data
+            decompressor = self._new_decompressor('gzip')
+            self.decompressors[i] = decompressor
+            output += decompressor.decompress(data)
+        return output
+
+    def _count(self, data):
+        self.decoded_size += len(data)
+        if self.decoded_size > self.max_size:
+            raise FetchError(
+                '502', reason='Bad Gateway',
+                error_message='Response is larger than the limit of %d '
+                              'bytes once decompressed' % self.max_size)
+        return data
+
+    def decode(self, data):
+        self.input_size += len(data)
+        for i in range(len(self.decompressors)):
+            data = self._decompress(i, data)
+        return self._count(data)
+
+    def finish(self):
+        '''Returns the output still held back by the decompressors'''
+        data = b''
+        for i, encoding in enumerate(self.encodings):
+            data = self._decompress(i, data)
+            decompressor = self.decompressors[i]
+            if encoding == 'gzip':
+                data += decompressor.flush()
+                finished = decompressor.eof
+            else:
+                finished = decompressor.is_finished()
+            if self.input_size and not finished:
+                raise EOFError('Compressed response ended before the '
+                               'end-of-stream marker was reached')
+        return self._count(data)
+
+
+def decode_content(content, encoding_header, max_size=MAX_DECODED_SIZE):
+    decoder = ContentDecoder(encoding_header, max_size)
+    return decoder.decode(content) + decoder.finish()
+
+
+def iter_decoded(response, max_size=MAX_DECODED_SIZE):
+    '''Generator over the body of response with its Content-Encoding
+    undone, read and decompressed DECODE_READ_SIZE bytes at a time'''
+    decoder = ContentDecoder(
+        response.getheader('Content-Encoding', default='identity'),
+        max_size)
+    while True:
+        data = response.read(DECODE_READ_SIZE)
+        if not data:
+            break
+        data = decoder.decode(data)
+        if data:
+            yield data
+    data = decoder.finish()
+    if data:
+        yield data
+
+
+def request_with_cookies(pool, method, url, headers, data, timeout, cookies,
+                         max_redirects=None):
+    '''Makes a request through a urllib3 pool, following redirects here
+    instead of in urllib3 so that cookies are sent and stored at every
+    step, like urllib's cookie handling does'''
+    if max_redirects is None:
+        max_redirects = 10     # urllib's limit
+    for redirect_num in range(max_redirects + 1):
+        response = pool.request(
+            method, url, headers=cookies.request_headers(url, headers),
+            body=data, timeout=timeout, preload_content=False,
+            decode_content=False, redirect=False,
+            retries=urllib3.Retry(3, redirect=0, raise_on_redirect=False))
+        cookies.extract_cookies(url, response)
+        location = response.get_redirect_location()
+        if not location or redirect_num == max_redirects:
+            break
+        response.drain_conn()
+        response.release_conn()
+        url = urllib.parse.urljoin(url, location)
+        if response.status == 303 or (response.status in (301, 302)
+                                      and method == 'POST'):
+            method = 'GET'
+            data = None
+    response.final_url = url
+    return response
 
 
 def fetch_url_response(url, headers=(), timeout=15, data=None,
                        cookiejar_send=None, cookiejar_receive=None,
-                       use_tor=True, max_redirects=None):
+                       use_tor=True, max_redirects=None, tor_circuit=None):
     '''
     returns response, cleanup_function
+    When routing through Tor, the request goes over tor_circuit, or the
+     first circuit if it is None. The circuit used is response.tor_circuit.
     When cookiejar_send is set to a CookieJar object,
      those cookies will be sent in the request (but cookies in response will not be merged into it)
     When cookiejar_receive is set to a CookieJar object,
@@ -249,76 +708,359 @@ def fetch_url_response(url, headers=(), timeout=15, data=None,
             data = urllib.parse.urlencode(data).encode('utf-8')
 
 
-    if cookiejar_send is not None or cookiejar_receive is not None:     # Use urllib
-        req = urllib.request.Request(url, data=data, headers=headers)
-
-        cookie_processor = HTTPAsymmetricCookieProcessor(cookiejar_send=cookiejar_send, cookiejar_receive=cookiejar_receive)
-
-        if use_tor and settings.route_tor:
-            opener = urllib.request.build_opener(sockshandler.SocksiPyHandler(socks.PROXY_TYPE_SOCKS5, "127.0.0.1", settings.tor_port), cookie_processor)
+    # default: Retry.DEFAULT = Retry(3)
+    # (in connectionpool.py in urllib3)
+    # According to the documentation for urlopen, a redirect counts as a
+    # retry. So there are 3 redirects max by default.
+    if max_redirects:
+        retries = urllib3.Retry(3+max_redirects, redirect=max_redirects, raise_on_redirect=False)
+    else:
+        retries = urllib3.Retry(3, raise_on_redirect=False)
+    if not (use_tor and settings.route_tor):
+        tor_circuit = None
+    elif tor_circuit is None:
+        tor_circuit = tor_manager.get_circuit()
+    pool = get_pool(use_tor and settings.route_tor, tor_circuit)
+    try:
+        if cookiejar_send is not None or cookiejar_receive is not None:
+            response = request_with_cookies(
+                pool, method, url, headers, data, timeout,
+                CookieMiddleware(cookiejar_send, cookiejar_receive),
+                max_redirects)
         else:
-            opener = urllib.request.build_opener(cookie_processor)
-
-        response = opener.open(req, timeout=timeout)
-        cleanup_func = (lambda r: None)
-
-    else:           # Use a urllib3 pool. Cookies can't be used since urllib3 doesn't have easy support for them.
-        # default: Retry.DEFAULT = Retry(3)
-        # (in connectionpool.py in urllib3)
-        # According to the documentation for urlopen, a redirect counts as a
-        # retry. So there are 3 redirects max by default.
-        if max_redirects:
-            retries = urllib3.Retry(3+max_redirects, redirect=max_redirects, raise_on_redirect=False)
+            response = None
+            if use_http2(url, use_tor and settings.route_tor):
+                response = http2_pool.request(method, url, headers, data,
+                                              timeout)
+                if response is not None:
+                    pool_checkouts.inc('http2')
+                if response is not None and response.get_redirect_location():
+                    # leave following redirects to urllib3
+                    response.close()
+                    response = None
+            if response is None:
+                if use_http2(url, use_tor and settings.route_tor):
+                    # the HTTP/2 attempt may have used up some of the time
+                    timeout = budget_timeout(timeout)
+                pool_checkouts.inc('direct' if pool is connection_pool
+                                   else 'tor')
+                response = pool.request(
+                    method, url, headers=headers, body=data, timeout=timeout,
+                    preload_content=False, decode_content=False,
+                    retries=retries)
+                # geturl() finds the final url after redirects using the
+                # history in response.retries, so get it before replacing that
+                response.final_url = response.geturl()
+                response.retries = retries
+    except urllib3.exceptions.MaxRetryError as e:
+        exception_cause = e.__context__.__context__
+        if (isinstance(exception_cause, socks.ProxyConnectionError)
+                and settings.route_tor):
+            msg = ('Failed to connect to Tor. Check that Tor is open and '
+                   'that your internet connection is working.\n\n'
+                   + str(e))
+            raise FetchError('502', reason='Bad Gateway',
+                             error_message=msg)
+        elif isinstance(e.__context__,
+                        urllib3.exceptions.NewConnectionError):
+            msg = 'Failed to establish a connection.\n\n' + str(e)
+            raise FetchError(
+                '502', reason='Bad Gateway',
+                 error_message=msg)
         else:
-            retries = urllib3.Retry(3, raise_on_redirect=False)
-        pool = get_pool(use_tor and settings.route_tor)
-        try:
-            response = pool.request(method, url, headers=headers, body=data,
-                                    timeout=timeout, preload_content=False,
-                                    decode_content=False, retries=retries)
-            response.retries = retries
-        except urllib3.exceptions.MaxRetryError as e:
-            exception_cause = e.__context__.__context__
-            if (isinstance(exception_cause, socks.ProxyConnectionError)
-                    and settings.route_tor):
-                msg = ('Failed to connect to Tor. Check that Tor is open and '
-                       'that your internet connection is working.\n\n'
-                       + str(e))
-                raise FetchError('502', reason='Bad Gateway',
-                                 error_message=msg)
-            elif isinstance(e.__context__,
-                            urllib3.exceptions.NewConnectionError):
-                msg = 'Failed to establish a connection.\n\n' + str(e)
-                raise FetchError(
-                    '502', reason='Bad Gateway',
-                     error_message=msg)
-            else:
-                raise
-        cleanup_func = (lambda r: r.release_conn())
+            raise
+    cleanup_func = (lambda r: r.release_conn())
+    response.tor_circuit = tor_circuit
 
     return response, cleanup_func
 
 
+class ResponseCache:
+    '''Keeps responses from fetch_url for a while, so that opening a channel
+    tab, search or playlist again shortly after doesn't need another request
+    to YouTube.
+
+    Only requests with a debug_name in TTLS are cached, for that many
+    seconds. Recent responses are kept in memory, and if a directory is
+    given, also on disk so that they survive restarts.'''
+
+    TTLS = {
+        'search_results': 10*60,
+        'channel_tab': 10*60,
+        'channel_search': 10*60,
+        'gen_channel_videos': 10*60,
+        'gen_channel_search': 10*60,
+        'gen_channel_playlists': 30*60,
+        'gen_channel_about': 60*60,
+        'get_channel_id': 24*60*60,
+        'playlist_first_page': 10*60,
+        'playlist_videos': 10*60,
+        'request_comments': 5*60,
+    }
+
+    def __init__(self, memory_bytes, directory=None, disk_bytes=0):
+        # entries are (expire_time, content)
+        self.memory = cachetools.LRUCache(
+            maxsize=memory_bytes, getsizeof=lambda entry: len(entry[1]))
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.disk_entries = collections.OrderedDict()   # least recent first
+        self.disk_total = 0
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            self._load()
+
+    @staticmethod
+    def key(method, url, data, debug_name):
+        '''data is the request body, which is also part of the key. The
+        debug_name is included since call sites send different headers and
+        may get different responses for the same url.'''
+        if data is None:
+            data = b''
+        elif isinstance(data, str):
+            data = data.encode('utf-8')
+        elif not isinstance(data, bytes):
+            data = urllib.parse.urlencode(data).encode('utf-8')
+        key_hash = hashlib.sha256()
+        key_hash.update(('%s %s %s\n' % (method, url, debug_name)).encode())
+        key_hash.update(data)
+        return key_hash.hexdigest()
+
+    def _load(self):
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        entries = [(entry.stat().st_mtime, entry.name, entry.stat().st_size)
+                   for entry in entries if not entry.name.endswith('.tmp')]
+        for mtime, name, size in sorted(entries):
+            self.disk_entries[name] = size
+            self.disk_total += size
+        self._evict_disk()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _read_disk(self, key):
+        if key not in self.disk_entries:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                expire_time = float(f.readline())
+                content = f.read()
+        except (OSError, ValueError):
+            self._remove_disk(key)
+            return None
+        self.disk_entries.move_to_end(key)
+        return expire_time, content
+
+    def _write_disk(self, key, entry):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = self._path(key) + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(b'%f\n' % entry[0])
+                f.write(entry[1])
+                size = f.tell()
+            os.replace(temp_path, self._path(key))
+        except OSError:
+            traceback.print_exc()
+            return
+        self.disk_total += size - self.disk_entries.pop(key, 0)
+        self.disk_entries[key] = size
+        self._evict_disk()
+
+    def _remove_disk(self, key):
+        self.disk_total -= self.disk_entries.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict_disk(self):
+        while self.disk_entries and self.disk_total > self.disk_bytes:
+            self._remove_disk(next(iter(self.disk_entries)))
+
+    def get(self, key):
+        '''Returns the cached content, or None if there is none or it has
+        expired'''
+        entry = self.memory.get(key)
+        if entry is None and self.directory is not None:
+            entry = self._read_disk(key)
+        if entry is None or entry[0] <= time.time():
+            self.misses += 1
+            if entry is not None:
+                self.memory.pop(key, None)
+                if self.directory is not None:
+                    self._remove_disk(key)
+            return None
+        self.hits += 1
+        if key not in self.memory:
+            self._put_memory(key, entry)
+        return entry[1]
+
+    def _put_memory(self, key, entry):
+        try:
+            self.memory[key] = entry
+        except ValueError:  # larger than the whole memory cache
+            pass
+
+    def put(self, key, content, ttl):
+        entry = (time.time() + ttl, content)
+        self._put_memory(key, entry)
+        if self.directory is not None:
+            self._write_disk(key, entry)
+
+
+response_cache_directory = os.path.join(settings.data_dir, 'response_cache')
+response_cache = None
+
+
+def set_response_cache_size(old_value=None, value=None):
+    global response_cache
+    memory_size = settings.response_cache_size
+    disk_size = settings.response_disk_cache_size
+    if not memory_size:
+        response_cache = None
+    elif disk_size:
+        response_cache = ResponseCache(memory_size*1024*1024,
+                                       response_cache_directory,
+                                       disk_size*1024*1024)
+    else:
+        response_cache = ResponseCache(memory_size*1024*1024)
+
+
+set_response_cache_size()
+settings.add_setting_changed_hook('response_cache_size',
+                                  set_response_cache_size)
+settings.add_setting_changed_hook('response_disk_cache_size',
+                                  set_response_cache_size)
+
+
+# greenlet -> whether the page it serves was reloaded, for the greenlets it
+# spawns, which don't have the flask request context
+refresh_flags = weakref.WeakKeyDictionary()
+
+
+def _is_reload(cache_control):
+    return bool(cache_control.no_cache) or cache_control.max_age == 0
+
+
+def set_refresh_requested(cache_control_header):
+    '''Records whether the page being served by the current greenlet was
+    reloaded, going by its Cache-Control header'''
+    refresh_flags[gevent.getcurrent()] = _is_reload(
+        werkzeug.http.parse_cache_control_header(cache_control_header))
+
+
+def clear_refresh_requested():
+    refresh_flags.pop(gevent.getcurrent(), None)
+
+
+def refresh_requested():
+    '''Whether the page being served was reloaded by the user, in which case
+    cached responses shouldn't be used'''
+    refresh = _value_for_greenlet(refresh_flags)
+    if refresh is not None:
+        return refresh
+    if not flask.has_request_context():
+        return False
+    return _is_reload(flask.request.cache_control)
+
+
 def fetch_url(url, headers=(), timeout=15, report_text=None, data=None,
               cookiejar_send=None, cookiejar_receive=None, use_tor=True,
-              debug_name=None):
+              debug_name=None, refresh=None, max_size=MAX_DECODED_SIZE):
+    '''Returns the decoded response body, which may be at most max_size
+    bytes.
+
+    Requests whose debug_name has an entry in ResponseCache.TTLS are served
+    from the response cache when it is enabled. With refresh=True the cache
+    isn't used but is updated with the new response. The default, None,
+    refreshes when the user reloaded the page being served.
+
+    The timeout is shortened to the time left until the deadline set for the
+    page being served, if any; see set_deadline.'''
+    method = 'GET' if data is None else 'POST'
+    cache_key = None
+    ttl = ResponseCache.TTLS.get(debug_name)
+    if (response_cache is not None and ttl is not None
+            and cookiejar_send is None and cookiejar_receive is None):
+        cache_key = ResponseCache.key(method, url, data, debug_name)
+        if refresh is None:
+            refresh = refresh_requested()
+        if not refresh:
+            content = response_cache.get(cache_key)
+            if content is not None:
+                fetch_cache_hits.inc(debug_name)
+                if report_text:
+                    print(report_text, '    Cached')
+                return content
+
+    if cookiejar_send is None and cookiejar_receive is None:
+        # Identical requests made at the same time share one request. This
+        # includes the retries after a 429, so only one new identity is
+        # requested for all of them.
+        flight_key = (ResponseCache.key(method, url, data, debug_name),
+                      frozenset(dict(headers).items()), bool(use_tor))
+        content = fetch_flights.do(
+            flight_key, _fetch_url, url, headers, timeout, report_text, data,
+            cookiejar_send, cookiejar_receive, use_tor, debug_name, max_size)
+    else:
+        content = _fetch_url(url, headers, timeout, report_text, data,
+                             cookiejar_send, cookiejar_receive, use_tor,
+                             debug_name, max_size)
+    if cache_key is not None:
+        response_cache.put(cache_key, content, ttl)
+    return content
+
+
+def _fetch_url(url, headers, timeout, report_text, data, cookiejar_send,
+               cookiejar_receive, use_tor, debug_name, max_size):
+    circuits_tried = 0
     while True:
         start_time = time.monotonic()
+        resolver.resolver.take_lookup_time()
+        resolver.resolver.take_connect_time()
 
+        tor_circuit = None
+        if use_tor and settings.route_tor and len(tor_manager.circuits) > 1:
+            tor_circuit = tor_manager.get_circuit(
+                spread=debug_name not in PRIMARY_CIRCUIT_REQUESTS)
         response, cleanup_func = fetch_url_response(
-            url, headers, timeout=timeout, data=data,
+            url, headers, timeout=budget_timeout(timeout), data=data,
             cookiejar_send=cookiejar_send, cookiejar_receive=cookiejar_receive,
-            use_tor=use_tor)
+            use_tor=use_tor, tor_circuit=tor_circuit)
         response_time = time.monotonic()
+        dns_time = resolver.resolver.take_lookup_time()
+        connect_time = resolver.resolver.take_connect_time()
 
-        content = response.read()
+        content_io = io.BytesIO()
+        try:
+            for content_part in iter_decoded(response, max_size):
+                content_io.write(content_part)
+        except BaseException:
+            # don't put a connection with unread data back in the pool
+            response.close()
+            raise
+        finally:
+            cleanup_func(response)  # release_connection for urllib3
+        # getvalue doesn't need to copy the buffer when it is the only user
+        content = content_io.getvalue()
+        del content_io
 
         read_finish = time.monotonic()
 
-        cleanup_func(response)  # release_connection for urllib3
-        content = decode_content(
-            content,
-            response.getheader('Content-Encoding', default='identity'))
+        endpoint = debug_name or 'other'
+        if dns_time:
+            fetch_dns_seconds.observe(dns_time, endpoint)
+        if connect_time:
+            fetch_connect_seconds.observe(connect_time, endpoint)
+        fetch_latency_seconds.observe(response_time - start_time, endpoint)
+        fetch_read_seconds.observe(read_finish - response_time, endpoint)
+        fetch_response_bytes.inc(endpoint, amount=len(content))
+        fetch_responses.inc(endpoint, response.status)
 
         if (settings.debugging_save_responses
                 and debug_name is not None and content):
@@ -337,6 +1079,7 @@ def fetch_url(url, headers=(), timeout=15, report_text=None, data=None,
             )
         ):
             print(response.status, response.reason, response.getheaders())
+            fetch_rate_limited.inc(endpoint)
             ip = re.search(
                 br'IP address: ((?:[\da-f]*:)+[\da-f]+|(?:\d+\.)+\d+)',
                 content)
@@ -352,6 +1095,18 @@ def fetch_url(url, headers=(), timeout=15, report_text=None, data=None,
 
             print('Error: YouTube blocked the request because the Tor exit node is overutilized. Exit node IP address: %s' % ip)
 
+            if tor_circuit is not None:
+                # only this circuit's exit node is blocked, so replace just
+                # it and retry, leaving the other circuits alone
+                tor_manager.retire_circuit(tor_circuit)
+                circuits_tried += 1
+                if circuits_tried >= TorManager.MAX_TRIES:
+                    raise FetchError(
+                        '429', reason=response.reason, ip=ip,
+                        error_message='Automatic circuit change: Retried '
+                                      'with %d circuits' % circuits_tried)
+                continue
+
             # get new identity
             error = tor_manager.new_identity(start_time)
             if error:
@@ -367,12 +1122,32 @@ def fetch_url(url, headers=(), timeout=15, report_text=None, data=None,
         break
 
     if report_text:
-        print(report_text, '    Latency:', round(response_time - start_time, 3), '    Read time:', round(read_finish - response_time,3))
+        print(report_text, '    Latency:', round(response_time - start_time, 3), '    Read time:', round(read_finish - response_time,3), '    DNS:', round(dns_time, 3))
 
     return content
 
 
-def head(url, use_tor=False, report_text=None, max_redirects=10):
+def fetch_url_stream(url, headers=(), timeout=15, data=None, use_tor=True,
+                     max_size=MAX_DECODED_SIZE):
+    '''Generator over the decoded response body as it arrives, for callers
+    that can process it incrementally. Unlike fetch_url, responses aren't
+    cached or shared, and a 429 is raised as a FetchError instead of
+    retried with a new identity.'''
+    response, cleanup_func = fetch_url_response(
+        url, headers, timeout=budget_timeout(timeout), data=data,
+        use_tor=use_tor)
+    try:
+        if response.status >= 400:
+            raise FetchError(str(response.status), reason=response.reason)
+        yield from iter_decoded(response, max_size)
+    except BaseException:
+        response.close()
+        raise
+    finally:
+        cleanup_func(response)
+
+
+def head(url, use_tor=False, report_text=None, max_redirects=10, timeout=15):
     pool = get_pool(use_tor and settings.route_tor)
     start_time = time.monotonic()
 
@@ -386,7 +1161,12 @@ def head(url, use_tor=False, report_text=None, max_redirects=10):
         redirect=max_redirects,
         raise_on_redirect=False)
     headers = {'User-Agent': 'Python-urllib'}
-    response = pool.request('HEAD', url, headers=headers, retries=retries)
+    pool_checkouts.inc('direct' if pool is connection_pool else 'tor')
+    response = pool.request('HEAD', url, headers=headers, retries=retries,
+                            timeout=budget_timeout(timeout))
+    response.final_url = response.geturl()
+    fetch_latency_seconds.observe(time.monotonic() - start_time, 'head')
+    fetch_responses.inc('head', response.status)
     if report_text:
         print(
             report_text,
@@ -414,6 +1194,65 @@ mobile_xhr_headers = (
 ) + mobile_ua
 
 
+class SingleFlight:
+    '''Lets concurrent callers asking for the same thing share one call.
+    The first caller for a key runs the function, and callers arriving while
+    it is still running wait for it and get the same result or exception.
+
+    Each caller keeps to its own deadline (see set_deadline): a waiting
+    caller gives up when its own time is up, and if the first caller fails
+    because its time ran out, the others make the call themselves.'''
+
+    # given to waiting callers when the first caller's greenlet was killed,
+    # or it ran out of time, which is no reason for them to fail, so they
+    # make the call themselves
+    _ABANDONED = object()
+    # a first caller failing with less than this many seconds left is taken
+    # to have failed because of its deadline
+    OUT_OF_TIME = 1
+
+    def __init__(self):
+        self.in_flight = {}
+        self.shared_count = 0
+
+    def do(self, key, function, *args, **kwargs):
+        pending_result = self.in_flight.get(key)
+        if pending_result is not None:
+            self.shared_count += 1
+            remaining = time_remaining()
+            try:
+                result = pending_result.get(
+                    timeout=None if remaining is None else max(remaining, 0))
+            except gevent.Timeout:
+                raise out_of_time_error()
+            if result is self._ABANDONED:
+                return self.do(key, function, *args, **kwargs)
+            return result
+
+        pending_result = gevent.event.AsyncResult()
+        self.in_flight[key] = pending_result
+        try:
+            result = function(*args, **kwargs)
+        except gevent.GreenletExit:
+            pending_result.set(self._ABANDONED)
+            raise
+        except BaseException as e:
+            remaining = time_remaining()
+            if remaining is not None and remaining < self.OUT_OF_TIME:
+                pending_result.set(self._ABANDONED)
+            else:
+                pending_result.set_exception(e)
+            raise
+        else:
+            pending_result.set(result)
+            return result
+        finally:
+            del self.in_flight[key]
+
+
+fetch_flights = SingleFlight()
+
+
 class RateLimitedQueue(gevent.queue.Queue):
     ''' Does initial_burst (def. 30) at first, then alternates between waiting waiting_period (def. 5) seconds and doing subsequent_bursts (def. 10) queries. After 5 seconds with nothing left in the queue, resets rate limiting. '''
 
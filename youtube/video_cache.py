@@ -0,0 +1,330 @@
+'''On-disk cache of byte ranges fetched from googlevideo
+
+Each cached stream is identified by the (id, itag, clen) query parameters of
+its videoplayback url, which stay the same when YouTube hands out a new
+signed url for the same file. The bytes are kept in a sparse file, and the
+ranges of it that have actually been filled in are tracked separately, so that
+seeks and rewatches only need to fetch the holes from upstream.
+'''
+import settings
+
+import bisect
+import collections
+import hashlib
+import json
+import os
+import time
+import traceback
+import urllib.parse
+
+import gevent.lock
+
+
+class RangeSet:
+    '''Sorted list of non-overlapping, half-open [start, end) intervals'''
+
+    def __init__(self, ranges=()):
+        self.ranges = []
+        for start, end in ranges:
+            self.add(start, end)
+
+    def add(self, start, end):
+        '''Adds [start, end), merging with any touching intervals.
+        Returns the number of bytes that were not already covered.'''
+        if end <= start:
+            return 0
+        newly_covered = (end - start) - self.covered(start, end)
+        starts = [interval[0] for interval in self.ranges]
+        # first interval that could touch [start, end)
+        i = bisect.bisect_left(starts, start)
+        if i > 0 and self.ranges[i-1][1] >= start:
+            i -= 1
+        j = i
+        while j < len(self.ranges) and self.ranges[j][0] <= end:
+            start = min(start, self.ranges[j][0])
+            end = max(end, self.ranges[j][1])
+            j += 1
+        self.ranges[i:j] = [[start, end]]
+        return newly_covered
+
+    def covered(self, start, end):
+        '''Number of bytes of [start, end) that are in the set'''
+        total = 0
+        for range_start, range_end in self.ranges:
+            if range_end <= start:
+                continue
+            if range_start >= end:
+                break
+            total += min(end, range_end) - max(start, range_start)
+        return total
+
+    def plan(self, start, end):
+        '''Splits [start, end) into a list of (is_cached, start, end) parts'''
+        parts = []
+        position = start
+        for range_start, range_end in self.ranges:
+            if range_end <= position:
+                continue
+            if range_start >= end:
+                break
+            if range_start > position:
+                parts.append((False, position, range_start))
+                position = range_start
+            part_end = min(end, range_end)
+            parts.append((True, position, part_end))
+            position = part_end
+        if position < end:
+            parts.append((False, position, end))
+        return parts
+
+    def total(self):
+        return sum(end - start for start, end in self.ranges)
+
+
+class CacheEntry:
+    def __init__(self, key, path, ranges=(), last_used=0):
+        self.key = key
+        self.path = path
+        self.ranges = RangeSet(ranges)
+        self.last_used = last_used
+        self.readers = 0    # entries being read from aren't evicted
+        # The .bin file, kept open while the entry is read from or written
+        # to. writing is set by write() and cleared by save().
+        self.file = None
+        self.writing = False
+
+
+def cache_key(query_string, content_length=None):
+    '''Returns the (id, itag, clen) cache key for a videoplayback query
+    string, or None if the url doesn't have the information needed.
+    content_length is used if the url has no clen parameter.'''
+    params = urllib.parse.parse_qs(query_string)
+    try:
+        if 'clen' in params or content_length is None:
+            content_length = int(params['clen'][0])
+        key = (params['id'][0], params['itag'][0], content_length)
+    except (KeyError, IndexError, ValueError):
+        return None
+    if key[2] <= 0:
+        return None
+    return key
+
+
+class VideoCache:
+    '''Size-bounded LRU store of partially downloaded googlevideo files'''
+
+    READ_SIZE = 32*8192
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()    # least recent first
+        self.total_bytes = 0
+        self.lock = gevent.lock.RLock()
+        self._load_index()
+
+    def _base_path(self, key):
+        name = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def _load_index(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        entries = []
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), 'r',
+                          encoding='utf-8') as f:
+                    info = json.load(f)
+                key = tuple(info['key'])
+                entry = CacheEntry(key, self._base_path(key), info['ranges'],
+                                   info['last_used'])
+            except (OSError, ValueError, KeyError):
+                print('Warning: Ignoring corrupt video cache index:', name)
+                continue
+            if os.path.exists(entry.path + '.bin'):
+                entries.append(entry)
+        entries.sort(key=lambda entry: entry.last_used)
+        for entry in entries:
+            self.entries[entry.key] = entry
+            self.total_bytes += entry.ranges.total()
+        self.evict()
+
+    def _save_index(self, entry):
+        info = {
+            'key': entry.key,
+            'ranges': entry.ranges.ranges,
+            'last_used': entry.last_used,
+        }
+        try:
+            with open(entry.path + '.json', 'w', encoding='utf-8') as f:
+                json.dump(info, f)
+        except OSError:
+            traceback.print_exc()
+
+    def _get_entry(self, key, create=False):
+        entry = self.entries.get(key)
+        if entry is None and create:
+            entry = CacheEntry(key, self._base_path(key))
+            self.entries[key] = entry
+        if entry is not None:
+            entry.last_used = time.time()
+            self.entries.move_to_end(key)
+        return entry
+
+    def _open_file(self, entry, create=False):
+        '''Returns the open .bin file of entry, opening it if needed'''
+        if entry.file is None:
+            if create and not os.path.exists(entry.path + '.bin'):
+                os.makedirs(self.directory, exist_ok=True)
+                entry.file = open(entry.path + '.bin', 'w+b')
+            else:
+                entry.file = open(entry.path + '.bin', 'r+b')
+        return entry.file
+
+    def _close_file(self, entry, force=False):
+        '''Closes the .bin file of entry once it's no longer used'''
+        if entry.file is None:
+            return
+        if force or not (entry.readers or entry.writing):
+            try:
+                entry.file.close()
+            except OSError:
+                traceback.print_exc()
+            entry.file = None
+        else:
+            entry.file.flush()
+
+    def plan(self, key, start, end):
+        '''Splits the inclusive byte range start-end into a list of
+        (is_cached, start, end) parts, where end is inclusive. Returns the
+        entry for key, to read the cached parts from, and the parts.'''
+        with self.lock:
+            entry = self._get_entry(key)
+            if entry is None:
+                return None, [(False, start, end)]
+            return entry, [(is_cached, part_start, part_end - 1)
+                           for is_cached, part_start, part_end
+                           in entry.ranges.plan(start, end + 1)]
+
+    def read(self, entry, start, end):
+        '''Generator over the cached bytes start-end (inclusive) of an
+        entry returned by plan. The entry isn't evicted while it is read.
+
+        Returns False without yielding anything if the bytes are no longer
+        cached, because the entry was evicted after plan, so that the caller
+        can fetch them from upstream instead. Otherwise returns True.'''
+        with self.lock:
+            if (self.entries.get(entry.key) is not entry
+                    or entry.ranges.covered(start, end + 1) < end - start + 1):
+                return False
+            try:
+                f = self._open_file(entry)
+            except FileNotFoundError:
+                return False
+            entry.readers += 1
+        try:
+            position = start
+            while position <= end:
+                # The file is shared with other readers and writers of the
+                # entry. File I/O doesn't switch greenlets, so the seek and
+                # read can't be interleaved with theirs under the lock.
+                with self.lock:
+                    f.seek(position)
+                    data = f.read(min(self.READ_SIZE, end - position + 1))
+                if not data:
+                    raise EOFError('Video cache file is shorter than expected')
+                position += len(data)
+                yield data
+            return True
+        finally:
+            with self.lock:
+                entry.readers -= 1
+                self._close_file(entry)
+
+    def write(self, key, offset, data):
+        '''Stores data that was received from upstream at offset. The file
+        is kept open for further writes until save(key) is called.
+
+        Data that would make the entry itself larger than max_bytes isn't
+        stored, since evicting everything else couldn't make room for it.'''
+        if not data:
+            return
+        end = offset + len(data)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                new_total = len(data)
+            else:
+                new_total = (entry.ranges.total() + len(data)
+                             - entry.ranges.covered(offset, end))
+            if new_total > self.max_bytes:
+                return
+            entry = self._get_entry(key, create=True)
+            f = self._open_file(entry, create=True)
+            entry.writing = True
+            f.seek(offset)
+            f.write(data)
+            self.total_bytes += entry.ranges.add(offset, end)
+            if self.total_bytes > self.max_bytes:
+                self.evict(keep=key)
+
+    def save(self, key):
+        '''Persist which ranges of key are present. Called when done
+        writing to key.'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.writing = False
+                self._close_file(entry)
+                self._save_index(entry)
+
+    def _remove(self, entry):
+        del self.entries[entry.key]
+        self._close_file(entry, force=True)
+        self.total_bytes -= entry.ranges.total()
+        for extension in ('.bin', '.json'):
+            try:
+                os.remove(entry.path + extension)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                traceback.print_exc()
+
+    def evict(self, keep=None):
+        '''Remove least recently used entries until under max_bytes, except
+        for keep and entries being read from'''
+        with self.lock:
+            for entry in list(self.entries.values()):
+                if self.total_bytes <= self.max_bytes:
+                    break
+                if entry.key != keep and not entry.readers:
+                    self._remove(entry)
+
+    def set_max_bytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.evict()
+
+
+cache_directory = os.path.join(settings.data_dir, 'video_cache')
+video_cache = None
+
+
+def set_cache_size(old_value=None, value=None):
+    global video_cache
+    if value is None:
+        value = settings.video_cache_size
+    if not value:
+        video_cache = None
+    elif video_cache is None:
+        video_cache = VideoCache(cache_directory, value*1024*1024)
+    else:
+        video_cache.set_max_bytes(value*1024*1024)
+
+
+set_cache_size()
+settings.add_setting_changed_hook('video_cache_size', set_cache_size)
@@ -440,6 +440,9 @@ def extract_info(video_id, use_invidious, playlist_id=None, index=None):
     info['invidious_reload_button'] = False
     if (settings.route_tor == 1
             and info['formats'] and info['formats'][0]['url']):
+        if not util.have_time_for_optional_step():
+            print('Skipped checking for URL access; out of time')
+            return info
         try:
             response = util.head(info['formats'][0]['url'],
                                  report_text='Checked for URL access')
@@ -611,9 +614,20 @@ def get_watch_page(video_id=None):
             gevent.spawn(extract_info, video_id, use_invidious,
                          playlist_id=playlist_id, index=index),
         )
-    gevent.joinall(tasks)
+    tasks[1].join()
     util.check_gevent_exceptions(tasks[1])
-    comments_info, info = tasks[0].value, tasks[1].value
+    info = tasks[1].value
+
+    # the comments are optional, so don't wait for them past the deadline
+    remaining = util.time_remaining()
+    tasks[0].join(timeout=None if remaining is None else max(remaining, 0))
+    if tasks[0].ready():
+        comments_info = tasks[0].value
+    else:
+        tasks[0].kill(block=False)
+        print('Left out comments for ' + video_id + '; out of time')
+        comments_info = comments.skipped_comments_info(
+            video_id, int(settings.default_comment_sorting), lc)
 
     if info['error']:
         return flask.render_template('error.html', error_message=info['error'])